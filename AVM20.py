@@ -85,8 +85,7 @@ class PhysicalThing(object):
     def _updateCallback(self, payload, responseStatus, token):
         ''' Log result when a request has been made to update the IOT shadow '''
         if responseStatus == 'accepted':
-            payloadDict = json.loads(payload)
-            self._logger.info("Received delta request: " + json.dumps(payloadDict))
+            self._logger.info('Received delta request: %s', payload)
             return
 
         self._logger.warn({
@@ -96,11 +95,11 @@ class PhysicalThing(object):
 
     def _deltaCallback(self, payload, responseStatus, token):
         ''' Receive an delta message from IOT service and forward update requests for every included property to the event queue '''
-        print ('Delta message received with content: {0}'.format(payload))
+        self._logger.debug('Delta message received with content: %s', payload)
         payloadDict = json.loads(payload)
 
         for property in payloadDict['state']:
-            self._logger.info('Delta Message: processing item [{0}][{1}]'.format(property, payloadDict['state'][property]))
+            self._logger.info('Delta Message: processing item [%s][%s]', property, payloadDict['state'][property])
             self._eventQueue.put({'source': '__thing__', 'action': 'UPDATE', 'property': property, 'value': payloadDict['state'][property] })
 
     def onChange(self, updatedProperties):
@@ -149,7 +148,7 @@ class PhysicalThing(object):
             payloadDict = { 'state': { 'reported': {}, 'desired': {} } }
             for property, value in updatedProperties.items():
                 if self._localShadow[property] != value:
-                    print ('IOT UPDATED: [{0}:{1}]'.format(property, value))
+                    self._logger.debug('IOT UPDATED: [%s:%s]', property, value)
                     updateNeeded = True
                     payloadDict['state']['reported'] = updatedProperties
                     payloadDict['state']['desired'] = updatedProperties
@@ -250,7 +249,7 @@ class PhysicalDevice(ABC):
 
     def _readLoop(self):
         ''' Main event loop for reading from device '''
-        print ('Starting {0} readLoop'.format(self.__name__))
+        self._logger.info('Starting %s readLoop', self.__name__)
         while not self._exit:
             val = self.read()
             if val:
@@ -277,13 +276,13 @@ class PhysicalDevice(ABC):
 
     def _writeLoop(self):
         ''' Main event loop for writing to device '''
-        print ('Starting {0} writeLoop'.format(self.__name__))
+        self._logger.info('Starting %s writeLoop', self.__name__)
 
         while not self._exit:
             try:
                 # Wait for ready state to be reached
                 while not self.ready():
-                    print ('{0} Sleeping ...'.format(self.__name__))
+                    self._logger.debug('%s Sleeping ...', self.__name__)
                     time.sleep(5)
                     raise queue.Empty
 
@@ -293,7 +292,7 @@ class PhysicalDevice(ABC):
                 if message['action'].upper() == 'EXIT':
                     return
                 elif message['action'].upper() == 'UPDATE':
-                    print ('IOT requests [{0}:{1}]'.format(message['property'], message['value']))
+                    self._logger.debug('IOT requests [%s:%s]', message['property'], message['value'])
                     ret = self._propertyToDevice(message['property'])
                     if ret:
                         (cmd, method) = ret
@@ -548,7 +547,7 @@ class denTVThing(PhysicalThing):
         rv = []
         # Make sure AVM is always on and set to the Alexa input when not watching TV
         if updatedProperties.get('powerState') == 'OFF':
-            print ('Returning powerState to ON and input to Alexa')
+            self._logger.info('Returning powerState to ON and input to Alexa')
             rv.append(('powerState','ON'))
             rv.append(('input', 'CD'))
         return rv
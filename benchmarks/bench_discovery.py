@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+# Measures the time to answer a discovery request for a user with 500 endpoints, comparing per-endpoint interface generation with the per-class capability cache and the per-user discovery cache
+#
+# Usage: python -m benchmarks.bench_discovery
+
+import time
+
+from pyASH.endpoint import Endpoint
+from pyASH.interface import BrightnessController, ColorController, EndpointHealth, PowerController, Speaker, InputController
+from pyASH.iot import IotTest, Thing
+from pyASH.pyASH import pyASH
+from pyASH.user import StaticUser, User
+
+class iotBench(IotTest):
+    pass
+
+@Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+@Endpoint.addInterface(BrightnessController, proactivelyReported=True, retrievable=True)
+@Endpoint.addInterface(ColorController, proactivelyReported=True, retrievable=True)
+@Endpoint.addInterface(EndpointHealth, proactivelyReported=True, retrievable=True)
+class benchLight(Endpoint):
+    displayCategories = ['LIGHT']
+
+@Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+@Endpoint.addInterface(Speaker, proactivelyReported=True, retrievable=True)
+@Endpoint.addInterface(InputController)
+class benchTV(Endpoint):
+    displayCategories = ['TV']
+
+def makeUser(count=500):
+    user = StaticUser()
+    for i in range(count):
+        cls = benchLight if i % 2 else benchTV
+        user.addEndpoint(cls(things=Thing('device_{0}'.format(i), iotBench), friendlyName='Device {0}'.format(i)))
+    return user
+
+def uncached(endpoints):
+    ''' Discovery as it was performed before capabilities were cached: every endpoint generates its interfaces (and an Iot object for each) '''
+    ret = []
+    for ep in endpoints:
+        with ep.openSession():
+            capabilities = [{ 'type': 'AlexaInterface', 'interface': 'Alexa', 'version': '3' }]
+            for object in ep._generateInterfaces().values():
+                capabilities.append(object.jsonDiscover)
+            ret.append(capabilities)
+    return ret
+
+def main(count=500, repeat=5):
+    user = makeUser(count)
+    pyash = pyASH(user)
+
+    best = min([ _time(lambda: uncached(user.endpoints.values())) for i in range(repeat) ])
+    print('{0:<10} {1:8.1f} ms for {2} endpoints'.format('uncached', best * 1000, count))
+
+    best = min([ _time(lambda: pyash._discoveryResponse(User.getDiscovery(user, None))) for i in range(repeat) ])
+    print('{0:<10} {1:8.1f} ms for {2} endpoints'.format('per class', best * 1000, count))
+
+    best = min([ _time(lambda: pyash.handleDiscovery(None)) for i in range(repeat) ])
+    print('{0:<10} {1:8.1f} ms for {2} endpoints'.format('per user', best * 1000, count))
+
+def _time(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    main()
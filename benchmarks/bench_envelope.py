@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+# Compares the per-response cost of building message envelopes through python_jsonschema_objects (strict) and from templates
+#
+# Usage: python -m benchmarks.bench_envelope
+
+import timeit
+
+from pyASH import envelope
+
+def response(strict):
+    return {
+        'context': { 'properties': [] },
+        'event': {
+            'header': envelope.header('Alexa', 'Response', correlationToken='dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==', strict=strict),
+            'endpoint': envelope.endpoint('dhroneTV:device_1', token='access-token-from-skill', strict=strict),
+            'payload': {}
+        }
+    }
+
+def main(number=2000):
+    # Build once so that the one time cost of generating the ASHO classes is not counted
+    response(True)
+    for strict in [True, False]:
+        elapsed = timeit.timeit(lambda: response(strict), number=number)
+        print('{0:<8} {1:8.1f} us per response'.format('strict' if strict else 'fast', elapsed / number * 1000000))
+
+if __name__ == '__main__':
+    main()
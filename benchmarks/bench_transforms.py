@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+# Measures the cost of creating an Iot object and of translating its reported state into properties, comparing the per-object transform tables pyASH used to build with the per-class tables it builds now
+#
+# Usage: python -m benchmarks.bench_transforms
+
+import time
+import timeit
+
+from pyASH.iot import IotTest, doNothing
+from pyASH.utility import VALID_PROPERTIES
+
+class iotBench(IotTest):
+    @IotTest.transformFromProperty('powerState', 'apower')
+    def fromPowerState(self, value):
+        return { 'ON': True, 'OFF': False }.get(value, value)
+
+    @IotTest.transformToProperty('powerState', 'apower')
+    def toPowerState(self, value):
+        return { True: 'ON', False: 'OFF' }.get(value, value)
+
+    @IotTest.transformToProperty('input', 'source')
+    def toInput(self, value):
+        return value.upper()
+
+def _validateProperty(property):
+    for interface in VALID_PROPERTIES:
+        if property in VALID_PROPERTIES[interface]:
+            return property
+    raise ValueError('{0} is not a valid property'.format(property))
+
+def _setTransforms(iot):
+    ''' Builds the transform tables the way each Iot object used to '''
+    iot.fromPropertybyProperty = {}
+    iot.toPropertybyProperty = {}
+    iot.fromPropertybyVariable = {}
+    iot.toPropertybyVariable = {}
+    for supercls in iot.__class__.__mro__:
+        for method in supercls.__dict__.values():
+            for property in getattr(method, '_transformFromList', {}):
+                iot.fromPropertybyProperty[property] = (method, getattr(method, '_transformFromList', {}).get(property))
+                iot.fromPropertybyVariable[getattr(method, '_transformFromList', {}).get(property)] = (method, property)
+            for property in getattr(method, '_transformToList', {}):
+                iot.toPropertybyProperty[property] = (method, getattr(method, '_transformToList', {}).get(property))
+                iot.toPropertybyVariable[getattr(method, '_transformToList', {}).get(property)] = (method, property)
+
+def _batchGet(iot):
+    ''' Translates the reported state the way batchGet used to '''
+    ret = {}
+    for variable in iot.reportedState:
+        if variable in iot.toPropertybyVariable:
+            (method, property) = iot.toPropertybyVariable[variable]
+        else:
+            try:
+                property = _validateProperty(variable)
+            except ValueError:
+                continue
+            method = doNothing
+        ret[property] = method(iot, iot.reportedState[variable])
+    return ret
+
+def main(number=20000):
+    iot = iotBench()
+    # Keep batchGet from retrieving the state again while it is being measured
+    iot.lastGet = time.time()
+    iot.consideredStaleAfter = 3600
+    iot.reportedState = { 'apower': True, 'source': 'hdmi1', 'volume': 10, 'muted': False, 'brightness': 50, 'thermostatMode': 'AUTO', 'firmware': '1.0', 'connectivity': { 'value': 'OK' } }
+    assert _batchGet(iot) == iot.batchGet()
+    variables = len(iot.reportedState)
+
+    legacy = timeit.timeit(lambda: _setTransforms(iot), number=number)
+    compiled = timeit.timeit(iot.setTransforms, number=number)
+    print('{0:<24} {1:8.2f} us per object (legacy {2:.2f} us)'.format('setTransforms', compiled / number * 1000000, legacy / number * 1000000))
+
+    legacy = timeit.timeit(lambda: _batchGet(iot), number=number)
+    compiled = timeit.timeit(iot.batchGet, number=number)
+    print('{0:<24} {1:8.3f} us per variable (legacy {2:.3f} us)'.format('batchGet', compiled / number / variables * 1000000, legacy / number / variables * 1000000))
+
+    legacy = timeit.timeit(lambda: _validateProperty('holdStartTime'), number=number)
+    compiled = timeit.timeit(lambda: iotBench.validateProperty('holdStartTime'), number=number)
+    print('{0:<24} {1:8.3f} us per property (legacy {2:.3f} us)'.format('validateProperty', compiled / number * 1000000, legacy / number * 1000000))
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,13 @@
 # Copyright 2018 dhrone. All Rights Reserved.
 #
 
-import json
-
 # pyASH imports
 from pyASH.endpoint import Endpoint
 from pyASH.iot import Iot, Thing
 from pyASH.interface import PowerController, EndpointHealth
 from pyASH.utility import LOGLEVEL
 from pyASH.user import DbUser
-from pyASH.objects import Request
-from pyASH.pyASH import pyASH
+from pyASH import warm
 
 # Setup logger
 import logging
@@ -46,15 +43,11 @@ class cloudLight(Endpoint):
 
 
 
-def lambda_handler(request, context):
-    token = Request(request).token
-    user = DbUser(token=Request(request).token, classes=[cloudLight, Iot])
-    print ('Received '+ json.dumps(request))
-    pyASHinstance = pyASH(user)
-    print ('Processing message')
-    response = pyASHinstance.lambda_handler(request)
-    print ('Returning '+json.dumps(response))
-    return response
+def makeUser(token):
+    return DbUser(token=token, classes=[cloudLight, Iot])
+
+# The user (and their endpoints) for each token is reused by later invocations of a warm container
+lambda_handler = warm.lambdaHandler(makeUser)
 
 
 if __name__ == u'__main__':
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""Awaitable counterparts of the Iot, User and Persist objects used by pyASH.async_lambda_handler
+
+boto3 (and the Amazon profile API) only offer blocking calls so each counterpart wraps the synchronous object and runs its I/O on a thread pool.  While one call is blocked the event loop is free to start others, which lets independent I/O (e.g. the shadow reads for each of an endpoint's things) overlap instead of being made one after another.
+
+The wrapped objects are not thread-safe so a single object must not be used by more than one of these calls at a time.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# pyASH imports
+from .utility import LOGLEVEL
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+MAX_WORKERS = int(os.environ.get('PYASH_ASYNC_WORKERS', 10))
+
+_executor = None
+
+def _getExecutor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _executor
+
+async def run(func, *args, **kwargs):
+    ''' Runs the blocking callable func(*args, **kwargs) on pyASH's thread pool and returns its result
+
+    func runs in a copy of the caller's context so that (for instance) its I/O is included in the request's trace.
+    '''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_getExecutor(), functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+class AsyncIot(object):
+    ''' Awaitable wrapper for an IotBase object.  Attributes that do not require I/O are read from the wrapped object. '''
+    def __init__(self, iot):
+        self.iot = iot
+
+    async def get(self):
+        return await run(self.iot.get)
+
+    async def put(self, newState):
+        return await run(self.iot.put, newState)
+
+    async def batchSet(self, propdict):
+        return await run(self.iot.batchSet, propdict)
+
+    async def batchGet(self):
+        return await run(self.iot.batchGet)
+
+    async def updateFinished(self, timeout=5):
+        return await run(self.iot.updateFinished, timeout)
+
+    async def getitem(self, property):
+        return await run(self.iot.__getitem__, property)
+
+    async def setitem(self, property, value):
+        return await run(self.iot.__setitem__, property, value)
+
+    def __getattr__(self, name):
+        return getattr(self.iot, name)
+
+async def prefetch(session, things):
+    ''' Retrieves the shadow of each thing (through session so the Iot objects are shared with the rest of the request) concurrently '''
+    # Iot objects are created here, on the loop's thread, as IotSession is not thread-safe
+    iots = []
+    for thing in things or []:
+        iot = session.getIot(thing)
+        if iot not in iots: iots.append(iot)
+    await asyncio.gather(*[ AsyncIot(iot).get() for iot in iots ])
+    return iots
+
+class AsyncPersist(object):
+    ''' Awaitable wrapper for a Persist object '''
+    def __init__(self, persist):
+        self.persist = persist
+
+    async def get(self, property):
+        return await run(self.persist.__getitem__, property)
+
+    async def set(self, property, value):
+        return await run(self.persist.__setitem__, property, value)
+
+    async def load(self):
+        return await run(self.persist._get)
+
+    async def commit(self):
+        return await run(self.persist._commit)
+
+    def __getattr__(self, name):
+        return getattr(self.persist, name)
+
+class AsyncUser(object):
+    ''' Awaitable wrapper for a User object '''
+    def __init__(self, user):
+        self.user = user
+
+    async def getEndpoints(self, request):
+        return await run(self.user.getEndpoints, request)
+
+    async def getEndpoint(self, request):
+        return await run(self.user.getEndpoint, request)
+
+    async def getDiscovery(self, request):
+        return await run(self.user.getDiscovery, request)
+
+    async def getTokens(self, request):
+        return await run(self.user.getTokens, request)
+
+    async def commit(self):
+        return await run(self.user.commit)
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
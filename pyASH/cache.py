@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# pyASH imports
+from .db import Persist
+from .utility import LOGLEVEL, DEFAULT_SYSTEM_NAME, DEFAULT_REGION
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+class LRUCache(object):
+    ''' Thread-safe, size bounded, in memory cache with optional expiration
+
+    Args:
+        maxsize (int): Maximum number of entries to hold.  The least recently used entry is evicted when the cache is full.
+        ttl (float): Default number of seconds an entry remains valid.  None means entries do not expire.
+    '''
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                (value, expires) = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, key, default=None):
+        ''' Returns the value for key without counting it as a use of the entry '''
+        with self.lock:
+            (value, expires) = self.entries.get(key, (default, None))
+            if expires is not None and expires < time.time():
+                return default
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries) }
+
+class PersistCache(object):
+    ''' Cache stored in a DynamoDB table through Persist so that entries are shared between Lambda containers
+
+    Values must be JSON serializable.  The table is keyed by 'cacheKey' and can be created with createTable.
+
+    Args:
+        tableName (str): Name of the table (the systemName is prefixed to it)
+        ttl (float): Default number of seconds an entry remains valid.  None means entries do not expire.
+    '''
+    def __init__(self, tableName='Cache', ttl=None, systemName=DEFAULT_SYSTEM_NAME, region=DEFAULT_REGION):
+        self.tableName = tableName
+        self.ttl = ttl
+        self.systemName = systemName
+        self.region = region
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _persist(self, key):
+        return Persist(key, 'cacheKey', self.tableName, systemName=self.systemName, region=self.region)
+
+    def get(self, key, default=None):
+        p = self._persist(key)
+        value = p['value']
+        expires = p['expires']
+        if value is None or (expires and expires < time.time()):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        p = self._persist(key)
+        p.item = { 'value': json.dumps(value), 'expires': int(time.time() + ttl) if ttl is not None else 0 }
+        p._commit()
+
+    def delete(self, key):
+        p = self._persist(key)
+        p.item = {}
+        p._commit()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def createTable(self):
+        return Persist('', 'cacheKey', self.tableName, systemName=self.systemName, region=self.region).createTable()
+
+    @property
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
+
+class ResponseCache(object):
+    ''' Remembers the response sent for each directive so that a directive Alexa delivers more than once is only handled once
+
+    Alexa retries directives that it does not receive a timely response to.  Handling a retried AdjustVolume or AdjustBrightness again would apply the adjustment twice so the response to the first delivery is returned instead.  Entries are keyed by the directive's messageId together with a digest of its content and of the bearer token it was sent with so a messageId that is reused for a different directive, or by a different user, is not mistaken for a retry.
+
+    Error responses are not cached so that a retry of a directive that failed is handled again.
+
+    Args:
+        backend (LRUCache or PersistCache): Where responses are stored.  Defaults to an in memory LRUCache.  Use a PersistCache to recognize retries that are delivered to a different Lambda container.
+        ttl (float): Number of seconds a response is remembered for
+    '''
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend if backend is not None else LRUCache(maxsize=1024)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(request):
+        directive = request.raw.get('directive', {})
+        header = directive.get('header', {})
+        content = json.dumps([ getattr(request, 'token', None), header.get('namespace'), header.get('name'), directive.get('endpoint', {}).get('endpointId'), directive.get('payload') ], sort_keys=True, default=str)
+        return 'response:{0}:{1}'.format(header.get('messageId'), hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+    def get(self, request):
+        ''' Returns (a copy of) the response previously sent for request or None '''
+        response = self.backend.get(self.key(request))
+        if response is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(response)
+
+    def set(self, request, response):
+        if response.get('event', {}).get('header', {}).get('name') == 'ErrorResponse':
+            return
+        self.backend.set(self.key(request), response, self.ttl)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses }
+
+class _Flight(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class ShadowCache(object):
+    ''' Process wide cache of thing shadows shared by every Iot object
+
+    Shadows are keyed by (region, thingName) and are only reused while they are younger than their thing's ttl.  If several threads need the same shadow at once only one of them retrieves it and the others wait for its result.  Writes are applied to the cached shadow (as desired state and a delta) so that it does not hide a change that the thing has not confirmed yet.
+
+    Args:
+        maxsize (int): Maximum number of shadows to hold
+        ttl (float): Default number of seconds a shadow is reused for.  Use setTtl to change it for a particular thing.
+    '''
+    def __init__(self, maxsize=1024, ttl=2):
+        self.entries = LRUCache(maxsize=maxsize)
+        self.ttl = ttl
+        self.ttls = {}
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+
+    def setTtl(self, thingName, ttl, region=None):
+        ''' Sets how long the shadow of thingName (in region or, if region is None, in every region) is reused for '''
+        self.ttls[(region, thingName)] = ttl
+
+    def _ttl(self, key):
+        return self.ttls.get(key, self.ttls.get((None, key[1]), self.ttl))
+
+    def get(self, key, fetch):
+        ''' Returns (shadow, retrieved) for key where retrieved is when the shadow was read.  fetch() is called to read the shadow if a fresh one is not cached. '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self.set(key, fetch())
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.event.set()
+
+    def peek(self, key):
+        ''' Returns (shadow, retrieved) for key if a fresh shadow is cached, otherwise None.  The shadow is never read. '''
+        return self.entries.get(key)
+
+    def set(self, key, shadow):
+        ''' Caches shadow (unless a newer version of it is already cached) and returns (shadow, retrieved) '''
+        entry = (shadow, time.time())
+        with self.lock:
+            current = self.entries.peek(key)
+            if current is not None and current[0].get('version', 0) > shadow.get('version', 0):
+                return current
+            self.entries.set(key, entry, self._ttl(key))
+        return entry
+
+    def write(self, key, newState, version=None):
+        ''' Applies newState, which was sent to the shadow as desired state, to the cached copy of the shadow '''
+        with self.lock:
+            current = self.entries.peek(key)
+            if current is None:
+                return
+            (shadow, retrieved) = current
+            state = shadow.get('state', {})
+            reported = state.get('reported', {})
+            delta = { k: v for k, v in { **state.get('delta', {}), **newState }.items() if reported.get(k, _MISSING) != v }
+            # The cached dictionary is replaced rather than modified as other threads may be reading it
+            state = { **state, 'desired': { **state.get('desired', {}), **newState }, 'delta': delta }
+            shadow = { **shadow, 'state': state }
+            if version is not None:
+                shadow['version'] = version
+            # The shadow does not become any fresher
+            ttl = self._ttl(key)
+            self.entries.set(key, (shadow, retrieved), retrieved + ttl - time.time() if ttl is not None else None)
+
+    def delete(self, key):
+        self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.coalesced = 0
+
+    @property
+    def stats(self):
+        return dict(self.entries.stats, coalesced=self.coalesced)
+
+defaultShadowCache = ShadowCache(maxsize=int(os.environ.get('PYASH_SHADOW_CACHE_SIZE', 1024)), ttl=float(os.environ.get('PYASH_SHADOW_CACHE_TTL', 2)))
+
+_MISSING = object()
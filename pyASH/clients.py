@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""Pool of boto3 clients and resources shared by every Iot and Persist object in the process
+
+Constructing a boto3 client is one of the slowest things boto3 does (it resolves endpoints and parses the service model) so pyASH creates one per (service, region, profile) and reuses it.  Clients are thread-safe and are shared between threads.  boto3 resources are not thread-safe so one is kept per thread.
+
+When running inside Lambda the clients pyASH normally needs are created when this module is imported so that the work is done during the Lambda init phase.  Set PYASH_WARM_CLIENTS=0 to disable this.
+
+Tests can substitute a local stub for a service with setStub.
+"""
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# pyASH imports
+from .utility import LOGLEVEL, DEFAULT_REGION, DEFAULT_IOTREGION
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+MAX_POOL_CONNECTIONS = int(os.environ.get('PYASH_MAX_POOL_CONNECTIONS', 20))
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_resources = threading.local()
+_stubs = {}
+
+def _config():
+    try:
+        # tcp_keepalive requires botocore 1.27 or later
+        return Config(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=True)
+    except TypeError:
+        return Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+def _session(profile):
+    if profile not in _sessions:
+        _sessions[profile] = boto3.session.Session(profile_name=profile) if profile else boto3.session.Session()
+    return _sessions[profile]
+
+def getClient(service, region=None, profile=None):
+    ''' Returns the shared client for service in region (using the named credentials profile if provided) '''
+    if service in _stubs:
+        return _stubs[service](region, profile)
+    key = (service, region, profile)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _session(profile).client(service, region_name=region, config=_config())
+                _clients[key] = client
+    return client
+
+def getResource(service, region=None, profile=None):
+    ''' Returns a resource for service in region.  Resources are shared within (but not between) threads. '''
+    if service in _stubs:
+        return _stubs[service](region, profile)
+    key = (service, region, profile)
+    resources = getattr(_resources, 'pool', None)
+    if resources is None:
+        resources = _resources.pool = {}
+    if key not in resources:
+        with _lock:
+            session = _session(profile)
+        resources[key] = session.resource(service, region_name=region, config=_config())
+    return resources[key]
+
+def setStub(service, factory):
+    ''' Causes getClient and getResource to return factory(region, profile) for service instead of a boto3 object '''
+    _stubs[service] = factory
+
+def clearStubs():
+    _stubs.clear()
+
+def reset():
+    ''' Discards every pooled client and resource '''
+    with _lock:
+        _clients.clear()
+        _sessions.clear()
+    _resources.pool = {}
+
+def warm(services=None):
+    ''' Creates the clients pyASH normally needs so that the cost is not paid by the first request '''
+    services = services if services is not None else [ ('client', 'iot-data', DEFAULT_IOTREGION), ('resource', 'dynamodb', DEFAULT_REGION) ]
+    for (kind, service, region) in services:
+        try:
+            if kind == 'client':
+                getClient(service, region)
+            else:
+                getResource(service, region)
+        except Exception as e:
+            logger.warn('Unable to warm {0} {1} for {2}: {3}'.format(service, kind, region, e))
+
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') and os.environ.get('PYASH_WARM_CLIENTS', '1') != '0':
+    warm()
@@ -8,6 +8,8 @@ from botocore.exceptions import ClientError
 import boto3
 
 # pyASH imports
+from .clients import getResource
+from . import instrumentation
 from .utility import LOGLEVEL, DEFAULT_SYSTEM_NAME, DEFAULT_REGION, DEFAULT_IOTREGION
 
 # Setup logger
@@ -29,12 +31,13 @@ class Persist(object):
         self.dataAge = 0
 
     def _get(self):
-        ddb = boto3.resource('dynamodb', self.region)
+        ddb = getResource('dynamodb', self.region)
         table = ddb.Table(self._tableName)
         key = { self.primaryKeyName: self.primaryKey }
         if self.secondaryKeyName:
             key[self.secondaryKeyName] = self.secondaryKey
-        result = table.get_item(Key=key)
+        with instrumentation.span('dynamodb.get'):
+            result = table.get_item(Key=key)
         self.dataAge = time.time()
         if 'Item' in result:
             self.item = result['Item']
@@ -45,10 +48,11 @@ class Persist(object):
         self.item[self.primaryKeyName] = self.primaryKey
         if self.secondaryKeyName:
             self.item[self.secondaryKeyName] = self.secondaryKey
-        ddb = boto3.resource('dynamodb', self.region)
+        ddb = getResource('dynamodb', self.region)
         table = ddb.Table(self._tableName)
         self.dataAge = time.time()
-        return table.put_item(Item=self.item)
+        with instrumentation.span('dynamodb.put'):
+            return table.put_item(Item=self.item)
 
     @property
     def _tableName(self):
@@ -80,14 +84,14 @@ class Persist(object):
 
     def __delitem__(self, key, secondaryKey=None):
         if key not in item: raise KeyError
-        ddb = boto3.resource('dynamodb', self.region)
+        ddb = getResource('dynamodb', self.region)
         table = ddb.Table(self._tableName)
         Key = { self.primaryKeyName: key }
         if self.secondaryKeyName: Key[self.secondaryKeyName] = secondaryKey
         table.delete_item(Key)
 
     def createTable(self):
-        ddb = boto3.resource('dynamodb', self.region)
+        ddb = getResource('dynamodb', self.region)
 
         keyschema = [{'AttributeName':self.primaryKeyName, 'KeyType':'HASH'}]
         attributedefinitions = [{'AttributeName': self.primaryKeyName, 'AttributeType':self._attributeType(self.primaryKey)}]
@@ -108,13 +112,13 @@ class Persist(object):
                 raise
 
     def delTable(self):
-        ddb = boto3.resource('dynamodb', self.region)
+        ddb = getResource('dynamodb', self.region)
         table = ddb.Table(self._tableName)
         table.delete()
 
 
     def ready(self, timeout=5): # Called by user program to check if the table exists and is ready to be interacted with
-        ddb = boto3.resource('dynamodb', self.region)
+        ddb = getResource('dynamodb', self.region)
         table = ddb.Table(self._tableName)
         timeExpired = time.time() + timeout
         while time.time() < timeExpired:
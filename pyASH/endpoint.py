@@ -3,10 +3,12 @@
 # Copyright 2018 dhrone. All Rights Reserved.
 #
 
+import copy
 import json
+from types import MappingProxyType
 
 # pyASH imports
-from .iot import Iot, Thing
+from .iot import Iot, IotGroup, IotSession, Thing
 from .exceptions import INVALID_DIRECTIVE, MISCELLANIOUS_EXCEPTION
 from .utility import LOGLEVEL, VALID_DIRECTIVES, makeList
 from .interface import getInterfaceClass
@@ -27,7 +29,24 @@ class _classproperty(property):
             return self
         return self.func(owner)
 
-class Endpoint(object):
+# Incremented whenever directives or interfaces may have been added to an Endpoint class so that the compiled dispatch tables get rebuilt
+_dispatchGeneration = 0
+
+def _invalidateDispatch():
+    global _dispatchGeneration
+    _dispatchGeneration += 1
+
+class _EndpointMeta(type):
+    ''' Invalidates the compiled dispatch tables when an Endpoint class is modified after it has been defined (e.g. by a class decorator) '''
+    def __setattr__(cls, name, value):
+        super(_EndpointMeta, cls).__setattr__(name, value)
+        _invalidateDispatch()
+
+    def __delattr__(cls, name):
+        super(_EndpointMeta, cls).__delattr__(name)
+        _invalidateDispatch()
+
+class Endpoint(object, metaclass=_EndpointMeta):
     '''
 
     Inherit from Endpoint to define how your device should respond to Alexa Smart Home messages.
@@ -135,7 +154,35 @@ class Endpoint(object):
             if self.displayCategories: self.displayCategories = makeList(self.displayCategories)
             self.cookie = cookie if cookie is not None else self.cookie
 
-        self.iot = self.things[0].iotcls(self.things[0].name)
+        # Sessions (and the Iot objects within them) are only created when the endpoint needs to talk to its things
+        self.session = None
+
+    def openSession(self):
+        '''Returns the IotSession used to process the current request, starting a new one if the previous session has been closed
+
+        All of the Interfaces generated for this endpoint share the session so that each thing's shadow is only retrieved once per request.
+        '''
+        if self.session is None or self.session.closed:
+            self.session = IotSession()
+        return self.session
+
+    @property
+    def iot(self):
+        '''Returns the Iot object (from the current session) for the endpoint's primary thing'''
+        return self.openSession().getIot(self.things[0])
+
+    @property
+    def group(self):
+        '''Returns an IotGroup containing the Iot object (from the current session) for each of the endpoint's things
+
+        Use it to act on all of the things at once.  For example, a scene can turn every one of its things off with::
+
+            @Endpoint.addDirective
+            def Deactivate(self, request):
+                self.group['powerState'] = 'OFF'
+        '''
+        session = self.openSession()
+        return IotGroup([ session.getIot(thing) for thing in self.things ])
 
     @property
     def json(self):
@@ -145,6 +192,7 @@ class Endpoint(object):
 
         d = {
             '__classname__': self.__class__.__name__,
+            'endpointId': self.endpointId,
             'things' : thingDict,
             'friendlyName': self.friendlyName,
             'description': self.description,
@@ -177,6 +225,7 @@ class Endpoint(object):
             item = { 'interface': interface, 'proactivelyReported': proactivelyReported, 'retrievable': retrievable, 'uncertaintyInMilliseconds': uncertaintyInMilliseconds, 'supportsDeactivation': supportsDeactivation, 'cameraStreamConfigurations': cameraStreamConfigurations }
             func.__interfaces__ = getattr(func, '__interfaces__', {})
             if name not in func.__interfaces__: func.__interfaces__[name] = item
+            _invalidateDispatch()
             return func
 
         return wrapper
@@ -218,6 +267,7 @@ class Endpoint(object):
                 func.__interfaces__ = getattr(func, '__interfaces__', {})
                 if interface not in func.__interfaces__: func.__interfaces__[interface] = intf
 
+            _invalidateDispatch()
             return func
         def decorateinterface(func):
             directives = getattr(func, '__directives__', [])
@@ -229,6 +279,7 @@ class Endpoint(object):
             item = { 'interface': icls, 'proactivelyReported': proactivelyReported, 'retrievable': retrievable, 'uncertaintyInMilliseconds': uncertaintyInMilliseconds, 'supportsDeactivation': supportsDeactivation, 'cameraStreamConfigurations': cameraStreamConfigurations }
             func.__interfaces__ = getattr(func, '__interfaces__', {})
             if interface not in func.__interfaces__: func.__interfaces__[interface] = item
+            _invalidateDispatch()
             return func
 
         if args:
@@ -243,6 +294,7 @@ class Endpoint(object):
                 args[0].__interfaces__ = getattr(args[0], '__interfaces__', {})
                 if interface not in args[0].__interfaces__: args[0].__interfaces__[interface] = item
 
+                _invalidateDispatch()
                 return args[0]
             else:
                 return decoratelist
@@ -251,13 +303,40 @@ class Endpoint(object):
 
     @property
     def _getCapabilities(self):
+        # Each endpoint gets its own copy so that changes made to one discovery response cannot reach any other
+        return copy.deepcopy(list(self._capabilities()))
+
+    @classmethod
+    def _capabilities(cls):
+        '''Returns the capability objects for the class
+
+        Capabilities only depend upon the interfaces that have been added to the class so they are computed (without creating any Iot objects) the first time they are needed and then reused for every endpoint of the class.  The returned capability objects are shared and must not be modified (_getCapabilities returns copies of them).
+        '''
+        generation = _dispatchGeneration
+        capabilities = cls.__dict__.get('_compiledCapabilities')
+        if capabilities is None or capabilities[0] != generation:
+            capabilities = (generation, tuple(cls._compileCapabilities()))
+            type.__setattr__(cls, '_compiledCapabilities', capabilities)
+        return capabilities[1]
+
+    @classmethod
+    def _compileCapabilities(cls):
         capabilities = [{
             "type": "AlexaInterface",
             "interface": "Alexa",
             "version": "3"
         }]
 
-        for object in self._generateInterfaces().values():
+        for interface in cls._dispatchTables()[2].values():
+            object = interface['interface'] \
+                ( \
+                    thing=None, \
+                    proactivelyReported=interface['proactivelyReported'], \
+                    retrievable = interface['retrievable'], \
+                    uncertaintyInMilliseconds = interface['uncertaintyInMilliseconds'], \
+                    supportsDeactivation = interface['supportsDeactivation'], \
+                    cameraStreamConfigurations= interface['cameraStreamConfigurations']
+                )
             capabilities.append(object.jsonDiscover)
         return capabilities
 
@@ -274,6 +353,7 @@ class Endpoint(object):
             object = interface['interface'] \
                 ( \
                     thing=self.things[0], \
+                    session=self.session, \
                     proactivelyReported=interface['proactivelyReported'], \
                     retrievable = interface['retrievable'], \
                     uncertaintyInMilliseconds = interface['uncertaintyInMilliseconds'], \
@@ -345,9 +425,22 @@ class Endpoint(object):
         thingNames = [ t.name for t in self.things ]
         return self.__class__.__name__ + ':' + ':'.join(thingNames)
 
-    @property
-    def _directives(self):
-        cls = self.__class__
+    @classmethod
+    def _dispatchTables(cls):
+        '''Returns the directive and interface tables for the class
+
+        The tables are compiled the first time they are needed and stored on the class as read-only mappings.  They are rebuilt if any Endpoint class has been modified since they were compiled.
+        '''
+        generation = _dispatchGeneration
+        tables = cls.__dict__.get('_compiledDispatch')
+        if tables is None or tables[0] != generation:
+            tables = (generation, MappingProxyType(cls._compileDirectives()), MappingProxyType(cls._compileInterfaces()))
+            # Store the tables without triggering the metaclass's invalidation
+            type.__setattr__(cls, '_compiledDispatch', tables)
+        return tables
+
+    @classmethod
+    def _compileDirectives(cls):
         ret = {}
         # Add in default handlers from interface
         for supercls in cls.__mro__:  # This makes inherited Appliances work
@@ -363,9 +456,8 @@ class Endpoint(object):
                     ret[directive] = (supercls, method)
         return ret
 
-    @property
-    def _interfaces(self):
-        cls = self.__class__
+    @classmethod
+    def _compileInterfaces(cls):
         ret = {}
 
         for supercls in cls.__mro__:
@@ -380,6 +472,14 @@ class Endpoint(object):
 
         return ret
 
+    @property
+    def _directives(self):
+        return self._dispatchTables()[1]
+
+    @property
+    def _interfaces(self):
+        return self._dispatchTables()[2]
+
     def _getHandler(self, request):
         ret = self._directives
         if (request.namespace, request.name) in ret:
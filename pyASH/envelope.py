@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""Builders for the header and endpoint sections of the messages pyASH sends to Alexa
+
+The builders produce the same dictionaries as ASHO.Header(...).as_dict() and ASHO.Endpoint(...).as_dict() but from precomputed templates so that building a response does not run python_jsonschema_objects' per attribute type coercion and validation.  Set STRICT (or the PYASH_STRICT_ENVELOPE environment variable) to build them through ASHO instead.
+"""
+
+import os
+
+# pyASH imports
+from .utility import LOGLEVEL, get_uuid
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+STRICT = os.environ.get('PYASH_STRICT_ENVELOPE', '0') == '1'
+PAYLOAD_VERSION = '3'
+
+# Header constants indexed by (namespace, name).  Only messageId and correlationToken vary between messages.
+_headerTemplates = {}
+
+def _strict(strict):
+    return STRICT if strict is None else strict
+
+def header(namespace, name, correlationToken=None, messageId=None, strict=None):
+    ''' Returns the header for an event.  A new messageId is generated if one is not provided. '''
+    messageId = messageId if messageId is not None else get_uuid()
+    if _strict(strict):
+        from .objects import ASHO
+        h = { 'namespace': namespace, 'name': name, 'messageId': messageId, 'payloadVersion': PAYLOAD_VERSION }
+        if correlationToken is not None: h['correlationToken'] = correlationToken
+        return ASHO.Header(**h).as_dict()
+
+    template = _headerTemplates.get((namespace, name))
+    if template is None:
+        template = _headerTemplates[(namespace, name)] = { 'namespace': namespace, 'name': name, 'payloadVersion': PAYLOAD_VERSION }
+    ret = dict(template)
+    ret['messageId'] = messageId
+    if correlationToken is not None: ret['correlationToken'] = correlationToken
+    return ret
+
+def scope(token):
+    return { 'type': 'BearerToken', 'token': token }
+
+def endpoint(endpointId, token=None, strict=None):
+    ''' Returns the endpoint section of an event, including a BearerToken scope if token is provided '''
+    if _strict(strict):
+        from .objects import ASHO
+        if token is not None:
+            return ASHO.Endpoint(endpointId=endpointId, scope=ASHO.Scope(type='BearerToken', token=token)).as_dict()
+        return ASHO.Endpoint(endpointId=endpointId).as_dict()
+
+    ret = { 'endpointId': endpointId }
+    if token is not None: ret['scope'] = scope(token)
+    return ret
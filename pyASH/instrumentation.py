@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""Opt-in timing of the phases of a request
+
+When enabled (set ENABLED or the PYASH_INSTRUMENT environment variable to 1) pyASH.lambda_handler starts a Trace for each request.  The I/O and processing steps that pyASH performs while handling the request are wrapped in spans which record how many times each phase ran and how long it took in total.  When the request finishes the trace is passed (as a dictionary) to each registered sink::
+
+    from pyASH import instrumentation
+    instrumentation.ENABLED = True
+    instrumentation.addSink(instrumentation.LogSink())
+
+Spans are not nested.  Time spent in a span that runs inside another span is counted by both of them.
+
+When instrumentation is disabled a span costs a single context variable lookup.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+# pyASH imports
+from .utility import LOGLEVEL
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+ENABLED = os.environ.get('PYASH_INSTRUMENT', '0') == '1'
+
+_currentTrace = contextvars.ContextVar('pyASH_trace', default=None)
+_sinks = []
+
+class Trace(object):
+    ''' Durations and counts of the phases of a single request '''
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def record(self, phase, elapsed=0, count=1):
+        with self.lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = [0, 0]
+            totals[0] += count
+            totals[1] += elapsed
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+
+    def asDict(self):
+        ''' Returns the trace with all durations in milliseconds '''
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.start
+        return {
+            'name': self.name,
+            'ms': round(elapsed * 1000, 3),
+            'phases': { phase: { 'count': count, 'ms': round(total * 1000, 3) } for phase, (count, total) in self.phases.items() }
+        }
+
+class _Span(object):
+    __slots__ = ('trace', 'phase', 'start')
+
+    def __init__(self, trace, phase):
+        self.trace = trace
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.record(self.phase, time.perf_counter() - self.start)
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_nullSpan = _NullSpan()
+
+class _TraceContext(object):
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+        self.token = None
+
+    def __enter__(self):
+        if ENABLED and _currentTrace.get() is None:
+            self.trace = Trace(self.name)
+            self.token = _currentTrace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.trace is None:
+            return
+        _currentTrace.reset(self.token)
+        self.trace.finish()
+        emit(self.trace)
+
+def trace(name):
+    ''' Returns a context manager that traces the enclosed request if instrumentation is enabled.  It yields the Trace (or None) '''
+    return _TraceContext(name)
+
+def span(phase):
+    ''' Returns a context manager that times the enclosed code as phase of the current request '''
+    trace = _currentTrace.get()
+    if trace is None:
+        return _nullSpan
+    return _Span(trace, phase)
+
+def count(phase, n=1):
+    ''' Counts n occurrences of phase (without timing it) in the current request '''
+    trace = _currentTrace.get()
+    if trace is not None:
+        trace.record(phase, count=n)
+
+def currentTrace():
+    return _currentTrace.get()
+
+def emit(trace):
+    data = trace.asDict()
+    for sink in list(_sinks):
+        try:
+            sink(data)
+        except Exception as e:
+            logger.warn('Instrumentation sink {0} failed: {1}'.format(sink, e))
+
+def addSink(sink):
+    ''' Registers sink (a callable that accepts the trace dictionary) to receive every finished trace '''
+    _sinks.append(sink)
+    return sink
+
+def removeSink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+# Traces are logged separately so that they can be enabled independently of pyASH's LOGLEVEL
+traceLogger = logging.getLogger(__name__+'.traces')
+traceLogger.setLevel(logging.INFO)
+
+class LogSink(object):
+    ''' Writes each trace as a single JSON log line '''
+    def __init__(self, logger=traceLogger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, data):
+        self.logger.log(self.level, json.dumps(data, sort_keys=True))
+
+class MemorySink(object):
+    ''' Keeps the traces it receives in traces.  Intended for tests. '''
+    def __init__(self):
+        self.traces = []
+
+    def __call__(self, data):
+        self.traces.append(data)
+
+    def clear(self):
+        self.traces = []
@@ -8,19 +8,24 @@ import time
 from .iot import Iot
 from .utility import get_utc_timestamp
 from .objects import ASHO
+from . import instrumentation
+
+_UNKNOWN = object()
 
 class Interface(object):
     interface = None
     version = None
     properties = None
 
-    def __init__(self,thing=None, uncertaintyInMilliseconds=0):
+    def __init__(self,thing=None, uncertaintyInMilliseconds=0, session=None):
         if not self.interface: self.interface = 'Alexa.'+self.__class__.__name__
         self.version='3'
         self.uncertaintyInMilliseconds = uncertaintyInMilliseconds
         self.thing = thing
+        self.iot = None
         if self.thing:
-            self.iot = thing.iotcls(thing.name)
+            # Share the request's Iot object if a session was provided so that the shadow is only retrieved once
+            self.iot = session.getIot(thing) if session else thing.iotcls(thing.name)
 
     @property
     def capability(self):
@@ -35,6 +40,10 @@ class Interface(object):
     @property
     def jsonResponse(self):
         if not self.properties: return []
+        with instrumentation.span('interface.jsonResponse'):
+            return self._jsonResponse()
+
+    def _jsonResponse(self):
         if self.iot:
             timeStamps = self.iot.timeStamps
             for item, value in self.properties.properties.items():
@@ -57,7 +66,8 @@ class Interface(object):
         if self.iot:
             if type(value) is tuple:
                 value = value[0]
-            if self.iot[property] != value:
+            # Only skip the write if the thing is known to already have the value.  Reading the shadow to find out would cost as much as the write.
+            if self.iot.knownValue(property, _UNKNOWN) != value:
                 self.iot[property] = self._formatForProperty(value)
         self.properties[property] = value
 
@@ -146,8 +156,8 @@ class Interface(object):
         self[propertyName] = (v, get_utc_timestamp(), self.uncertaintyInMilliseconds)
 
 class BrightnessController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(BrightnessController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(BrightnessController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
 
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('brightness')], \
@@ -182,8 +192,8 @@ class CameraStreamController(Interface):
         return { 'type': 'AlexaInterface', 'interface': self.interface, 'version': self.version, 'cameraStreamConfigurations': cameraStreams }
 
 class ChannelController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(ChannelController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(ChannelController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('channel')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -193,8 +203,8 @@ class ChannelController(Interface):
         return { k:v for k, v in value.items() if k in ['number','callSign','affiliateCallSign'] }
 
 class ColorController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(ColorController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(ColorController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('color')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -203,8 +213,8 @@ class ColorController(Interface):
         self._setdirective(request, 'color', 'color')
 
 class ColorTemperatureController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(ColorTemperatureController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(ColorTemperatureController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('colorTemperatureInKelvin')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -225,15 +235,15 @@ class ColorTemperatureController(Interface):
         self['colorTemperatureInKelvin'] = (v, get_utc_timestamp(), self.uncertaintyInMilliseconds)
 
 class EndpointHealth(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(EndpointHealth, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(EndpointHealth, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('connectivity')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
 
 class InputController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(InputController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(InputController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('input')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -242,8 +252,8 @@ class InputController(Interface):
         self['input'] = (request.payload['input'], get_utc_timestamp(), self.uncertaintyInMilliseconds)
 
 class LockController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(LockController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(LockController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('lockState')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -257,16 +267,16 @@ class LockController(Interface):
         self['lockState'] = ('UNLOCKED', get_utc_timestamp(), self.uncertaintyInMilliseconds)
 
 class MeetingClientController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(MeetingClientController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(MeetingClientController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
 
         # Needs special discovery logic
         # Need to add another structure for meeting.  See https://developer.amazon.com/docs/device-apis/alexa-meetingclientcontroller.html#properties payload details
         # Uses generic response with no context object
 
 class PercentageController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(PercentageController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(PercentageController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('percentage')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -278,16 +288,16 @@ class PercentageController(Interface):
         self._adjustdirective(request, 'percentage', 'percentageDelta', range(101))
 
 class PlaybackController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(PlaybackController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(PlaybackController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
 
         # Requires special discovery logic
         # Basicallly receives player state events and needs to command that action for the device
         # Response is just a generic message.  Weirdly the example shows a context but the properties are empty.
 
 class PowerController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(PowerController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(PowerController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('powerState')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -299,8 +309,8 @@ class PowerController(Interface):
         self['powerState'] = ('OFF', get_utc_timestamp(), self.uncertaintyInMilliseconds)
 
 class PowerLevelController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(PowerLevelController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(PowerLevelController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('powerLevel')], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -312,8 +322,8 @@ class PowerLevelController(Interface):
         self._adjustdirective(request, 'powerLevel', 'powerLevelDelta', range(101))
 
 class SceneController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, supportsDeactivation=False, *args, **kwargs):
-        super(SceneController, self).__init__(thing=thing)
+    def __init__(self, thing=None, proactivelyReported=False, supportsDeactivation=False, session=None, *args, **kwargs):
+        super(SceneController, self).__init__(thing=thing, session=session)
         self.proactivelyReported = proactivelyReported
         self.supportsDeactivation = supportsDeactivation
 
@@ -322,8 +332,8 @@ class SceneController(Interface):
         return { 'type':'AlexaInterface', 'interface':self.interface, 'version': self.version, 'supportsDeactivation': self.supportsDeactivation, 'proactivelyReported': self.proactivelyReported }
 
 class StepSpeaker(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(StepSpeaker, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(StepSpeaker, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
 
     # Assumes that iot['volume'] is used to tell the speaker how much to increase or decrease the volume by
     def AdjustVolume(self, request):
@@ -338,8 +348,8 @@ class StepSpeaker(Interface):
             self.iot['muted'] = request.payload['mute']
 
 class Speaker(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(Speaker, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(Speaker, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('volume'), Interface.Property('muted') ], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
@@ -355,15 +365,15 @@ class Speaker(Interface):
 
 
 class TemperatureSensor(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
-        super(TemperatureSensor, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
+        super(TemperatureSensor, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         self.properties = \
             Interface.Properties(self.interface, [ Interface.Property('temperature') ], \
                 proactivelyReported=proactivelyReported, retrievable=retrievable)
 
 class ThermostatController(Interface):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, thermostatType='single', *args, **kwargs):
-        super(ThermostatController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds)
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, thermostatType='single', session=None, *args, **kwargs):
+        super(ThermostatController, self).__init__(thing=thing, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session)
         prop_list = [ Interface.Property('thermostatMode') ]
         if thermostatType.lower() == 'single':
             prop_list.append( Interface.Property('targetSetpoint'))
@@ -399,20 +409,20 @@ class ThermostatController(Interface):
         self['thermostatMode'] = (tm, get_utc_timestamp(), self.uncertaintyInMilliseconds)
 
 class ThermostatControllerSingle(ThermostatController):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
         self.interface = 'Alexa.'+'ThermostatController'
-        super(ThermostatControllerSingle, self).__init__(thing=thing, proactivelyReported=proactivelyReported, retrievable=retrievable, uncertaintyInMilliseconds=uncertaintyInMilliseconds, thermostatType='single')
+        super(ThermostatControllerSingle, self).__init__(thing=thing, proactivelyReported=proactivelyReported, retrievable=retrievable, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session, thermostatType='single')
 
 
 class ThermostatControllerDual(ThermostatController):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
         self.interface = 'Alexa.'+'ThermostatController'
-        super(ThermostatControllerDual, self).__init__(thing=thing, proactivelyReported=proactivelyReported, retrievable=retrievable, uncertaintyInMilliseconds=uncertaintyInMilliseconds, thermostatType='dual')
+        super(ThermostatControllerDual, self).__init__(thing=thing, proactivelyReported=proactivelyReported, retrievable=retrievable, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session, thermostatType='dual')
 
 class ThermostatControllerTriple(ThermostatController):
-    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, *args, **kwargs):
+    def __init__(self, thing=None, proactivelyReported=False, retrievable=False, uncertaintyInMilliseconds=0, session=None, *args, **kwargs):
         self.interface = 'Alexa.'+'ThermostatController'
-        super(ThermostatControllerTriple, self).__init__(thing=thing, proactivelyReported=proactivelyReported, retrievable=retrievable, uncertaintyInMilliseconds=uncertaintyInMilliseconds, thermostatType='triple')
+        super(ThermostatControllerTriple, self).__init__(thing=thing, proactivelyReported=proactivelyReported, retrievable=retrievable, uncertaintyInMilliseconds=uncertaintyInMilliseconds, session=session, thermostatType='triple')
 
 
 
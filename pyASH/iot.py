@@ -3,13 +3,24 @@
 # Copyright 2018 dhrone. All Rights Reserved.
 #
 
+import contextvars
 import json
+import os
+import threading
 import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 
 # pyASH imports
 from .utility import *
+from .exceptions import ENDPOINT_UNREACHABLE
+from .wait import VersionWait
+from .clients import getClient
+from .cache import defaultShadowCache
+from . import instrumentation
 
 # Setup logger
 import logging
@@ -20,11 +31,285 @@ logger.setLevel(LOGLEVEL)
 def doNothing(obj, value):
     return value
 
+# Returned by _cachedValue when a variable's value is not held outside of the Iot object
+_NOT_CACHED = object()
+
+def _isVersionConflict(e):
+    ''' Returns True if e is the error AWS returns when an update's version does not match the shadow's '''
+    return getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConflictException'
+
 class Thing(object):
     def __init__(self, name, iotcls):
         self.name = name
         self.iotcls = iotcls
 
+class IotSession(object):
+    ''' Request scoped identity map for Iot objects
+
+    An IotSession hands out a single Iot object per thing so that every participant in a request (the Endpoint, pyASH and each Interface) shares the same shadow state.  A thing's shadow is therefore fetched at most once per request and any write made through one participant is visible to all of the others.
+
+    The session also tracks how many shadow round trips its Iot objects have made which is useful when testing.
+    '''
+    def __init__(self):
+        self.iots = {}
+        self.closed = False
+        self.buffering = False
+
+    def getIot(self, thing):
+        key = (thing.iotcls, thing.name)
+        if key not in self.iots:
+            iot = thing.iotcls(thing.name)
+            iot.buffering = self.buffering
+            self.iots[key] = iot
+        return self.iots[key]
+
+    def bufferWrites(self):
+        ''' Holds the writes made to each of the session's things (see IotBase.bufferWrites) until flush is called '''
+        self.buffering = True
+        for iot in self.iots.values():
+            iot.buffering = True
+
+    def flush(self):
+        ''' Sends the writes held for each thing as a single update per thing (concurrently) and stops buffering '''
+        self.buffering = False
+        iots = list(self.iots.values())
+        for iot in iots:
+            iot.buffering = False
+        IotGroup([ iot for iot in iots if iot.bufferedState ]).flush()
+
+    @contextmanager
+    def buffered(self):
+        ''' Buffers the writes made within the with block and flushes them when it exits.  Has no effect if the session is already buffering. '''
+        if self.buffering:
+            yield self
+            return
+        self.bufferWrites()
+        try:
+            yield self
+        finally:
+            self.flush()
+
+    @property
+    def shadowGets(self):
+        return sum([ iot.getCount for iot in self.iots.values() ])
+
+    @property
+    def shadowPuts(self):
+        return sum([ iot.putCount for iot in self.iots.values() ])
+
+    @property
+    def roundTrips(self):
+        return self.shadowGets + self.shadowPuts
+
+    @property
+    def waitTime(self):
+        ''' Total seconds spent waiting for things to finish updating during the request '''
+        return sum([ iot.waitTime for iot in self.iots.values() ])
+
+    @property
+    def waitPolls(self):
+        ''' Total number of shadow reads (or shadow messages received) while waiting for things to finish updating '''
+        return sum([ iot.waitPolls for iot in self.iots.values() ])
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class IotGroup(object):
+    ''' Performs the same operation on several Iot objects at once
+
+    Endpoints that control more than one thing (e.g. a scene that acts on several devices as a group) can use an IotGroup to read and write all of their things concurrently so that the time an operation takes is bounded by the slowest thing rather than the sum of all of them.  Operations on a group of one thing are performed directly on the calling thread.
+
+    If the operation fails for any of the things an ENDPOINT_UNREACHABLE exception naming each thing that failed is raised after every thing has been tried.  The individual exceptions are available in failures.
+
+    Args:
+        iots (list): The Iot objects that make up the group
+    '''
+    maxWorkers = int(os.environ.get('PYASH_GROUP_WORKERS', 10))
+
+    _executor = None
+    _executorLock = threading.Lock()
+
+    def __init__(self, iots):
+        self.iots = list(iots)
+        self.failures = {}
+
+    @classmethod
+    def _getExecutor(cls):
+        if IotGroup._executor is None:
+            with IotGroup._executorLock:
+                if IotGroup._executor is None:
+                    IotGroup._executor = ThreadPoolExecutor(max_workers=cls.maxWorkers)
+        return IotGroup._executor
+
+    def _map(self, func):
+        ''' Calls func(iot) for every Iot object in the group and returns the results indexed by thing name '''
+        results = {}
+        self.failures = {}
+        if len(self.iots) == 1:
+            outcomes = [ (self.iots[0], self._call(func, self.iots[0])) ]
+        else:
+            # Each call runs in a copy of the caller's context so that it is included in the request's trace
+            futures = [ (iot, self._getExecutor().submit(contextvars.copy_context().run, self._call, func, iot)) for iot in self.iots ]
+            outcomes = [ (iot, future.result()) for (iot, future) in futures ]
+        for (iot, (result, e)) in outcomes:
+            if e is not None:
+                self.failures[iot.getThingName()] = e
+            else:
+                results[iot.getThingName()] = result
+        return results
+
+    @staticmethod
+    def _call(func, iot):
+        try:
+            return (func(iot), None)
+        except Exception as e:
+            return (None, e)
+
+    def _raiseFailures(self, action):
+        if self.failures:
+            names = ', '.join(sorted(self.failures))
+            logger.warn('Unable to %s %s: %s', action, names, self.failures)
+            raise ENDPOINT_UNREACHABLE('Unable to {0} {1} of {2} things ({3})'.format(action, len(self.failures), len(self.iots), names))
+
+    def get(self):
+        ''' Retrieves every thing's shadow and returns them indexed by thing name '''
+        results = self._map(lambda iot: iot.get())
+        self._raiseFailures('retrieve the shadow for')
+        return results
+
+    def put(self, newState):
+        ''' Sends newState to every thing (or, for things that are buffering writes, adds it to their buffered writes) '''
+        self._map(lambda iot: iot._write(newState))
+        self._raiseFailures('update')
+
+    def batchSet(self, propdict):
+        self._map(lambda iot: iot.batchSet(propdict))
+        self._raiseFailures('update')
+
+    def flush(self):
+        ''' Sends the writes held by each thing (see IotBase.bufferWrites) '''
+        self._map(lambda iot: iot.flush())
+        self._raiseFailures('update')
+
+    def batchGet(self):
+        results = self._map(lambda iot: iot.batchGet())
+        self._raiseFailures('retrieve properties from')
+        return results
+
+    def __getitem__(self, property):
+        ''' Returns the value of property for every thing indexed by thing name '''
+        results = self._map(lambda iot: iot[property])
+        self._raiseFailures('retrieve {0} from'.format(property))
+        return results
+
+    def __setitem__(self, property, value):
+        def _set(iot):
+            iot[property] = value
+        self._map(_set)
+        self._raiseFailures('set {0} on'.format(property))
+
+    def updateFinished(self, timeout=5):
+        ''' Waits (concurrently) for every thing to finish updating.  Raises ENDPOINT_UNREACHABLE if any of them do not finish within timeout seconds '''
+        results = self._map(lambda iot: iot.updateFinished(timeout=timeout))
+        for name, finished in results.items():
+            if not finished:
+                self.failures[name] = ENDPOINT_UNREACHABLE('Timed out waiting for {0} to update'.format(name))
+        self._raiseFailures('confirm the update of')
+        return True
+
+    def __iter__(self):
+        return iter(self.iots)
+
+    def __len__(self):
+        return len(self.iots)
+
+class BulkGet(object):
+    ''' The outcome of retrieving the shadows of many things at once (see bulkGet)
+
+    Attributes:
+        iots (dict): The Iot object for each thing indexed by thing name
+        shadows (dict): The shadow of each thing that was retrieved
+        errors (dict): The exception raised for each thing that could not be retrieved
+        latency (dict): Seconds taken to retrieve each thing's shadow (whether or not it succeeded)
+        elapsed (float): Seconds taken to retrieve all of them
+    '''
+    def __init__(self):
+        self.iots = {}
+        self.shadows = {}
+        self.errors = {}
+        self.latency = {}
+        self.elapsed = 0
+
+    def __getitem__(self, thingName):
+        return self.shadows[thingName]
+
+    def __contains__(self, thingName):
+        return thingName in self.shadows
+
+    def __len__(self):
+        return len(self.shadows)
+
+BULK_WORKERS = int(os.environ.get('PYASH_BULK_WORKERS', 32))
+
+_bulkExecutor = None
+_bulkExecutorLock = threading.Lock()
+
+def _getBulkExecutor():
+    global _bulkExecutor
+    if _bulkExecutor is None:
+        with _bulkExecutorLock:
+            if _bulkExecutor is None:
+                _bulkExecutor = ThreadPoolExecutor(max_workers=BULK_WORKERS)
+    return _bulkExecutor
+
+def _timedGet(iot):
+    start = time.perf_counter()
+    try:
+        return (iot.get(), None, time.perf_counter() - start)
+    except Exception as e:
+        return (None, e, time.perf_counter() - start)
+
+def bulkGet(things, maxWorkers=None):
+    ''' Retrieves the shadows of many things concurrently and returns a BulkGet
+
+    Requests are made by a pool of (at most BULK_WORKERS or, if provided, maxWorkers) threads so retrieving many things takes about as long as the slowest of each batch rather than the sum of all of them.  Shadows are read through the Iot class's shadowCache so recently read shadows are not retrieved again and the ones that are retrieved are available to later requests.  A thing that cannot be retrieved is reported in errors rather than raising an exception.
+
+    Args:
+        things (list): Thing objects (or Iot objects) to retrieve
+        maxWorkers (int): Number of shadows to retrieve at the same time
+    '''
+    result = BulkGet()
+    for thing in things:
+        iot = thing.iotcls(thing.name) if isinstance(thing, Thing) else thing
+        result.iots.setdefault(iot.getThingName(), iot)
+
+    start = time.perf_counter()
+    iots = list(result.iots.values())
+    if maxWorkers is None:
+        futures = [ _getBulkExecutor().submit(contextvars.copy_context().run, _timedGet, iot) for iot in iots ]
+        outcomes = [ future.result() for future in futures ]
+    else:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            outcomes = list(executor.map(lambda iot: contextvars.copy_context().run(_timedGet, iot), iots))
+    result.elapsed = time.perf_counter() - start
+
+    for (iot, (shadow, e, latency)) in zip(iots, outcomes):
+        name = iot.getThingName()
+        result.latency[name] = latency
+        if e is not None:
+            result.errors[name] = e
+        else:
+            result.shadows[name] = shadow
+    if result.errors:
+        logger.warning('Unable to retrieve the shadow for %s of %s things: %s', len(result.errors), len(iots), ', '.join(sorted(result.errors)))
+    return result
+
 class IotBase(ABC):
     def __init__(self, endpointId, consideredStaleAfter=2):
         self.endpointId = endpointId
@@ -33,8 +318,17 @@ class IotBase(ABC):
         self.reportedStateTimeStamp = { 'connectivity': {'timestamp': time.time() } }
         self.lastGet = 0
         self.consideredStaleAfter = consideredStaleAfter
+        self.getCount = 0
+        self.putCount = 0
+        self.pendingState = {}
+        self.lastPutVersion = None
+        self.waitTime = 0
+        self.waitPolls = 0
+        self.buffering = False
+        self.bufferedState = {}
+
+        # The shadow is not retrieved until a value is actually needed
 
-        self.get()
 
     def getThingName(self):
         return self.endpointId
@@ -52,7 +346,8 @@ class IotBase(ABC):
     def timeStamps(self):
         pass
 
-    def updateFinished(self):
+    def updateFinished(self, timeout=5):
+        self._sendBuffered()
         self.reportedState['connectivity'] = {'value': 'OK'}
         self.reportedStateTimeStamp['connectivity'] = {'timestamp': time.time() }
         return True
@@ -60,33 +355,98 @@ class IotBase(ABC):
     def _stale(self):
         return True if self.lastGet + self.consideredStaleAfter < time.time() else False
 
+    def _ensureLoaded(self):
+        ''' Retrieves the shadow if it has never been retrieved '''
+        if not self.lastGet and not self.getCount:
+            self.get()
+
     def __getitem__(self, property):
         if self._stale():
             self.get()
         (method, variable) = self._getMethodVariable(property, 'to')
+        # Writes that have not been sent yet take precedence over the shadow
+        if variable in self.bufferedState:
+            return method(self, self.bufferedState[variable])
         return method(self, self.reportedState[variable])
 
     def __setitem__(self, property, value):
+        # Writing does not require the shadow so it is not retrieved to validate the variable
+        (method, variable) = self._getMethodVariable(property, 'from', load=False)
+        self._write({variable : method(self, value)})
+
+    def knownValue(self, property, default=None):
+        ''' Returns the value of property from state that is already held, without reading the shadow
+
+        A write that has not been sent yet is always known.  Otherwise the reported value is returned if this object's shadow is not stale, and then the value from a fresh copy of the shadow held by a shared cache (see _cachedValue).  If the value is not known default is returned.
+        '''
         try:
-            (method, variable) = self._getMethodVariable(property, 'from')
-        except KeyError:
-            method = doNothing
-            variable = property
-        self.put({variable : method(self, value)})
+            (method, variable) = self._getMethodVariable(property, 'to', load=False)
+        except ValueError:
+            return default
+        if variable in self.bufferedState:
+            return method(self, self.bufferedState[variable])
+        if variable in self.reportedState and not self._stale():
+            return method(self, self.reportedState[variable])
+        value = self._cachedValue(variable, _NOT_CACHED)
+        if value is not _NOT_CACHED:
+            return method(self, value)
+        return default
+
+    def _cachedValue(self, variable, default):
+        ''' Returns the value of variable held for the thing outside of this object or default.  There is no such state by default. '''
+        return default
+
+    def bufferWrites(self):
+        ''' Holds subsequent writes made through __setitem__ and batchSet so that they can be sent to the thing as a single update by flush
+
+        Held writes are merged in the order they were made so a later write to a variable replaces an earlier one.  Reads made while writes are held return the held values.  Waiting for the thing to finish updating (updateFinished) sends the held writes first.
+        '''
+        self.buffering = True
+
+    def flush(self):
+        ''' Stops buffering and sends any held writes '''
+        self.buffering = False
+        self._sendBuffered()
+
+    @contextmanager
+    def buffered(self):
+        ''' Buffers the writes made within the with block and flushes them when it exits.  Has no effect if the object is already buffering. '''
+        if self.buffering:
+            yield self
+            return
+        self.bufferWrites()
+        try:
+            yield self
+        finally:
+            self.flush()
+
+    def _sendBuffered(self):
+        if self.bufferedState:
+            (newState, self.bufferedState) = (self.bufferedState, {})
+            self.put(newState)
+
+    def _write(self, newState):
+        if self.buffering:
+            self.bufferedState = { **self.bufferedState, **newState }
+        else:
+            self.put(newState)
 
-    def _getMethodVariable(self,property, direction='from'):
-        fromtoProperties = self.fromPropertybyProperty if direction.lower() == 'from' else self.toPropertybyProperty
-        if Iot.validateProperty(property) in fromtoProperties:
+    def _getMethodVariable(self,property, direction='from', load=True):
+        fromtoProperties = self.fromPropertybyProperty if direction == 'from' else self.toPropertybyProperty
+        # Properties in the tables were validated when their transform was declared
+        if property in fromtoProperties:
             (method, variable) = fromtoProperties[property]
         else:
             method = doNothing
-            variable = property
-        if variable not in self.reportedState:
-            raise KeyError('{0} is not a valid value for this Iot device'.format(variable))
+            variable = Iot.validateProperty(property)
+        if load and variable not in self.reportedState:
+            self._ensureLoaded()
+            if variable not in self.reportedState:
+                raise KeyError('{0} is not a valid value for this Iot device'.format(variable))
         return (method, variable)
 
     def _getMethodProperty(self, variable, direction='from'):
-        fromtoVariables = self.fromPropertybyVariable if direction.lower() == 'from' else self.toPropertybyVariable
+        fromtoVariables = self.fromPropertybyVariable if direction == 'from' else self.toPropertybyVariable
         if variable in fromtoVariables:
             (method, property) = fromtoVariables[variable]
         else:
@@ -103,18 +463,29 @@ class IotBase(ABC):
                 method = doNothing
                 variable = property
             vars[variable] = method(self, propdict[property])
-        self.put(vars)
+        self._write(vars)
 
     def batchGet(self):
         if self._stale():
             self.get()
         ret = {}
+        state = { **self.reportedState, **self.bufferedState }
+        translations = self.propertyByVariable
+        for (variable, value) in state.items():
+            translation = translations.get(variable)
+            # Variables that do not correspond to a property are skipped
+            if translation is not None:
+                ret[translation[1]] = translation[0](self, value)
+        return ret
+
+    def _propertyTimeStamps(self):
+        ''' Returns the timestamp of each of the thing's reported variables that corresponds to a property, indexed by property '''
+        ret = {}
+        translations = self.propertyByVariable
         for variable in self.reportedState:
-            try:
-                (method, property) = self._getMethodProperty(variable, 'to')
-            except ValueError:
-                continue
-            ret[property] = method(self, self.reportedState[variable])
+            translation = translations.get(variable)
+            if translation is not None:
+                ret[translation[1]] = self.reportedStateTimeStamp[variable]['timestamp']
         return ret
 
     def refresh(self):
@@ -122,9 +493,8 @@ class IotBase(ABC):
 
     @staticmethod
     def validateProperty(property):
-        for interface in VALID_PROPERTIES:
-            if property in VALID_PROPERTIES[interface]:
-                return property
+        if property in INTERFACES_BY_PROPERTY:
+            return property
         raise ValueError('{0} is not a valid property'.format(property))
 
     @classmethod
@@ -152,18 +522,39 @@ class IotBase(ABC):
         return decorateinterface
 
     def setTransforms(self):
-        self.fromPropertybyProperty = {}
-        self.toPropertybyProperty = {}
-        self.fromPropertybyVariable = {}
-        self.toPropertybyVariable = {}
-        for supercls in self.__class__.__mro__:  # This makes inherited Appliances work
+        (self.fromPropertybyProperty, self.toPropertybyProperty, self.fromPropertybyVariable, self.toPropertybyVariable, self.propertyByVariable) = self._transformTables()
+
+    @classmethod
+    def _transformTables(cls):
+        ''' Returns the transform tables for the class
+
+        The tables are built when the first object of the class is created and are stored on the class as read-only mappings.  Transforms must therefore be declared (with transformFromProperty and transformToProperty) when the class is defined.
+        '''
+        tables = cls.__dict__.get('_compiledTransforms')
+        if tables is None:
+            tables = tuple([ MappingProxyType(table) for table in cls._compileTransforms() ])
+            cls._compiledTransforms = tables
+        return tables
+
+    @classmethod
+    def _compileTransforms(cls):
+        fromPropertybyProperty = {}
+        toPropertybyProperty = {}
+        fromPropertybyVariable = {}
+        toPropertybyVariable = {}
+        for supercls in cls.__mro__:  # This makes inherited Appliances work
             for method in supercls.__dict__.values():
                 for property in getattr(method, '_transformFromList', {}):
-                    self.fromPropertybyProperty[property] = (method, getattr(method, '_transformFromList', {}).get(property))
-                    self.fromPropertybyVariable[getattr(method, '_transformFromList', {}).get(property)] = (method, property)
+                    fromPropertybyProperty[property] = (method, getattr(method, '_transformFromList', {}).get(property))
+                    fromPropertybyVariable[getattr(method, '_transformFromList', {}).get(property)] = (method, property)
                 for property in getattr(method, '_transformToList', {}):
-                    self.toPropertybyProperty[property] = (method, getattr(method, '_transformToList', {}).get(property))
-                    self.toPropertybyVariable[getattr(method, '_transformToList', {}).get(property)] = (method, property)
+                    toPropertybyProperty[property] = (method, getattr(method, '_transformToList', {}).get(property))
+                    toPropertybyVariable[getattr(method, '_transformToList', {}).get(property)] = (method, property)
+
+        # How to translate each variable the thing can report into a property.  Variables that are not transformed must be named after a property.
+        propertyByVariable = { property: (doNothing, property) for property in INTERFACES_BY_PROPERTY }
+        propertyByVariable.update(toPropertybyVariable)
+        return (fromPropertybyProperty, toPropertybyProperty, fromPropertybyVariable, toPropertybyVariable, propertyByVariable)
 
 class IotTest(IotBase):
     def __init__(self, *args, **kwargs):
@@ -177,6 +568,7 @@ class IotTest(IotBase):
 
 
     def get(self):
+        self.getCount += 1
         try:
             filename = self.__class__.__name__+'.json'
             with open(filename) as json_file:
@@ -187,9 +579,12 @@ class IotTest(IotBase):
             pass
 
     def put(self, newState):
+        # The whole state is written to the file so what is already stored there must be merged in first
+        self._ensureLoaded()
+        self.putCount += 1
         currentTime = int(time.time())
         for item in newState:
-            print ('Storing {0}:{1}'.format(item,newState[item]))
+            logger.debug('Storing %s:%s', item, newState[item])
             self.reportedState[item] = newState[item]
             self.reportedStateTimeStamp[item] = {'timestamp': currentTime }
         df = {'reportedState': self.reportedState, 'reportedStateTimeStamp': self.reportedStateTimeStamp }
@@ -199,15 +594,8 @@ class IotTest(IotBase):
 
     @property
     def timeStamps(self):
-        ret = {}
-        for variable in self.reportedState:
-            try:
-                (method, property) = self._getMethodProperty(variable, 'to')
-                ret[property] = self.reportedStateTimeStamp[variable]['timestamp']
-            except ValueError:
-                # If a variable can not be translated from device to property then skip it
-                pass
-        return ret
+        self._ensureLoaded()
+        return self._propertyTimeStamps()
 
     @staticmethod
     def initial(name, value):
@@ -224,11 +612,24 @@ class IotTest(IotBase):
 
 
 class Iot(IotBase):
+    # Strategy used by updateFinished to wait for the thing to apply changes.  Override in a subclass to use a different one (e.g. BackoffWait or SubscriptionWait)
+    waitStrategy = VersionWait()
+    # Cache of recently read shadows shared with the other Iot objects in the process.  Set to None in a subclass to always read the shadow.
+    shadowCache = defaultShadowCache
+    # Set to True in a subclass to send the version of the shadow last seen with each update.  AWS rejects the update if the shadow has changed since then in which case the shadow is read again and the update resent once.
+    versionedWrites = False
+
     def __init__(self, endpointId, region=DEFAULT_IOTREGION, consideredStaleAfter=2):
         self.client = None
         self.region = region
+        self.shadowVersion = None
         super(Iot, self).__init__(endpointId, consideredStaleAfter)
 
+    @classmethod
+    def bulkGet(cls, thingNames, region=DEFAULT_IOTREGION, maxWorkers=None):
+        ''' Retrieves the shadows of the things named in thingNames concurrently using objects of this class.  Returns a BulkGet (see the module level bulkGet). '''
+        return bulkGet([ cls(name, region=region) for name in thingNames ], maxWorkers=maxWorkers)
+
     @staticmethod
     def createIot(endpointId, region, profileName):
         tp = {
@@ -274,47 +675,101 @@ class Iot(IotBase):
             pass
 
     def get(self):
-        if not self.client:
-            self.client = boto3.client('iot-data', region_name=self.region)
-        thingData = json.loads(self.client.get_thing_shadow(thingName=self.getThingName())['payload'].read().decode('utf-8'))
+        ''' Returns the thing's shadow.  A copy read (by any Iot object) within the last shadowCache ttl seconds is reused unless this object is waiting for the thing to apply its own writes. '''
+        if self.shadowCache is None or self.pendingState:
+            thingData = self._fetch()
+            retrieved = time.time()
+            if self.shadowCache is not None:
+                self.shadowCache.set(self._cacheKey, thingData)
+        else:
+            (thingData, retrieved) = self.shadowCache.get(self._cacheKey, self._fetch)
+        self._apply(thingData, retrieved)
+        return thingData
+
+    def _apply(self, thingData, retrieved):
         self.reportedState = { **self.reportedState, **thingData['state']['reported'] }
         self.reportedStateTimeStamp = { **self.reportedStateTimeStamp, **thingData['metadata']['reported'] }
-        self.lastGet = time.time()
-        return thingData
+        self.shadowVersion = thingData.get('version', self.shadowVersion)
+        self.lastGet = retrieved
+
+    @property
+    def _cacheKey(self):
+        return (self.region, self.getThingName())
+
+    def _cachedValue(self, variable, default):
+        ''' Returns variable's value from the shadowCache's copy of the shadow if it is fresh.  A change that has been requested (desired) but not yet reported takes precedence over the reported value. '''
+        entry = self.shadowCache.peek(self._cacheKey) if self.shadowCache is not None else None
+        if entry is None:
+            return default
+        state = entry[0].get('state', {})
+        if variable in state.get('delta', {}):
+            return state['delta'][variable]
+        return state.get('reported', {}).get(variable, default)
+
+    def _fetch(self):
+        if not self.client:
+            self.client = getClient('iot-data', self.region)
+        self.getCount += 1
+        with instrumentation.span('shadow.get'):
+            return json.loads(self.client.get_thing_shadow(thingName=self.getThingName())['payload'].read().decode('utf-8'))
 
     def put(self, newState):
+        try:
+            response = self._update(newState)
+        except Exception as e:
+            if not (self.versionedWrites and _isVersionConflict(e)):
+                raise
+            logger.debug('Shadow for %s changed since version %s.  Retrying update.', self.getThingName(), self.shadowVersion)
+            thingData = self._fetch()
+            if self.shadowCache is not None:
+                self.shadowCache.set(self._cacheKey, thingData)
+            self._apply(thingData, time.time())
+            response = self._update(newState)
+        self.pendingState = { **self.pendingState, **newState }
+        try:
+            self.lastPutVersion = json.loads(response['payload'].read().decode('utf-8')).get('version')
+        except (KeyError, ValueError, AttributeError):
+            self.lastPutVersion = None
+        if self.lastPutVersion is not None:
+            self.shadowVersion = self.lastPutVersion
+        if self.shadowCache is not None:
+            self.shadowCache.write(self._cacheKey, newState, self.lastPutVersion)
+        currentTime = int(time.time())
+        for item in newState:
+            self.reportedStateTimeStamp[item] = {'timestamp': currentTime}
+
+    def _update(self, newState):
         if not self.client:
-            self.client = boto3.client('iot-data', region_name=self.region)
+            self.client = getClient('iot-data', self.region)
         item = {'state': {'desired': newState}}
+        if self.versionedWrites:
+            if self.shadowVersion is None:
+                # Writes do not require the shadow but a versioned write does need its version.  A version held by the shadowCache is used if there is one.
+                entry = self.shadowCache.peek(self._cacheKey) if self.shadowCache is not None else None
+                if entry is not None and entry[0].get('version') is not None:
+                    self.shadowVersion = entry[0]['version']
+                else:
+                    self._apply(self._fetch(), time.time())
+            if self.shadowVersion is not None:
+                item['version'] = self.shadowVersion
         # Send desired changes to shadow
         bdata = json.dumps(item).encode('utf-8')
-        response = self.client.update_thing_shadow(thingName=self.getThingName(), payload = bdata)
-        currentTime = int(time.time())
-        for item in newState:
-            self.reportedStateTimeStamp[item] = {'timestamp': currentTime}
+        self.putCount += 1
+        with instrumentation.span('shadow.put'):
+            return self.client.update_thing_shadow(thingName=self.getThingName(), payload = bdata)
 
     def updateFinished(self, timeout=5):
+        self._sendBuffered()
         start = time.time()
-        while start+timeout > time.time():
-            ret = self.get()
-            if 'delta' in ret['state']:
-                time.sleep(.1)
-                continue
-            self.reportedState['connectivity'] = {'value': 'OK'}
-            self.reportedStateTimeStamp['connectivity'] = {'timestamp': time.time() }
-            return True
-        self.reportedState['connectivity'] = {'value': 'UNREACHABLE'}
+        finished = self.waitStrategy.wait(self, timeout)
+        self.waitTime += time.time() - start
+        if finished:
+            self.pendingState = {}
+        self.reportedState['connectivity'] = {'value': 'OK' if finished else 'UNREACHABLE'}
         self.reportedStateTimeStamp['connectivity'] = {'timestamp': time.time() }
-        return False
+        return finished
 
     @property
     def timeStamps(self):
-        ret = {}
-        for variable in self.reportedState:
-            try:
-                (method, property) = self._getMethodProperty(variable, 'to')
-                ret[property] = self.reportedStateTimeStamp[variable]['timestamp']
-            except ValueError:
-                # If a variable can not be translated from device to property then skip it
-                pass
-        return ret
+        self._ensureLoaded()
+        return self._propertyTimeStamps()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""Helpers for logging from pyASH's request path without paying for messages that are not going to be written
+
+Messages are formatted by the logging module only if their level is enabled so arguments should be passed separately rather than formatted into the message.  Anything that is expensive to compute (e.g. serializing a response) should be wrapped in Lazy so that it is only computed when the message is actually written::
+
+    logger.debug('Response is %s', Lazy(dumps, response))
+
+Full request and response payloads can be large so payload() only logs a sample of them (see PAYLOAD_SAMPLE_RATE).  Bearer tokens, OAUTH2 codes and refresh tokens are always redacted from logged payloads.
+"""
+
+import json
+import os
+import random
+
+# pyASH imports
+from .utility import LOGLEVEL
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+# Fraction of requests (0 to 1) whose full payloads are logged when the logger's level permits it
+PAYLOAD_SAMPLE_RATE = float(os.environ.get('PYASH_LOG_PAYLOAD_SAMPLE_RATE', 1))
+
+REDACTED = '<redacted>'
+SENSITIVE_KEYS = frozenset(['token', 'accessToken', 'refreshToken', 'access_token', 'refresh_token', 'code'])
+
+class Lazy(object):
+    ''' Defers calling func(*args, **kwargs) until the value is formatted into a log message.  The value is computed at most once. '''
+    __slots__ = ('func', 'args', 'kwargs', 'value')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+
+    def __str__(self):
+        if self.value is None:
+            self.value = str(self.func(*self.args, **self.kwargs))
+        return self.value
+
+    __repr__ = __str__
+
+def redact(obj):
+    ''' Returns a copy of obj with the values of any sensitive keys (e.g. bearer tokens) replaced '''
+    if isinstance(obj, dict):
+        return { k: REDACTED if k in SENSITIVE_KEYS and v else redact(v) for k, v in obj.items() }
+    if isinstance(obj, list):
+        return [ redact(item) for item in obj ]
+    return obj
+
+def dumps(obj):
+    ''' Serializes obj to JSON with sensitive values redacted '''
+    return json.dumps(redact(obj), default=str)
+
+def event(logger, level, name, **fields):
+    ''' Logs a structured event.  The fields are available to handlers as record.pyASH and are appended to the message as JSON. '''
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s %s', name, Lazy(dumps, fields), extra={ 'pyASH': dict(fields, event=name) })
+
+def payload(logger, message, obj, level=logging.DEBUG, sampleRate=None):
+    ''' Logs a full (redacted) payload for a sample of the calls made while level is enabled for logger '''
+    if not logger.isEnabledFor(level):
+        return False
+    sampleRate = PAYLOAD_SAMPLE_RATE if sampleRate is None else sampleRate
+    if sampleRate < 1 and random.random() >= sampleRate:
+        return False
+    logger.log(level, '%s %s', message, Lazy(dumps, obj))
+    return True
@@ -3,42 +3,60 @@
 # Copyright 2018 by dhrone. All Rights Reserved.
 #
 
+import hashlib
 import json
 import os
-import python_jsonschema_objects as pjs
+import threading
 
 from .utility import VALID_DIRECTIVES
 
+path_to_schema = os.path.dirname(__file__)+'/alexa_smart_home_message_schema.json'
 
-with open(os.path.dirname(__file__)+'/alexa_smart_home_message_schema.json') as json_file:
-    schema = json.load(json_file)
+# The schema used to generate the ASHO classes, precomputed from the Alexa Smart Home message schema.
+# Regenerate it with 'python -m pyASH.objects' whenever the message schema changes.
+path_to_compiled_schema = os.environ.get('PYASH_ASHO_SCHEMA', os.path.dirname(__file__)+'/asho_schema.json')
 
-# Calculate all of the possible values for name in a header
-DIRECTIVES = list(set([item for nested in VALID_DIRECTIVES.values() for item in nested]))
-DIRECTIVES += schema['definitions']['ErrorResponse.properties']['name']['enum']
-DIRECTIVES += schema['definitions']['ResponseOrStateReport.properties']['name']['enum']
-DIRECTIVES += schema['definitions']['ChangeReport.properties']['name']['enum']
-DIRECTIVES += schema['definitions']['DeferredResponse.properties']['name']['enum']
-DIRECTIVES += schema['definitions']['Discover.Response.properties']['name']['enum']
+def _objectSchema(schema):
+    """ Derives the schema that the ASHO classes are generated from out of the Alexa Smart Home message schema """
 
-cp = { k:v for k,v in schema['definitions']['common.properties'].items() if k in ['payloadVersion', 'message', 'currentDeviceMode', 'messageId', 'correlationToken', 'temperature', 'channel', 'input', 'volume', 'muted', 'timestamp', 'uncertaintyInMilliseconds', 'resolution', 'protocol', 'authorizationType', 'videoCodec', 'audioCodec', 'cameraStream', 'cause', 'version', 'endpointId']}
+    # Calculate all of the possible values for name in a header
+    DIRECTIVES = list(set([item for nested in VALID_DIRECTIVES.values() for item in nested]))
+    DIRECTIVES += schema['definitions']['ErrorResponse.properties']['name']['enum']
+    DIRECTIVES += schema['definitions']['ResponseOrStateReport.properties']['name']['enum']
+    DIRECTIVES += schema['definitions']['ChangeReport.properties']['name']['enum']
+    DIRECTIVES += schema['definitions']['DeferredResponse.properties']['name']['enum']
+    DIRECTIVES += schema['definitions']['Discover.Response.properties']['name']['enum']
+    DIRECTIVES = sorted(DIRECTIVES)
 
-# Add Header
-cp['header'] = schema['definitions']['ErrorResponse.properties']['header.general']
-cp['header']['properties']['namespace']['enum'] = [x for x in VALID_DIRECTIVES.keys()]
-cp['header']['properties']['name'] = { 'enum': DIRECTIVES }
+    cp = { k:v for k,v in schema['definitions']['common.properties'].items() if k in ['payloadVersion', 'message', 'currentDeviceMode', 'messageId', 'correlationToken', 'temperature', 'channel', 'input', 'volume', 'muted', 'timestamp', 'uncertaintyInMilliseconds', 'resolution', 'protocol', 'authorizationType', 'videoCodec', 'audioCodec', 'cameraStream', 'cause', 'version', 'endpointId']}
 
-cp['scope'] = {"type": "object", "required": ["type", "token"], "properties": {"type": {"enum": ["BearerToken"]}, "token": {"type": "string", "minLength": 1}}}
+    # Add Header
+    cp['header'] = schema['definitions']['ErrorResponse.properties']['header.general']
+    cp['header']['properties']['namespace']['enum'] = [x for x in VALID_DIRECTIVES.keys()]
+    cp['header']['properties']['name'] = { 'enum': DIRECTIVES }
 
-cp['endpoint'] = {"type": "object", "additionalProperties": False, "required": ["endpointId"], "properties": {"scope": {"$ref": "#/definitions/scope"}, "endpointId": {"$ref": "#/definitions/common.properties/endpointId"}, "cookie": {"type": "object"}}}
+    cp['scope'] = {"type": "object", "required": ["type", "token"], "properties": {"type": {"enum": ["BearerToken"]}, "token": {"type": "string", "minLength": 1}}}
 
+    cp['endpoint'] = {"type": "object", "additionalProperties": False, "required": ["endpointId"], "properties": {"scope": {"$ref": "#/definitions/scope"}, "endpointId": {"$ref": "#/definitions/common.properties/endpointId"}, "cookie": {"type": "object"}}}
 
-# Add objects from interfaces if missing from common.properties
-for iName, iValue in schema['definitions']['common.properties']['interfaces'].items():
-    if iName in ['BrightnessController', 'ColorController', 'ColorTemperatureController', 'EndpointHealth', 'LockController', 'PercentageController', 'PowerController', 'PowerLevelController', 'ThermostatController']:
-        for objName, objDef in { k:v for k,v in iValue.items() if k not in 'capabilities'}.items():
-            iobj = ''.join([ x for x in iName if x.isupper() ])+objName
-            cp[iobj] = objDef['property']['properties']['value']
+
+    # Add objects from interfaces if missing from common.properties
+    for iName, iValue in schema['definitions']['common.properties']['interfaces'].items():
+        if iName in ['BrightnessController', 'ColorController', 'ColorTemperatureController', 'EndpointHealth', 'LockController', 'PercentageController', 'PowerController', 'PowerLevelController', 'ThermostatController']:
+            for objName, objDef in { k:v for k,v in iValue.items() if k not in 'capabilities'}.items():
+                iobj = ''.join([ x for x in iName if x.isupper() ])+objName
+                cp[iobj] = objDef['property']['properties']['value']
+
+    fixCommonProperties(cp)
+
+    return {
+        "title": "Test",
+        "id": "tst",
+        "definitions": cp,
+        "oneOf": [
+            { "$ref": "#/definitions/channel"}
+        ]
+    }
 
 def fixCommonProperties(ashSchema):
     for k, v in ashSchema.items():
@@ -49,19 +67,78 @@ def fixCommonProperties(ashSchema):
             for item in v:
                 if type(item) is dict: fixCommonProperties(item)
 
-fixCommonProperties(cp)
+def _schemaHash(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+def _loadCompiledSchema(schemaHash):
+    """ Returns the precomputed object schema if one exists for the current message schema """
+    try:
+        with open(path_to_compiled_schema) as json_file:
+            compiled = json.load(json_file)
+    except (OSError, ValueError):
+        return None
+    if compiled.get('hash') != schemaHash:
+        return None
+    return compiled['schema']
+
+def writeCompiledSchema(path=None):
+    """ Precomputes the object schema so that it does not need to be derived and meta-validated at run time """
+    with open(path_to_schema, 'rb') as schema_file:
+        raw = schema_file.read()
+    with open(path if path else path_to_compiled_schema, 'w') as outfile:
+        json.dump({ 'hash': _schemaHash(raw), 'schema': _objectSchema(json.loads(raw.decode('utf-8'))) }, outfile, sort_keys=True)
+
+def _prevalidatedBuilder(pjs, schema):
+    """ Returns an ObjectBuilder for a schema that was already meta-validated when it was precomputed
 
-schema = {
-    "title": "Test",
-    "id": "tst",
-    "definitions": cp,
-    "oneOf": [
-        { "$ref": "#/definitions/channel"}
-    ]
-}
+    ObjectBuilder always validates its schema against the draft 4 meta schema so this performs the rest of its initialization directly.
+    """
+    import jsonschema
+    builder = pjs.ObjectBuilder.__new__(pjs.ObjectBuilder)
+    builder.mem_resolved = {}
+    builder.schema = schema
+    builder.basedir = os.path.dirname(os.path.normpath(pjs.FILE))
+    builder.resolver = jsonschema.RefResolver.from_schema(schema, handlers={ 'file': builder.relative_file_resolver, 'memory': builder.memory_resolver })
+    builder.validator = jsonschema.Draft4Validator(schema, resolver=builder.resolver)
+    builder._classes = None
+    builder._resolved = None
+    return builder
+
+class _LazyNamespace(object):
+    """ Stands in for the namespace of classes generated by python_jsonschema_objects
+
+    Importing python_jsonschema_objects and building the classes is expensive so it is deferred until one of the classes is first used.
+    """
+    def __init__(self):
+        self._classes = None
+        self._lock = threading.Lock()
+
+    @property
+    def built(self):
+        return self._classes is not None
+
+    def _build(self):
+        import python_jsonschema_objects as pjs
+
+        with open(path_to_schema, 'rb') as schema_file:
+            raw = schema_file.read()
+        schema = _loadCompiledSchema(_schemaHash(raw))
+        if schema is not None:
+            builder = _prevalidatedBuilder(pjs, schema)
+        else:
+            builder = pjs.ObjectBuilder(_objectSchema(json.loads(raw.decode('utf-8'))))
+        return builder.build_classes()
+
+    def __getattr__(self, name):
+        # Do not build the classes just because something (e.g. copy or pickle) is probing for special methods
+        if name.startswith('__'): raise AttributeError(name)
+        if self._classes is None:
+            with self._lock:
+                if self._classes is None:
+                    self._classes = self._build()
+        return getattr(self._classes, name)
 
-builder = pjs.ObjectBuilder(schema)
-ASHO = builder.build_classes()
+ASHO = _LazyNamespace()
 
 class Request(dict):
     """Simplifies retrieval of values from a request.
@@ -117,15 +194,40 @@ class Request(dict):
     def __init__(self, rawRequest):
         super(Request, self).__init__(rawRequest)
         self.raw = rawRequest
+        self._keyIndex = None
+        self._children = {}
 
     def __getattr__(self, name):
-        if name == 'raw': raise AttributeError()
-        res = self.findkey(name, self.raw)
+        if name in ['raw', '_keyIndex', '_children']: raise AttributeError(name)
+
+        # The index is built on first access so the request should be treated as read-only once it has been used
+        if self._keyIndex is None:
+            self._keyIndex = self._buildIndex(self.raw)
+        try:
+            res = self._keyIndex[name]
+        except KeyError:
+            raise AttributeError(name)
         if isinstance(res, dict):
-            return Request(res)
+            if name not in self._children:
+                self._children[name] = Request(res)
+            return self._children[name]
         if res:
             return res
-        raise AttributeError()
+        raise AttributeError(name)
+
+    @classmethod
+    def _buildIndex(cls, dictionary):
+        ''' Returns a dictionary holding, for every key within dictionary, the value that findkey would return for it '''
+        ret = {}
+        for k,v in dictionary.items():
+            if k not in ret:
+                ret[k] = v
+            if isinstance(v, dict):
+                for nk, nv in cls._buildIndex(v).items():
+                    # Like findkey, a nested value is only used if it is truthy
+                    if nv and nk not in ret:
+                        ret[nk] = nv
+        return ret
 
     def findkey(self, key, dictionary):
         for k,v in dictionary.items():
@@ -137,3 +239,7 @@ class Request(dict):
             else:
                 continue
         return None
+
+
+if __name__ == '__main__':
+    writeCompiledSchema()
@@ -3,15 +3,20 @@
 # Copyright 2018 by dhrone. All Rights Reserved.
 #
 
+import contextvars
 import logging
 import time
-
-import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 #from .utility import *
 from .utility import LOGLEVEL, get_uuid, get_utc_timestamp
-from .exceptions import pyASH_EXCEPTION, OAUTH2_EXCEPTION, MISCELLANIOUS_EXCEPTION
-from .objects import ASHO, Request
+from .exceptions import pyASH_EXCEPTION, OAUTH2_EXCEPTION, MISCELLANIOUS_EXCEPTION, INTERNAL_ERROR
+from .objects import Request
+from . import envelope
+from . import aio
+from . import instrumentation
+from . import log
 
 # Setup logger
 logger = logging.getLogger(__name__)
@@ -32,13 +37,15 @@ class pyASH(object):
 
       """
 
-    def __init__(self, user, version='3'):
+    def __init__(self, user, version='3', responseCache=None):
         """
         Args:
             user (user object): The user object contains the list of endpoints that belong to a user
             version (enum = ['3']): Currently pyASH only supports the version 3 Alexa Smart Home API.
+            responseCache (ResponseCache): Used to answer directives that Alexa delivers more than once without handling them again.  By default every delivery is handled.  A cache may be shared between pyASH objects for different users.
         """
         self.user = user
+        self.responseCache = responseCache or None
         self.version = version if type(version) is str else str(version)
         if not self.version == '3': raise ValueError('pyAsh currently only supports API version 3')
 
@@ -46,7 +53,7 @@ class pyASH(object):
     def _errorResponse(request, e):
         json = {
             'event': {
-                'header': ASHO.Header(namespace='Alexa', name='ErrorResponse', correlationToken=request.correlationToken, messageId=get_uuid(), payloadVersion='3').as_dict(),
+                'header': envelope.header('Alexa', 'ErrorResponse', correlationToken=request.correlationToken),
                 'payload': e.payload
             }
         }
@@ -66,142 +73,114 @@ class pyASH(object):
         """
         try:
             self.user.getTokens(request)
-            return {
-                'event': {
-                    'header': ASHO.Header(namespace='Alexa.Authorization', name='AcceptGrant.Response', messageId=get_uuid(), payloadVersion='3').as_dict(),
-                    'payload': {}
-                }
-            }
+            return self._acceptGrantResponse()
         except pyASH_EXCEPTION as e:
             return self._errorResponse(request, e)
         except:
             raise
 
+    async def asyncHandleAcceptGrant(self, request):
+        """ Awaitable version of handleAcceptGrant """
+        try:
+            await aio.AsyncUser(self.user).getTokens(request)
+            return self._acceptGrantResponse()
+        except pyASH_EXCEPTION as e:
+            return self._errorResponse(request, e)
+
+    @staticmethod
+    def _acceptGrantResponse():
+        return {
+            'event': {
+                'header': envelope.header('Alexa.Authorization', 'AcceptGrant.Response'),
+                'payload': {}
+            }
+        }
+
     def handleDiscovery(self, request):
         """ Sends a list of all of the endpoints a user has installed and what they are capable of to Alexa Smart Home
 
-        Before Alexa Smart Home can control a device, it needs to be told about each endpoint that your skill will handle for a user and what interfaces that endpoint supports.
+        Before Alexa Smart Home can control a device, it needs to be told about each endpoint that your skill will handle for a user and what interfaces that endpoint supports.  The user object caches the list until the user's endpoints change (see User.getDiscovery).
         """
 
-        print ('Entering handleDiscovery')
+        logger.debug('Entering handleDiscovery')
         try:
-            ret = []
-            endpoints = self.user.getEndpoints(request)
-            for ep in endpoints:
-                print ('Processing discovery for endpoint '+ep.endpointId)
-                ret.append(ep.jsonDiscover)
-            return {
-                'event': {
-                    'header': ASHO.Header(namespace='Alexa.Discovery', name='Discover.Response',messageId=get_uuid(), payloadVersion='3').as_dict(),
-                    'payload': {
-                        'endpoints': ret
-                    }
-                }
-            }
+            with instrumentation.span('user'):
+                discovery = self.user.getDiscovery(request)
+            return self._discoveryResponse(discovery)
         except pyASH_EXCEPTION as e:
-            print(e)
+            logger.warn('Discovery failed: %s', e)
             return self._errorResponse(request, e)
         except Exception as e:
-            print(e)
+            logger.error('Discovery failed: %r', e)
             raise
 
+    async def asyncHandleDiscovery(self, request):
+        """ Awaitable version of handleDiscovery """
+        try:
+            with instrumentation.span('user'):
+                discovery = await aio.AsyncUser(self.user).getDiscovery(request)
+            return self._discoveryResponse(discovery)
+        except pyASH_EXCEPTION as e:
+            return self._errorResponse(request, e)
+
+    @staticmethod
+    def _discoveryResponse(discovery):
+        return {
+            'event': {
+                'header': envelope.header('Alexa.Discovery', 'Discover.Response'),
+                'payload': {
+                    'endpoints': discovery
+                }
+            }
+        }
 
     def handleReportState(self, request):
         """ Sends the current property values for the requested endpoint to Alexa Smart Home """
         try:
-            endpoint = self.user.getEndpoint(request)
-            return {
-                'context': {
-                    'properties': endpoint.jsonResponse
-                },
-                'event': {
-                    'header': ASHO.Header(namespace='Alexa', name='StateReport', correlationToken=request.correlationToken,messageId=get_uuid(), payloadVersion='3').as_dict(),
-                    'endpoint': {
-                        'scope': {
-                            'type': 'BearerToken',
-                            'token': request.token
-                        },
-                        'endpointId' : endpoint.endpointId
-                    },
-                    'payload': {}
-                }
-            }
+            with instrumentation.span('user'):
+                endpoint = self.user.getEndpoint(request)
+            return self._stateReport(request, endpoint)
         except pyASH_EXCEPTION as e:
             return self._errorResponse(request, e)
         except:
             raise
 
-    def handleDirective(self, request):
-        """ Based upon the request from Alexa Smart Home, invokes the appropriate method to handle the request """
+    async def asyncHandleReportState(self, request):
+        """ Awaitable version of handleReportState """
+        try:
+            with instrumentation.span('user'):
+                endpoint = await aio.AsyncUser(self.user).getEndpoint(request)
+            return await aio.run(self._stateReport, request, endpoint)
+        except pyASH_EXCEPTION as e:
+            return self._errorResponse(request, e)
 
-        def _getResponseJson(request):
-            if request.namespace != 'Alexa.SceneController':
-                return {
-                    'context': {
-                         'properties': []
+    @staticmethod
+    def _stateReport(request, endpoint):
+        with endpoint.openSession():
+            properties = endpoint.jsonResponse
+        return {
+            'context': {
+                'properties': properties
+            },
+            'event': {
+                'header': envelope.header('Alexa', 'StateReport', correlationToken=request.correlationToken),
+                'endpoint': {
+                    'scope': {
+                        'type': 'BearerToken',
+                        'token': request.token
                     },
-                     'event': {
-                        'header': ASHO.Header(namespace='Alexa', name='Response', correlationToken=request.correlationToken,messageId=get_uuid(), payloadVersion='3').as_dict(),
-                        'endpoint': ASHO.Endpoint(endpointId=endpoint.endpointId).as_dict(),
-                        'payload': {}
-                    }
-                }
-
-            scene_type = 'ActivationStarted' if request.name == 'Activate' else 'DeactivationStarted' if request.name == 'Deactivate' else None
-            return {
-                "context": {
-                    "properties": []
+                    'endpointId' : endpoint.endpointId
                 },
-                "event": {
-                    'header': ASHO.Header(namespace='Alexa.SceneController', name=scene_type, correlationToken=request.correlationToken,messageId=get_uuid(), payloadVersion='3').as_dict(),
-                    'endpoint': ASHO.Endpoint(endpointId=endpoint.endpointId, scope=ASHO.Scope(type='BearerToken', token=request.token)).as_dict(),
-                    "payload": {
-                        "cause": {
-                            "type": "VOICE_INTERACTION"
-                        },
-                        "timestamp": get_utc_timestamp()
-                    }
-                }
+                'payload': {}
             }
+        }
 
+    def handleDirective(self, request):
+        """ Based upon the request from Alexa Smart Home, invokes the appropriate method to handle the request """
         try:
-            endpoint = self.user.getEndpoint(request)
-            cls, handler = endpoint._getHandler(request)
-
-            # If the method to handle the directive comes from the endpoint bind the method to the endpoint
-            if cls.__name__ == endpoint.__class__.__name__:
-                method = handler.__get__(endpoint, cls)
-            else:
-                # else create an object of the handling interface class and bind the method to it
-                method = handler.__get__(cls(endpoint.things[0]), cls)
-
-            ret = method(request)
-
-            interfaces = endpoint._generateInterfaces()
-
-            # If the handler did not produce it's own response message then compute a default one
-            if not ret:
-                waitStarted = time.time()
-                waitFor = 5
-                while not endpoint.iot.updateFinished():
-                    if time.time() > waitStarted+waitFor:
-                        raise ENDPOINT_UNREACHABLE('Timed out waiting for endpoint to update')
-
-                interface = interfaces[request.namespace]
-                interfaceJsonResponse = interface.jsonResponse
-                ret = _getResponseJson(request)
-                if interfaceJsonResponse and type(interfaceJsonResponse) is list:
-                    ret['context']['properties'] += interfaceJsonResponse
-
-            # Check if Endpoint Health is enabled and if yes, add the appropriate context information to the response
-            healthif = interfaces['Alexa.EndpointHealth'] if 'Alexa.EndpointHealth' in endpoint._interfaces else None
-            if healthif:
-                if 'context' not in ret: ret['context'] = {}
-                if 'properties' not in ret['context'] or ret['context']['properties'] is None: ret['context']['properties'] = []
-                ret['context']['properties'] += healthif.jsonResponse
-            if 'scope' in request.raw['directive']['endpoint']: ret['event']['endpoint']['scope'] = request.raw['directive']['endpoint']['scope']
-
-            return ret
+            with instrumentation.span('user'):
+                endpoint = self.user.getEndpoint(request)
+            return self._dispatchDirective(request, endpoint)
         except pyASH_EXCEPTION as e:
             return self._errorResponse(request, e)
         except OAUTH2_EXCEPTION as e:
@@ -211,16 +190,275 @@ class pyASH(object):
         except:
             raise
 
-    def lambda_handler(self, request, context=None):
-        """ Routes the Alexa Smart Home request to the appropriate handler """
-        print ('Entering Lambda Function')
+    async def asyncHandleDirective(self, request):
+        """ Awaitable version of handleDirective
 
-        request = Request(request)
-        response = {
+        The shadows of all of the endpoint's things are retrieved concurrently before the handler is invoked.
+        """
+        try:
+            with instrumentation.span('user'):
+                endpoint = await aio.AsyncUser(self.user).getEndpoint(request)
+            with endpoint.openSession() as session:
+                with instrumentation.span('prefetch'):
+                    await aio.prefetch(session, endpoint.things)
+                return await aio.run(self._dispatchDirective, request, endpoint)
+        except pyASH_EXCEPTION as e:
+            return self._errorResponse(request, e)
+
+    def _dispatchDirective(self, request, endpoint):
+        """ Invokes the method that handles the request on endpoint and returns the response """
+
+        # Share a single Iot object per thing between the endpoint and all of its interfaces for the duration of the request
+        with endpoint.openSession() as session:
+            # Hold the handler's writes so that each thing receives a single shadow update however many properties the handler sets
+            with session.buffered():
+                ret = self._invokeHandler(request, endpoint)
+
+            # If the handler did not produce it's own response message then wait for the endpoint to update before computing a default one
+            if not ret:
+                # Wait (concurrently) for every thing the endpoint controls to finish updating.  Each Iot object's wait strategy handles polling (or listening) for its update to complete and things that were not changed return immediately.
+                with instrumentation.span('wait'):
+                    endpoint.group.updateFinished(timeout=5)
+
+            return self._completeResponse(request, endpoint, ret)
+
+    @staticmethod
+    def _invokeHandler(request, endpoint):
+        """ Invokes the method that handles the request on endpoint and returns its result """
+        cls, handler = endpoint._getHandler(request)
+
+        # If the method to handle the directive comes from the endpoint bind the method to the endpoint
+        if cls.__name__ == endpoint.__class__.__name__:
+            method = handler.__get__(endpoint, cls)
+        else:
+            # else create an object of the handling interface class and bind the method to it
+            method = handler.__get__(cls(endpoint.things[0], session=endpoint.session), cls)
+
+        with instrumentation.span('handler'):
+            return method(request)
+
+    @staticmethod
+    def _defaultResponse(request, endpoint):
+        if request.namespace != 'Alexa.SceneController':
+            return {
+                'context': {
+                     'properties': []
+                },
+                 'event': {
+                    'header': envelope.header('Alexa', 'Response', correlationToken=request.correlationToken),
+                    'endpoint': envelope.endpoint(endpoint.endpointId),
+                    'payload': {}
+                }
+            }
+
+        scene_type = 'ActivationStarted' if request.name == 'Activate' else 'DeactivationStarted' if request.name == 'Deactivate' else None
+        return {
+            "context": {
+                "properties": []
+            },
+            "event": {
+                'header': envelope.header('Alexa.SceneController', scene_type, correlationToken=request.correlationToken),
+                'endpoint': envelope.endpoint(endpoint.endpointId, token=request.token),
+                "payload": {
+                    "cause": {
+                        "type": "VOICE_INTERACTION"
+                    },
+                    "timestamp": get_utc_timestamp()
+                }
+            }
+        }
+
+    def _stateResponse(self, request, endpoint, interfaces=None):
+        """ Returns the default response to request containing the current state of the properties of the interface the request was sent to """
+        interfaces = interfaces or endpoint._generateInterfaces()
+        interfaceJsonResponse = interfaces[request.namespace].jsonResponse
+        ret = self._defaultResponse(request, endpoint)
+        if interfaceJsonResponse and type(interfaceJsonResponse) is list:
+            ret['context']['properties'] += interfaceJsonResponse
+        return ret
+
+    def _completeResponse(self, request, endpoint, ret):
+        """ Returns the response to request using the handler's result (ret) or, if the handler did not produce one, the default response containing the endpoint's current state """
+        interfaces = endpoint._generateInterfaces()
+
+        if not ret:
+            ret = self._stateResponse(request, endpoint, interfaces)
+
+        # Check if Endpoint Health is enabled and if yes, add the appropriate context information to the response
+        healthif = interfaces['Alexa.EndpointHealth'] if 'Alexa.EndpointHealth' in endpoint._interfaces else None
+        if healthif:
+            if 'context' not in ret: ret['context'] = {}
+            if 'properties' not in ret['context'] or ret['context']['properties'] is None: ret['context']['properties'] = []
+            ret['context']['properties'] += healthif.jsonResponse
+        if 'scope' in request.raw['directive']['endpoint']: ret['event']['endpoint']['scope'] = request.raw['directive']['endpoint']['scope']
+
+        return ret
+
+    def handleBatch(self, requests, maxWorkers=10):
+        """ Handles a list of requests together and returns their responses in the same order
+
+        Intended for automation that needs to send many directives at once (e.g. turning off every light).  Directives are grouped by endpoint so that each endpoint is only retrieved from the user once.  All of the directives for an endpoint are handled in a single session, in the order they appear in requests, with their writes held until every directive has been handled so each thing receives a single shadow update.  Different endpoints are handled concurrently (up to maxWorkers at a time).
+
+        A directive that does not produce its own response reports the state of its interface as it was once that directive was handled (i.e. including the held writes of the directives before it but not those after it).  Unlike lambda_handler the reported values are the ones that were written rather than the ones the thing confirmed.  Endpoint health is reported once the thing has finished updating.
+
+        Requests that are not directives (e.g. discovery or ReportState) are handled as lambda_handler would, after the directives that precede them in requests have completed and before any that follow them.
+
+        An exception only affects the directives it was raised for.  Exceptions that are not Alexa errors (e.g. a failed AWS call) are reported as INTERNAL_ERROR.
+        """
+        requests = [ Request(request) for request in requests ]
+        responses = [ None ] * len(requests)
+
+        with instrumentation.trace('batch'):
+            directives = []
+            for i, request in enumerate(requests):
+                if request.namespace in self._handlers:
+                    self._handleDirectives(directives, responses, maxWorkers)
+                    directives = []
+                    try:
+                        responses[i] = self._route(request)
+                    except Exception as e:
+                        responses[i] = self._batchErrorResponse(request, e)
+                else:
+                    directives.append((i, request))
+            self._handleDirectives(directives, responses, maxWorkers)
+
+        return responses
+
+    def _handleDirectives(self, items, responses, maxWorkers):
+        """ Handles each (index, request) in items, grouped by endpoint, and stores their responses in responses """
+        # Group directives by user so that the user is loaded once per token
+        groups = OrderedDict()
+        for (i, request) in items:
+            groups.setdefault(getattr(request, 'token', None) or '', []).append((i, request))
+
+        # Retrieve each endpoint once.  User objects are not thread-safe so this is done before handling the directives concurrently.
+        byEndpoint = OrderedDict()
+        for token in sorted(groups):
+            for (i, request) in groups[token]:
+                try:
+                    with instrumentation.span('user'):
+                        endpoint = self.user.getEndpoint(request)
+                except Exception as e:
+                    responses[i] = self._batchErrorResponse(request, e)
+                    continue
+                byEndpoint.setdefault(id(endpoint), (endpoint, []))[1].append((i, request))
+
+        work = [ (endpoint, sorted(items, key=lambda item: item[0])) for (endpoint, items) in byEndpoint.values() ]
+        if not work:
+            return
+        if len(work) == 1:
+            results = [ self._dispatchBatch(*work[0]) ]
+        else:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                results = list(executor.map(lambda item: contextvars.copy_context().run(self._dispatchBatch, *item), work))
+        for result in results:
+            for i, response in result.items():
+                responses[i] = response
+
+    def _dispatchBatch(self, endpoint, items):
+        """ Handles each (index, request) in items on endpoint and returns the responses indexed by index """
+        responses = {}
+        handled = []
+        wait = False
+        with endpoint.openSession() as session:
+            session.bufferWrites()
+            for (i, request) in items:
+                try:
+                    ret = self._invokeHandler(request, endpoint)
+                    if not ret:
+                        # Reads return the held writes so this is the state as of this directive
+                        wait = True
+                        ret = self._stateResponse(request, endpoint)
+                    handled.append((i, request, ret))
+                except Exception as e:
+                    responses[i] = self._batchErrorResponse(request, e)
+
+            try:
+                # One update per thing for all of the directives
+                session.flush()
+                if wait:
+                    with instrumentation.span('wait'):
+                        endpoint.group.updateFinished(timeout=5)
+            except Exception as e:
+                for (i, request, ret) in handled:
+                    responses[i] = self._batchErrorResponse(request, e)
+                return responses
+
+            for (i, request, ret) in handled:
+                try:
+                    responses[i] = self._completeResponse(request, endpoint, ret)
+                except Exception as e:
+                    responses[i] = self._batchErrorResponse(request, e)
+        return responses
+
+    def _batchErrorResponse(self, request, e):
+        """ Returns the error response for a directive within a batch.  Exceptions that are not Alexa errors are logged and reported as INTERNAL_ERROR. """
+        if not isinstance(e, pyASH_EXCEPTION):
+            logger.error('%s.%s failed: %r', request.namespace, request.name, e)
+            e = INTERNAL_ERROR('{0}: {1}'.format(type(e).__name__, e))
+        return self._errorResponse(request, e)
+
+    @property
+    def _handlers(self):
+        return {
             'Alexa' : self.handleReportState,
             'Alexa.Authorization' : self.handleAcceptGrant,
             'Alexa.Discovery' : self.handleDiscovery,
-        }.get(request.namespace, self.handleDirective)(request)
+        }
+
+    def _route(self, request):
+        return self._handlers.get(request.namespace, self.handleDirective)(request)
 
-        print ('lambda_handler response is '+json.dumps(response))
+    def _cachedResponse(self, request):
+        ''' Returns the response already sent for request if it is a redelivered directive '''
+        if self.responseCache is None or request.namespace in self._handlers:
+            return None
+        response = self.responseCache.get(request)
+        if response is not None:
+            log.event(logger, logging.INFO, 'redelivery', messageId=request.messageId, directive='{0}.{1}'.format(request.namespace, request.name))
+        return response
+
+    def _cacheResponse(self, request, response):
+        if self.responseCache is not None and request.namespace not in self._handlers:
+            self.responseCache.set(request, response)
+
+    def lambda_handler(self, request, context=None):
+        """ Routes the Alexa Smart Home request to the appropriate handler """
+        request = Request(request)
+        self._logRequest(request)
+        with instrumentation.trace('{0}.{1}'.format(request.namespace, request.name)):
+            response = self._cachedResponse(request)
+            if response is None:
+                response = self._route(request)
+                self._cacheResponse(request, response)
+
+            with instrumentation.span('serialize'):
+                log.payload(logger, 'lambda_handler response is', response)
+        return response
+
+    @staticmethod
+    def _logRequest(request):
+        if not logger.isEnabledFor(logging.INFO): return
+        log.event(logger, logging.INFO, 'request', namespace=request.namespace, name=request.name, messageId=getattr(request, 'messageId', None), endpointId=getattr(request, 'endpointId', None))
+        log.payload(logger, 'request is', request.raw)
+
+    async def async_lambda_handler(self, request, context=None):
+        """ Routes the Alexa Smart Home request to the appropriate awaitable handler
+
+        Use this instead of lambda_handler when pyASH is being run from an asyncio event loop.  Blocking I/O is performed on a thread pool (see pyASH.aio) so that independent calls can overlap.
+        """
+        request = Request(request)
+        self._logRequest(request)
+        with instrumentation.trace('{0}.{1}'.format(request.namespace, request.name)):
+            response = self._cachedResponse(request)
+            if response is None:
+                response = await {
+                    'Alexa' : self.asyncHandleReportState,
+                    'Alexa.Authorization' : self.asyncHandleAcceptGrant,
+                    'Alexa.Discovery' : self.asyncHandleDiscovery,
+                }.get(request.namespace, self.asyncHandleDirective)(request)
+                self._cacheResponse(request, response)
+
+            with instrumentation.span('serialize'):
+                log.payload(logger, 'async_lambda_handler response is', response)
         return response
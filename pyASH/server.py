@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""HTTP server for running a pyASH lambda_handler outside of Lambda (e.g. on premises behind a reverse proxy)
+
+The server accepts a directive as the JSON body of a POST (to any path) and responds with the JSON returned by the handler.  The handler is any callable with the same signature as a Lambda handler (handler(request, context)) so an existing Lambda module can be served unchanged::
+
+    python -m pyASH.server cloudLightLambda:lambda_handler --port 8080 --workers 8
+
+Requests are handled on a pool of long lived workers, either threads (the default) or processes (--processes).  State that pyASH keeps at module level (pooled boto3 clients, compiled dispatch tables, discovery and token caches) is built once per worker process and reused by every request it handles.  When using processes each worker imports the handler from its 'module:function' name so the handler does not need to be picklable (e.g. it can be the closure returned by pyASH.warm.lambdaHandler).
+
+Threads share everything the handler keeps at module level.  User, Endpoint and Iot objects are not thread-safe so a handler that creates its User (and pyASH object) once, at module level, would have concurrent requests share its endpoints and their Endpoint.session.  Serve such a handler with --processes (each worker process handles one request at a time), create the user for each request or use pyASH.warm.lambdaHandler which only lets one request at a time use each user's objects.
+
+GET /metrics returns the number of requests handled, their throughput and a histogram of their latency.  GET /health returns 200 while the server is running.
+"""
+
+import argparse
+import bisect
+import importlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# pyASH imports
+from .utility import LOGLEVEL
+from . import clients
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+MAX_WORKERS = int(os.environ.get('PYASH_SERVER_WORKERS', 10))
+MAX_BODY = 1024 * 1024
+REQUEST_TIMEOUT = 8
+
+# Upper bounds (in milliseconds) of the latency histogram's buckets.  The last bucket holds everything slower.
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Metrics(object):
+    ''' Thread-safe counts and latencies of the requests a server has handled
+
+    Args:
+        window (int): Number of seconds over which the recent throughput is measured
+    '''
+    def __init__(self, window=60, buckets=LATENCY_BUCKETS):
+        self.window = window
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.totalLatency = 0
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.directives = {}
+        self.recent = deque()
+
+    def record(self, name, elapsed, error=False):
+        ''' Records a request for the directive name that took elapsed seconds '''
+        ms = elapsed * 1000
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.totalLatency += ms
+            self.histogram[bisect.bisect_left(self.buckets, ms)] += 1
+            counts = self.directives.get(name)
+            if counts is None:
+                counts = self.directives[name] = { 'count': 0, 'errors': 0, 'ms': 0 }
+            counts['count'] += 1
+            counts['ms'] += ms
+            if error:
+                self.errors += 1
+                counts['errors'] += 1
+            self.recent.append(now)
+            self._expire(now)
+
+    def _expire(self, now):
+        while self.recent and self.recent[0] < now - self.window:
+            self.recent.popleft()
+
+    def asDict(self):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            uptime = now - self.started
+            histogram = { str(bound): count for bound, count in zip(self.buckets, self.histogram) }
+            histogram['+Inf'] = self.histogram[-1]
+            return {
+                'uptime': round(uptime, 3),
+                'requests': self.requests,
+                'errors': self.errors,
+                'throughput': {
+                    'overall': round(self.requests / uptime, 3) if uptime else 0,
+                    'recent': round(len(self.recent) / min(self.window, uptime), 3) if uptime else 0,
+                    'window': self.window
+                },
+                'latency': {
+                    'mean': round(self.totalLatency / self.requests, 3) if self.requests else 0,
+                    'histogram': histogram
+                },
+                'directives': { name: { 'count': c['count'], 'errors': c['errors'], 'ms': round(c['ms'] / c['count'], 3) } for name, c in self.directives.items() }
+            }
+
+# The handler used by each worker process.  It is imported once, when the process starts, by _initWorker.
+_workerHandler = None
+
+def _initWorker(spec):
+    global _workerHandler
+    _workerHandler = loadHandler(spec)
+    clients.warm()
+
+def _invokeWorker(request):
+    return _workerHandler(request, None)
+
+def _directiveName(request):
+    try:
+        header = request['directive']['header']
+        return '{0}.{1}'.format(header['namespace'], header['name'])
+    except (KeyError, TypeError):
+        return 'unknown'
+
+class Server(object):
+    ''' Serves handler over HTTP
+
+    Args:
+        handler (callable or str): Called as handler(request, context) for each directive.  context is None.  May be given as 'module:function'.  When processes is True a callable must be importable by name (see handlerSpec).
+        host (str): Address to listen on
+        port (int): Port to listen on.  0 picks a free port (see address).
+        workers (int): Number of requests that are handled at the same time
+        processes (bool): Handle requests in worker processes instead of threads.  Use processes for a handler that shares User or Endpoint objects between requests (see the module documentation).
+        timeout (float): Number of seconds to wait for the handler before responding with an error
+        startMethod (str): The multiprocessing start method ('fork', 'spawn' or 'forkserver') used for worker processes.  Defaults to the platform's default.
+    '''
+    def __init__(self, handler, host='127.0.0.1', port=8080, workers=MAX_WORKERS, processes=False, timeout=REQUEST_TIMEOUT, startMethod=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.metrics = Metrics()
+        if processes:
+            self.handler = None
+            context = multiprocessing.get_context(startMethod) if startMethod else None
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_initWorker, initargs=(handlerSpec(handler),))
+        else:
+            self.handler = loadHandler(handler) if isinstance(handler, str) else handler
+            clients.warm()
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.pyASHServer = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def submit(self, request):
+        if self.processes:
+            return self.executor.submit(_invokeWorker, request)
+        return self.executor.submit(self.handler, request, None)
+
+    def handle(self, request):
+        ''' Runs the handler for request on the worker pool and records its metrics.  Returns (status, response). '''
+        name = _directiveName(request)
+        start = time.perf_counter()
+        try:
+            response = self.submit(request).result(timeout=self.timeout)
+            status = 200
+        except TimeoutError:
+            logger.warning('%s did not finish within %s seconds', name, self.timeout)
+            (status, response) = (504, { 'error': 'timeout' })
+        except Exception:
+            # The exception is logged rather than returned as its text may contain tokens or other internal details
+            logger.exception('%s failed', name)
+            (status, response) = (500, { 'error': 'internal error' })
+        self.metrics.record(name, time.perf_counter() - start, error=(status != 200))
+        return (status, response)
+
+    def serve_forever(self):
+        logger.info('Serving on %s:%s', *self.address[:2])
+        self.httpd.serve_forever()
+
+    def start(self):
+        ''' Serves requests on a background thread '''
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.executor.shutdown(wait=True)
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/metrics':
+            self._send(200, self.server.pyASHServer.metrics.asDict())
+        elif path == '/health':
+            self._send(200, { 'status': 'ok' })
+        else:
+            self._send(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self.close_connection = True
+            return self._send(413, { 'error': 'request too large' })
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            return self._send(400, { 'error': 'invalid JSON: {0}'.format(e) })
+        self._send(*self.server.pyASHServer.handle(request))
+
+    def log_message(self, format, *args):
+        logger.debug('%s - ' + format, self.address_string(), *args)
+
+def loadHandler(spec):
+    ''' Returns the callable named by spec ('module:attribute') '''
+    (module, _, attribute) = spec.partition(':')
+    return getattr(importlib.import_module(module), attribute or 'lambda_handler')
+
+def handlerSpec(handler):
+    ''' Returns the 'module:attribute' name that loadHandler can import handler from
+
+    Raises ValueError if handler is a callable that cannot be imported by name (e.g. a closure such as the one returned by pyASH.warm.lambdaHandler).  Pass the name of the module level variable that holds it instead.
+    '''
+    if isinstance(handler, str):
+        return handler
+    spec = '{0}:{1}'.format(getattr(handler, '__module__', None), getattr(handler, '__qualname__', None))
+    try:
+        if loadHandler(spec) is handler:
+            return spec
+    except (ImportError, AttributeError, ValueError):
+        pass
+    raise ValueError("{0!r} cannot be imported by worker processes.  Pass it as 'module:function'.".format(handler))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve a pyASH lambda handler over HTTP')
+    parser.add_argument('handler', help='the handler to serve as module:function (function defaults to lambda_handler)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--processes', action='store_true', help='handle requests in worker processes instead of threads')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT)
+    args = parser.parse_args(args)
+
+    server = Server(args.handler, host=args.host, port=args.port, workers=args.workers, processes=args.processes, timeout=args.timeout)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
@@ -7,6 +7,8 @@ import json
 import time
 import re
 import pickle
+import copy
+import hashlib
 import boto3
 from botocore.vendored import requests
 from decimal import Decimal
@@ -14,8 +16,12 @@ from decimal import Decimal
 
 # pyASH imports
 from .db import Persist
+from .cache import LRUCache
+from . import instrumentation
 from .endpoint import Endpoint
-from .exceptions import NO_SUCH_ENDPOINT, USER_NOT_FOUND_EXCEPTION, MISCELLANIOUS_EXCEPTION
+from .iot import bulkGet
+from . import exceptions
+from .exceptions import pyASH_EXCEPTION, NO_SUCH_ENDPOINT, USER_NOT_FOUND_EXCEPTION, MISCELLANIOUS_EXCEPTION
 from .utility import LOGLEVEL, DEFAULT_SYSTEM_NAME, DEFAULT_REGION, DEFAULT_IOTREGION, getAccessTokenFromCode, getUserProfile
 
 # Setup logger
@@ -23,6 +29,102 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(LOGLEVEL)
 
+class TokenCache(object):
+    ''' Process wide cache that maps an access token to the user it belongs to
+
+    Resolving a token requires a call to the Amazon profile service followed by a DynamoDB lookup of the user's uuid.  Caching the result lets warm Lambda invocations skip both.  Tokens that the profile service rejects are also cached (for negativeTtl seconds) so that a client retrying with a bad token does not cause repeated lookups.
+
+    Tokens are hashed before being used as keys so that they are not stored in clear text when a PersistCache is used as the backend.
+
+    Args:
+        backend (LRUCache or PersistCache): Where entries are stored.  Defaults to an in memory LRUCache.
+        ttl (float): Maximum number of seconds a resolved token is cached for.  Entries never outlive the token's own expiration if it is known.
+        negativeTtl (float): Number of seconds a token that failed to resolve is cached for
+        unknownExpiryTtl (float): Number of seconds a resolved token whose expiration is not known is cached for.  This bounds how long a revoked or expired token continues to resolve.
+    '''
+    def __init__(self, backend=None, ttl=300, negativeTtl=30, unknownExpiryTtl=60):
+        self.backend = backend if backend is not None else LRUCache(maxsize=1024)
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.unknownExpiryTtl = unknownExpiryTtl
+
+    @staticmethod
+    def _key(token):
+        return 'token:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        ''' Returns a dictionary containing userId, uuid and profile for the token or None if the token is not cached
+
+        Raises the original exception if the token is negatively cached
+        '''
+        entry = self.backend.get(self._key(token))
+        if entry and 'error' in entry:
+            raise getattr(exceptions, entry['error'], pyASH_EXCEPTION)(entry['message'])
+        return entry
+
+    def set(self, token, userId, uuid, profile, expires=None):
+        ''' Caches the user for token.  If expires (seconds since the epoch) is provided the entry will not outlive it, otherwise it is only kept for unknownExpiryTtl seconds '''
+        ttl = min(self.ttl, self.unknownExpiryTtl) if expires is None else min(self.ttl, expires - time.time())
+        if ttl > 0:
+            self.backend.set(self._key(token), { 'userId': userId, 'uuid': uuid, 'profile': profile, 'expires': expires }, ttl)
+
+    def setInvalid(self, token, e):
+        self.backend.set(self._key(token), { 'error': type(e).__name__, 'message': e.args[0] if e.args else '' }, self.negativeTtl)
+
+    def delete(self, token):
+        self.backend.delete(self._key(token))
+
+    @property
+    def stats(self):
+        return self.backend.stats
+
+# Shared by all DbUser objects in the process so that it survives across warm Lambda invocations
+defaultTokenCache = TokenCache()
+
+# Responses from the profile service that mean the token itself is not valid
+INVALID_TOKEN_STATUS = (400, 401, 403)
+
+def _capabilityFingerprint(classes):
+    ''' Returns a hash of the capabilities of each of the Endpoint classes in classes which changes whenever any of them change '''
+    capabilities = [ (cls.__name__, cls._capabilities()) for cls in classes or [] if isinstance(cls, type) and issubclass(cls, Endpoint) ]
+    capabilities.sort(key=lambda item: item[0])
+    return hashlib.sha256(json.dumps(capabilities, sort_keys=True).encode('utf-8')).hexdigest()
+
+class DiscoveryCache(object):
+    ''' Process wide cache of the discovery objects for each user's endpoints
+
+    Entries are keyed by the user's uuid, a hash of the user's persisted endpoint records and a fingerprint of the endpoint classes' capabilities so an entry is no longer used as soon as the user's endpoints (or the classes that describe them) change.  Entries are copied when they are stored and when they are returned so a caller cannot change a cached entry.
+
+    Args:
+        backend (LRUCache or PersistCache): Where entries are stored.  Defaults to an in memory LRUCache.  Use a PersistCache to share precomputed discovery responses between Lambda containers.
+        ttl (float): Number of seconds an entry is cached for.  None means entries are kept until they are evicted.
+    '''
+    def __init__(self, backend=None, ttl=None):
+        self.backend = backend if backend is not None else LRUCache(maxsize=256)
+        self.ttl = ttl
+
+    @staticmethod
+    def key(uuid, endpointsVersion, classes):
+        return 'discovery:{0}:{1}:{2}'.format(uuid, endpointsVersion, _capabilityFingerprint(classes))
+
+    def get(self, key):
+        ''' Returns (a copy of) the discovery objects cached under key or None '''
+        discovery = self.backend.get(key)
+        return copy.deepcopy(discovery) if discovery is not None else None
+
+    def set(self, key, discovery):
+        # A copy is stored so that later changes to discovery by the caller do not change the cached entry
+        self.backend.set(key, copy.deepcopy(discovery), self.ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    @property
+    def stats(self):
+        return self.backend.stats
+
+defaultDiscoveryCache = DiscoveryCache()
+
 class User(ABC):
 
     def __init__(self):
@@ -36,6 +138,18 @@ class User(ABC):
     def getEndpoint(self, request):
         pass
 
+    def getDiscovery(self, request):
+        ''' Returns the discovery object for each of the user's endpoints '''
+        return [ ep.jsonDiscover for ep in self.getEndpoints(request) ]
+
+    def getThingStates(self, request, maxWorkers=None):
+        ''' Retrieves the shadow of every thing controlled by the user's endpoints concurrently and returns a BulkGet (see iot.bulkGet) '''
+        things = {}
+        for endpoint in self.getEndpoints(request):
+            for thing in endpoint.things:
+                things.setdefault(thing.name, thing)
+        return bulkGet(things.values(), maxWorkers=maxWorkers)
+
     def getTokens(self, request):
         response = getAccessTokenFromCode(request['payload']['grant']['code'])
         self.storeTokens(response['access_token'], response['refresh_token'], response['expires_in'])
@@ -63,10 +177,23 @@ class User(ABC):
 class StaticUser(User):
     def __init__(self):
         super(StaticUser, self).__init__()
+        self.discovery = None
 
     def getEndpoints(self, request):
         return self.endpoints.values()
 
+    def getDiscovery(self, request):
+        ''' Returns the discovery objects for the user's endpoints, computing them only when an endpoint is added or an endpoint class changes '''
+        fingerprint = _capabilityFingerprint(set([ type(ep) for ep in self.endpoints.values() ]))
+        if self.discovery is None or self.discovery[0] != fingerprint:
+            self.discovery = (fingerprint, super(StaticUser, self).getDiscovery(request))
+        # Callers receive a copy so that changes to a response cannot reach later ones
+        return copy.deepcopy(self.discovery[1])
+
+    def _persistEndpoints(self):
+        # Called by addEndpoint.  The discovery objects must be recomputed.
+        self.discovery = None
+
     def getEndpoint(self, request):
         try:
             return self.endpoints[request.endpointId]
@@ -75,7 +202,8 @@ class StaticUser(User):
 
     def storeTokens(self, access, refresh, expires_in):
         self._storeTokens(access, refresh, expires_in)
-        print ('ACCESSGRANT Refresh[{0}], Access[{1}], Expires_In [{2}]'.format(access,refresh,expires_in))
+        # The tokens themselves are never logged
+        logger.info('ACCESSGRANT stored tokens which expire in %s seconds', expires_in)
 
 class DemoUser(StaticUser):
     def getTokens(self, request):
@@ -87,13 +215,20 @@ class DemoUser(StaticUser):
         self.storeTokens(response['access_token'], response['refresh_token'], response['expires_in'])
 
 class DbUser(User):
-    def __init__(self, userEmail=None, userId=None, token=None, region='us-east-1', systemName = 'pyASH', classes=None):
+    def __init__(self, userEmail=None, userId=None, token=None, region='us-east-1', systemName = 'pyASH', classes=None, tokenCache=None, discoveryCache=None):
         super(DbUser, self).__init__()
 
         self.region = region
         self.systemName = systemName
         self.uuid = None
+        self.accessToken = None
         self.classes = classes
+        self.endpointRecords = {}
+        self.tokenCache = tokenCache if tokenCache is not None else defaultTokenCache
+        self.discoveryCache = discoveryCache if discoveryCache is not None else defaultDiscoveryCache
+        self.endpointsVersion = None
+        # When the access token expires (in seconds since the epoch) if it is known
+        self.tokenExpires = None
 
         if userId or userEmail or token:
             self._getUser(userId=userId, userEmail=userEmail, token=token)
@@ -102,15 +237,30 @@ class DbUser(User):
                 raise USER_NOT_FOUND_EXCEPTION('Could not find {0}'.format(un))
 
     def getEndpoints(self, request):
-        self._getUser(token=request.token)
-        self._retrieveEndpoints()
+        self._ensureUser(request)
+        for endpointId in self.endpointRecords:
+            self._materializeEndpoint(endpointId)
         return self.endpoints.values()
 
+    def getDiscovery(self, request):
+        ''' Returns the discovery objects for the user's endpoints from discoveryCache, computing them only if the user's endpoints have changed since they were cached '''
+        if not self._ensureUser(request):
+            # The user was loaded by an earlier request.  Their endpoints may have been changed since (e.g. by another container).
+            self._refreshEndpoints()
+        key = self.discoveryCache.key(self.uuid, self.endpointsVersion, self.classes)
+        discovery = self.discoveryCache.get(key)
+        if discovery is None:
+            discovery = super(DbUser, self).getDiscovery(request)
+            self.discoveryCache.set(key, discovery)
+        return discovery
+
     def getEndpoint(self, request):
-        self._getUser(token=request.token)
-        self._retrieveEndpoints()
+        loaded = self._ensureUser(request)
+        if request.endpointId not in self.endpointRecords and not loaded:
+            # The endpoint may have been added since the user was loaded by an earlier request
+            self._refreshEndpoints()
         try:
-            return self.endpoints[request.endpointId]
+            return self._materializeEndpoint(request.endpointId)
         except KeyError:
             raise NO_SUCH_ENDPOINT('{0} is not a valid endpoint'.format(request.endpointId))
 
@@ -120,6 +270,29 @@ class DbUser(User):
         self._persistTokens()
         dbUUIDuserid = UUIDuserid(self.userId)
         dbUUIDuserid['uuid'] = self.uuid
+        self.tokenExpires = self.accessTokenTimestamp + self.accessTokenExpires
+        self.tokenCache.set(access, self.userId, self.uuid, self._profile, self.tokenExpires)
+
+    def _ensureUser(self, request):
+        ''' Loads the user (and their endpoints) for the request's token unless they were already loaded for that token.  Returns True if the user was loaded.
+
+        A user that is reused (e.g. by pyASH.warm) has its token checked again through tokenCache so that a token stops working once it expires or is revoked.  This only costs a lookup of the profile service once tokenCache no longer holds the token.
+        '''
+        if self.uuid and request.token == self.accessToken:
+            uuid = self.uuid
+            self._getUserProfileFromToken()
+            if self.uuid == uuid:
+                return False
+            self._retrieveEndpoints()
+            return True
+        self._getUser(token=request.token)
+        return True
+
+    def _refreshEndpoints(self):
+        ''' Reloads the user's endpoints if their stored records have changed since they were retrieved '''
+        endpointList = DBEndpoints(self.uuid)['endpoints']
+        if self._endpointsHash(endpointList or []) != self.endpointsVersion:
+            self._retrieveEndpoints(endpointList)
 
     def _getUser(self, token=None, userId=None, userEmail=None):
         self.userId = userId
@@ -132,6 +305,8 @@ class DbUser(User):
         self.accessGrantCode = None
         self.refreshToken = None
         self.ddb = None
+        self.uuid = None
+        self.tokenExpires = None
 
         if not token and not userId and not userEmail:
             errmsg = 'Cannot initialize a user without an access token, an email address or a userId'
@@ -161,12 +336,34 @@ class DbUser(User):
         msg = 'No user with UserId of {0}'.format(self.userId) if self.userId else 'No user with Email address of {0}'.format(self.userEmail) if self.userEmail else 'No ability to retrieve user.  Neither userId nor userEmail provided'
         raise USER_NOT_FOUND_EXCEPTION(msg)
 
+    @property
+    def _profile(self):
+        return { 'user_id': self.userId, 'name': self.userName, 'email': self.userEmail }
+
     def _getUserProfileFromToken(self):
-        response = getUserProfile(self.accessToken)
-        self.userId = response['user_id']
-        self.userName = response['name']
-        self.userEmail = response['email']
-        self._getUserUUID()
+        cached = self.tokenCache.get(self.accessToken)
+        if cached:
+            self.userId = cached['profile']['user_id']
+            self.userName = cached['profile']['name']
+            self.userEmail = cached['profile']['email']
+            self.uuid = cached['uuid']
+            self.tokenExpires = cached.get('expires')
+            return
+
+        try:
+            with instrumentation.span('getUserProfile'):
+                response = getUserProfile(self.accessToken)
+            self.userId = response['user_id']
+            self.userName = response['name']
+            self.userEmail = response['email']
+            self._getUserUUID()
+        except pyASH_EXCEPTION as e:
+            # Only a token the profile service rejected is remembered.  Server errors (and users that are not stored yet) may succeed when tried again.
+            if getattr(e, 'statusCode', None) in INVALID_TOKEN_STATUS:
+                self.tokenCache.setInvalid(self.accessToken, e)
+            raise
+        # The profile service does not report when the token expires so the entry is kept briefly.  storeTokens replaces it with one bounded by the token's expiration.
+        self.tokenCache.set(self.accessToken, self.userId, self.uuid, self._profile)
 
     def _getUserProfileFromDb(self):
         dbTokens = DBTokens(self.userId)
@@ -189,7 +386,7 @@ class DbUser(User):
         if not uuid:
             uuid = get_uuid()
             dbUUIDemail['uuid'] = uuid
-        print ('creating user {0} with uuid {1}'.format(email, uuid))
+        logger.info('creating user %s with uuid %s', email, uuid)
         self._getUser(userEmail=email)
 
     def removeUser(self, user):
@@ -245,28 +442,56 @@ class DbUser(User):
     def _persistEndpoints(self):
         dbEndpoints = DBEndpoints(self.uuid)
         endpointList = []
+        # Endpoints that were never materialized are written back exactly as they were retrieved
+        for endpointId, (epJson, item) in self.endpointRecords.items():
+            if endpointId not in self.endpoints:
+                endpointList.append(epJson)
         for item in self.endpoints.values():
             endpointList.append(item.json)
         dbEndpoints['endpoints'] = endpointList
 
-    def _retrieveEndpoints(self):
+        # The cached discovery objects no longer describe the user's endpoints
+        if self.endpointsVersion is not None:
+            self.discoveryCache.delete(self.discoveryCache.key(self.uuid, self.endpointsVersion, self.classes))
+        self.endpointsVersion = self._endpointsHash(endpointList)
+
+    def _retrieveEndpoints(self, endpointList=None):
+        ''' Loads the user's endpoints (or, if provided, the endpoint records in endpointList) as lightweight records indexed by endpointId
+
+        Endpoint objects are only constructed (by _materializeEndpoint) when they are actually needed so that a directive only touches the endpoint it is addressed to.
+        '''
         self.endpoints = {}
-        dbEndpoints = DBEndpoints(self.uuid)
-        endpointList = dbEndpoints['endpoints']
+        self.endpointRecords = {}
+        if endpointList is None:
+            endpointList = DBEndpoints(self.uuid)['endpoints']
+        self.endpointsVersion = self._endpointsHash(endpointList or [])
         if endpointList:
             for epJson in endpointList:
                 item = json.loads(epJson)
-                print (item['__classname__'])
-                for clsinstance in self.classes:
-                    print ('Checking '+clsinstance.__name__)
-                    if item['__classname__'] == clsinstance.__name__:
-                        print ('Matched '+clsinstance.__name__)
-                        endpointClass = clsinstance
-                        break
+                if item.get('endpointId'):
+                    self.endpointRecords[item['endpointId']] = (epJson, item)
                 else:
-                    raise Exception('No endpoint class found to handle retrieved endpoint')
-                endpoint = endpointClass(json=item, iotClasses = self.classes)
-                self.endpoints[endpoint.endpointId] = endpoint
+                    # Records written before the endpointId was persisted must be constructed to learn their endpointId (Endpoint subclasses may override it).  As the endpoint is then materialized its record is rewritten, with the endpointId, by the next _persistEndpoints.
+                    endpoint = self._constructEndpoint(item)
+                    self.endpointRecords[endpoint.endpointId] = (epJson, item)
+                    self.endpoints[endpoint.endpointId] = endpoint
+
+    @staticmethod
+    def _endpointsHash(endpointList):
+        return hashlib.sha256('\n'.join(endpointList).encode('utf-8')).hexdigest()
+
+    def _constructEndpoint(self, item):
+        for clsinstance in self.classes:
+            if item['__classname__'] == clsinstance.__name__:
+                return clsinstance(json=item, iotClasses = self.classes)
+        raise Exception('No endpoint class found to handle retrieved endpoint')
+
+    def _materializeEndpoint(self, endpointId):
+        ''' Returns the Endpoint object for endpointId, constructing it from its record if needed.  Raises KeyError if the user has no such endpoint '''
+        if endpointId not in self.endpoints:
+            (epJson, item) = self.endpointRecords[endpointId]
+            self.endpoints[endpointId] = self._constructEndpoint(item)
+        return self.endpoints[endpointId]
 
 class DBEndpoints(Persist):
     def __init__(self, uuid='', systemName=DEFAULT_SYSTEM_NAME, region=DEFAULT_REGION):
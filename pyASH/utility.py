@@ -109,6 +109,13 @@ for item in VALID_PROPERTIES:
     VALID_INTERFACES.append(item)
 del (item)
 
+# The interfaces that each property belongs to
+INTERFACES_BY_PROPERTY = {}
+for (item, names) in VALID_PROPERTIES.items():
+    for name in names:
+        INTERFACES_BY_PROPERTY[name] = INTERFACES_BY_PROPERTY.get(name, frozenset()) | frozenset([item])
+del (item, names, name)
+
 VALID_COOKINGMODES = [ 'DEFROST', 'OFF', 'PRESET', 'REHEAT', 'TIMECOOK']
 VALID_CONNECTIVITY = ['OK', 'UNREACHABLE']
 VALID_ENUMERATEDPOWERLEVELS = ['LOW','MED_LOW', 'MEDIUM', 'MED_HIGH', 'HIGH']
@@ -246,6 +253,12 @@ def fix_term(term):
 
 
 # Oauth2 utilities
+def _oauth2Exception(response, error_description):
+    # The status code lets callers tell a rejected token from a failure of the service
+    e = OAUTH2_EXCEPTION(error_description)
+    e.statusCode = response.status_code
+    return e
+
 def validateReturnCode(response):
     error = response.json().get('error')
     error_description = response.json().get('error_description')
@@ -254,9 +267,9 @@ def validateReturnCode(response):
         if error == 'invalid_grant':
             EXPIRED_AUTHORIZATION_CREDENTIAL(error_description)
         else:
-            raise OAUTH2_EXCEPTION(error_description)
+            raise _oauth2Exception(response, error_description)
     elif response.status_code != 200:
-        raise OAUTH2_EXCEPTION(error_description)
+        raise _oauth2Exception(response, error_description)
     return response.status_code
 
 def validateValue(value, validList, errmsg=None):
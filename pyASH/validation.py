@@ -23,18 +23,70 @@ of the JSON Schema Draft 4 to perform the actual validation against the validati
 
 """
 
+import itertools
 import json
 import os
+import threading
 
-from jsonschema import validate
+from jsonschema import Draft4Validator
 
-def validate_message(request, response):
+# update below with path to your validation schema
+# this path works if you copy the latest validation schema into the same directory as this file
+# validation schema: https://github.com/alexa/alexa-smarthome/wiki/Validation-Schema
+path_to_validation_schema = os.path.dirname(__file__)+"/alexa_smart_home_message_schema.json"
 
-    # update below with path to your validation schema
-    # this path works if you copy the latest validation schema into the same directory as this file
-    # validation schema: https://github.com/alexa/alexa-smarthome/wiki/Validation-Schema
-    path_to_validation_schema = os.path.dirname(__file__)+"/alexa_smart_home_message_schema.json"
+# Validate 1 in SAMPLE_RATE messages.  Set to 1 (the default) to validate every message.
+SAMPLE_RATE = int(os.environ.get('PYASH_VALIDATION_SAMPLE_RATE', 1))
 
+_lock = threading.Lock()
+_validators = None
+_messageCount = itertools.count()
+
+def _compileValidators():
+    """Loads and checks the schema once and builds a validator for it and for each of its message types.
+
+    The top level of the schema is a oneOf with one branch per message type.  Each branch is compiled into
+    its own validator (sharing the schema's definitions) and indexed by the header names that branch
+    accepts so that a message can be checked against its own branch only.
+    """
     with open(path_to_validation_schema) as json_file:
         schema = json.load(json_file)
-    validate(response, schema)
+    Draft4Validator.check_schema(schema)
+
+    byName = {}
+    for branch in schema['oneOf']:
+        subschema = dict(branch)
+        subschema['$schema'] = schema['$schema']
+        subschema['definitions'] = schema['definitions']
+        validator = Draft4Validator(subschema)
+        text = json.dumps(branch)
+        for key, definition in schema['definitions'].items():
+            if '#/definitions/'+key+'/' in text and 'name' in definition:
+                for name in definition['name']['enum']:
+                    byName[name] = validator
+    return (Draft4Validator(schema), byName)
+
+def get_validator(response=None):
+    """Returns the validator for the message type of response (or for the whole schema if the type cannot be determined)"""
+    global _validators
+    if _validators is None:
+        with _lock:
+            if _validators is None:
+                _validators = _compileValidators()
+    (validator, byName) = _validators
+    try:
+        return byName.get(response['event']['header']['name'], validator)
+    except (KeyError, TypeError):
+        return validator
+
+def validate_message(request, response, sample_rate=None):
+    """Validates response against the Alexa Smart Home message schema.
+
+    Raises jsonschema.ValidationError if the response is not valid.  If sample_rate (or the module's SAMPLE_RATE)
+    is greater than 1 only 1 in that many messages is actually validated.  Returns True if the message was validated.
+    """
+    sample_rate = sample_rate if sample_rate is not None else SAMPLE_RATE
+    if sample_rate > 1 and next(_messageCount) % sample_rate:
+        return False
+    get_validator(response).validate(response)
+    return True
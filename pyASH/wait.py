@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+
+# pyASH imports
+from .utility import LOGLEVEL
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+class WaitStrategy(ABC):
+    ''' Determines how an Iot object waits for a thing to finish applying the changes that were sent to its shadow
+
+    A strategy is shared by every Iot object that uses it so it must not hold per-thing state.  Everything it needs is available from the Iot object passed to wait:
+
+        **pendingState** (*dict*): The desired state that has been sent to the shadow but not yet confirmed
+        **lastPutVersion** (*int*): The shadow version returned when the desired state was last updated
+        **waitPolls** (*int*): Count of shadow reads made while waiting.  Strategies increment it on each poll.
+    '''
+
+    @abstractmethod
+    def wait(self, iot, timeout):
+        ''' Returns True if the thing finished updating within timeout seconds, False if not '''
+        pass
+
+    @staticmethod
+    def isComplete(iot, shadow):
+        ''' Returns True if shadow shows that every pending change has been applied by the thing '''
+        version = shadow.get('version')
+        if iot.lastPutVersion is not None and version is not None and version < iot.lastPutVersion:
+            # The shadow we read predates our own update
+            return False
+        delta = shadow.get('state', {}).get('delta', {})
+        if not iot.pendingState:
+            return not delta
+        return not any([ variable in delta for variable in iot.pendingState ])
+
+class BackoffWait(WaitStrategy):
+    ''' Polls the shadow using exponential backoff with jitter
+
+    Args:
+        initialDelay (float): Seconds to wait before the second poll
+        maxDelay (float): Upper bound on the delay between polls
+        factor (float): Multiplier applied to the delay after each poll
+        jitter (float): Fraction of the delay to randomly add or remove so that many waiting Lambdas do not poll in lockstep
+    '''
+    def __init__(self, initialDelay=.05, maxDelay=1, factor=2, jitter=.5):
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.jitter = jitter
+
+    def wait(self, iot, timeout):
+        expires = time.time() + timeout
+        delay = self.initialDelay
+        while True:
+            shadow = iot.get()
+            iot.waitPolls += 1
+            if self.isComplete(iot, shadow):
+                return True
+            remaining = expires - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining, delay * (1 + random.uniform(-self.jitter, self.jitter))))
+            delay = min(delay * self.factor, self.maxDelay)
+
+class VersionWait(BackoffWait):
+    ''' Polls with exponential backoff but only when there is something to wait for
+
+    If nothing has been written to the shadow since the last confirmed update there is nothing for the thing to apply so wait returns immediately without reading the shadow.  Otherwise the shadow is polled until it is at least as new as the version returned by the update and none of the written values remain in the delta.
+    '''
+    def wait(self, iot, timeout):
+        if not iot.pendingState:
+            return True
+        return super(VersionWait, self).wait(iot, timeout)
+
+class ShadowMessageBus(object):
+    ''' A minimal stand-in for the MQTT shadow topics
+
+    Connect the on_message callback of a real MQTT client to publish (passing the decoded JSON document) and SubscriptionWait will be notified of shadow updates instead of polling.  The last message published on each topic is retained so that a waiter that subscribes after the thing has already responded is not left waiting.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.retained = {}
+
+    @staticmethod
+    def topic(thingName, suffix):
+        return '$aws/things/{0}/shadow/{1}'.format(thingName, suffix)
+
+    def subscribe(self, topic, callback):
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append(callback)
+            return self.retained.get(topic)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            if callback in self.subscribers.get(topic, []):
+                self.subscribers[topic].remove(callback)
+
+    def publish(self, topic, message):
+        with self.lock:
+            self.retained[topic] = message
+            callbacks = list(self.subscribers.get(topic, []))
+        for callback in callbacks:
+            callback(topic, message)
+
+shadowMessages = ShadowMessageBus()
+
+class SubscriptionWait(WaitStrategy):
+    ''' Waits for update/documents or update/accepted messages from a ShadowMessageBus instead of polling the shadow
+
+    Args:
+        bus (ShadowMessageBus): The bus to listen on.  Defaults to the module level shadowMessages bus
+    '''
+    def __init__(self, bus=None):
+        self.bus = bus if bus is not None else shadowMessages
+
+    @staticmethod
+    def _documentFromMessage(topic, message):
+        # update/documents messages hold the full shadow under 'current'.  update/accepted messages are partial documents.
+        if topic.endswith('/update/documents'):
+            return message.get('current', {})
+        return message
+
+    def _isCompleteMessage(self, iot, topic, message):
+        document = self._documentFromMessage(topic, message)
+        version = document.get('version')
+        if iot.lastPutVersion is not None and version is not None and version < iot.lastPutVersion:
+            return False
+        if topic.endswith('/update/documents'):
+            state = document.get('state', {})
+            desired = state.get('desired', {})
+            reported = state.get('reported', {})
+            return all([ variable in reported and reported[variable] == desired.get(variable, reported[variable]) for variable in iot.pendingState ])
+        reported = document.get('state', {}).get('reported', {})
+        return all([ variable in reported for variable in iot.pendingState ])
+
+    def wait(self, iot, timeout):
+        if not iot.pendingState:
+            return True
+
+        finished = threading.Event()
+        def _notify(topic, message):
+            iot.waitPolls += 1
+            if self._isCompleteMessage(iot, topic, message):
+                finished.set()
+
+        topics = [ self.bus.topic(iot.getThingName(), 'update/documents'), self.bus.topic(iot.getThingName(), 'update/accepted') ]
+        try:
+            for topic in topics:
+                retained = self.bus.subscribe(topic, _notify)
+                if retained is not None:
+                    _notify(topic, retained)
+            return finished.wait(timeout)
+        finally:
+            for topic in topics:
+                self.bus.unsubscribe(topic, _notify)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+
+"""Reuse of User and pyASH objects across warm Lambda invocations
+
+Lambda keeps a container's module level state between invocations.  Constructing a DbUser (and a pyASH object for it) at module level in a handler would share one user between every caller so handlers normally build them inside lambda_handler, throwing away the user's profile, endpoint records and materialized Endpoint objects at the end of each invocation.  WarmState keeps them, per access token, so that the next invocation with the same token starts from where the previous one finished::
+
+    from pyASH import warm
+
+    def makeUser(token):
+        return DbUser(token=token, classes=[cloudLight, Iot])
+
+    lambda_handler = warm.lambdaHandler(makeUser)
+
+Entries expire after ttl seconds (or, if it is sooner, when the user's access token expires) and the least recently used entry is discarded once there are more than maxUsers.  Call invalidate (with a token, a user's uuid or nothing to discard everything) after changing a user outside of the cached objects.
+
+A reused DbUser still checks its token through its tokenCache on every request, and compares its endpoint records with the stored ones before answering a discovery request, so a revoked token or an endpoint added by another container does not have to wait for the entry to expire.
+
+The boto3 clients used by those objects are already shared across invocations by pyASH.clients.
+"""
+
+import hashlib
+import threading
+import time
+
+# pyASH imports
+from .cache import LRUCache
+from .objects import Request
+from .pyASH import pyASH
+from . import clients
+from .utility import LOGLEVEL
+
+# Setup logger
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGLEVEL)
+
+
+class _Entry(object):
+    __slots__ = ('user', 'handler', 'lock')
+
+    def __init__(self, user, handler):
+        self.user = user
+        self.handler = handler
+        # User and Endpoint objects are not thread-safe so an entry is only used by one request at a time
+        self.lock = threading.Lock()
+
+class WarmState(object):
+    ''' Process wide store of the User and pyASH objects for recently seen access tokens
+
+    Args:
+        maxUsers (int): Maximum number of users to keep
+        ttl (float): Number of seconds a user is kept after it was created.  None means users are kept until they are evicted, invalidated or their token expires.
+    '''
+    def __init__(self, maxUsers=64, ttl=600):
+        self.entries = LRUCache(maxsize=maxUsers, ttl=ttl)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return 'user:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _entry(self, token, factory):
+        key = self._key(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            # The user is constructed outside of the lock so that a slow lookup does not hold up other users
+            user = factory(token)
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = _Entry(user, pyASH(user))
+                    self.entries.set(key, entry, self._ttl(user))
+        return entry
+
+    def _ttl(self, user):
+        ''' Returns how long user may be kept, which is never past the expiration of its access token '''
+        expires = getattr(user, 'tokenExpires', None)
+        if expires is None:
+            return self.entries.ttl
+        remaining = max(expires - time.time(), 0)
+        return remaining if self.entries.ttl is None else min(remaining, self.entries.ttl)
+
+    def getUser(self, token, factory):
+        ''' Returns the user for token, calling factory(token) to construct it if it is not already held '''
+        return self._entry(token, factory).user
+
+    def getHandler(self, token, factory):
+        ''' Returns the pyASH object for token's user '''
+        return self._entry(token, factory).handler
+
+    def handle(self, request, factory, context=None):
+        ''' Handles request with the pyASH object for the request's token.  Requests without a token are handled by a new user. '''
+        token = getattr(Request(request), 'token', None)
+        if not token:
+            return pyASH(factory(token)).lambda_handler(request, context)
+        entry = self._entry(token, factory)
+        with entry.lock:
+            return entry.handler.lambda_handler(request, context)
+
+    def invalidate(self, token=None, uuid=None):
+        ''' Discards the user for token, every user whose uuid is uuid or (if neither is provided) every user '''
+        if token is not None:
+            self.entries.delete(self._key(token))
+        elif uuid is not None:
+            for key in self.entries.keys():
+                entry = self.entries.get(key)
+                if entry is not None and getattr(entry.user, 'uuid', None) == uuid:
+                    self.entries.delete(key)
+        else:
+            self.entries.clear()
+
+    def clear(self, resetClients=False):
+        ''' Discards every user and, if resetClients is True, every pooled boto3 client '''
+        self.entries.clear()
+        if resetClients:
+            clients.reset()
+
+    @property
+    def stats(self):
+        return self.entries.stats
+
+defaultState = WarmState()
+
+def lambdaHandler(factory, state=None):
+    ''' Returns a Lambda handler that handles each request with a (reused) user constructed by factory(token) '''
+    state = state if state is not None else defaultState
+    def lambda_handler(request, context=None):
+        return state.handle(request, factory, context)
+    return lambda_handler
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+
+from pyASH import envelope
+
+def test_HeaderMatchesStrict():
+    for (namespace, name, correlationToken) in [ ('Alexa', 'Response', 'TOKEN'), ('Alexa', 'ErrorResponse', 'TOKEN'), ('Alexa.Discovery', 'Discover.Response', None), ('Alexa.SceneController', 'ActivationStarted', 'TOKEN') ]:
+        fast = envelope.header(namespace, name, correlationToken=correlationToken, messageId='MESSAGEID')
+        strict = envelope.header(namespace, name, correlationToken=correlationToken, messageId='MESSAGEID', strict=True)
+        assert fast == strict
+
+def test_HeaderTemplateNotShared():
+    h1 = envelope.header('Alexa', 'Response', correlationToken='TOKEN1')
+    h2 = envelope.header('Alexa', 'Response')
+    assert h1['messageId'] != h2['messageId']
+    assert 'correlationToken' not in h2
+
+def test_EndpointMatchesStrict():
+    assert envelope.endpoint('endpoint-001') == envelope.endpoint('endpoint-001', strict=True)
+    assert envelope.endpoint('endpoint-001', token='access-token') == envelope.endpoint('endpoint-001', token='access-token', strict=True)
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+import io
+import json
+import time
+
+from pyASH import clients
+from pyASH.iot import Iot, IotGroup
+from pyASH.cache import ShadowCache, defaultShadowCache
+from pyASH.exceptions import ENDPOINT_UNREACHABLE
+
+class ConflictException(Exception):
+    ''' Stands in for the botocore ClientError raised when an update's version does not match the shadow '''
+    def __init__(self, expected, actual):
+        super(ConflictException, self).__init__('Version conflict: {0} != {1}'.format(expected, actual))
+        self.response = { 'Error': { 'Code': 'ConflictException' } }
+
+class fakeIotData(object):
+    ''' Minimal in memory stand-in for the boto3 iot-data client '''
+    def __init__(self):
+        self.shadows = {}
+        self.calls = []
+
+    def _document(self, thingName):
+        return self.shadows.setdefault(thingName, { 'state': { 'reported': {} }, 'metadata': { 'reported': {} }, 'version': 1 })
+
+    def get_thing_shadow(self, thingName):
+        self.calls.append(('get', thingName))
+        return { 'payload': io.BytesIO(json.dumps(self._document(thingName)).encode('utf-8')) }
+
+    def update_thing_shadow(self, thingName, payload):
+        self.calls.append(('update', thingName))
+        document = self._document(thingName)
+        update = json.loads(payload.decode('utf-8'))
+        if 'version' in update and update['version'] != document['version']:
+            raise ConflictException(update['version'], document['version'])
+        desired = update['state']['desired']
+        # Act as a thing that applies desired changes immediately
+        document['state']['reported'].update(desired)
+        for k in desired:
+            document['metadata']['reported'][k] = { 'timestamp': 1 }
+        document['version'] += 1
+        return { 'payload': io.BytesIO(json.dumps({ 'state': { 'desired': desired }, 'version': document['version'] }).encode('utf-8')) }
+
+@pytest.fixture(autouse=True)
+def clearShadowCache():
+    defaultShadowCache.clear()
+    yield
+    defaultShadowCache.clear()
+
+@pytest.fixture
+def iotData():
+    fake = fakeIotData()
+    clients.setStub('iot-data', lambda region, profile: fake)
+    yield fake
+    clients.clearStubs()
+
+def test_ClientPool_Stub(iotData):
+    assert clients.getClient('iot-data', 'us-east-1') is iotData
+
+    iot = Iot('thing-001')
+    iot.put({ 'apower': True })
+    assert iot.updateFinished(timeout=1)
+    assert iot.pendingState == {}
+    assert iot.lastPutVersion == 2
+    assert iot.reportedState['apower'] is True
+    assert iotData.calls == [('update', 'thing-001'), ('get', 'thing-001')]
+
+class slowIotData(fakeIotData):
+    ''' fakeIotData that takes delay seconds to answer and cannot reach the things listed in unreachable '''
+    def __init__(self, delay, unreachable=()):
+        super(slowIotData, self).__init__()
+        self.delay = delay
+        self.unreachable = unreachable
+
+    def get_thing_shadow(self, thingName):
+        time.sleep(self.delay)
+        if thingName in self.unreachable: raise IOError('{0} is offline'.format(thingName))
+        return super(slowIotData, self).get_thing_shadow(thingName)
+
+    def update_thing_shadow(self, thingName, payload):
+        time.sleep(self.delay)
+        if thingName in self.unreachable: raise IOError('{0} is offline'.format(thingName))
+        return super(slowIotData, self).update_thing_shadow(thingName, payload)
+
+def test_IotGroup():
+    fake = slowIotData(.2, unreachable=['thing-003'])
+    clients.setStub('iot-data', lambda region, profile: fake)
+    try:
+        group = IotGroup([ Iot('thing-001'), Iot('thing-002') ])
+        start = time.time()
+        group.put({ 'apower': True })
+        assert group.updateFinished(timeout=1)
+        # Each thing took .4 seconds (a put and a get) but they were handled concurrently
+        assert time.time() - start < .7
+        assert all([ iot.reportedState['apower'] is True for iot in group ])
+
+        group = IotGroup([ Iot('thing-001'), Iot('thing-002'), Iot('thing-003') ])
+        with pytest.raises(ENDPOINT_UNREACHABLE) as e:
+            group.get()
+        assert 'thing-003' in str(e.value)
+        assert list(group.failures) == ['thing-003']
+    finally:
+        clients.clearStubs()
+
+def test_ShadowCache(iotData):
+    cache = ShadowCache(maxsize=2, ttl=.2)
+    class iotCached(Iot):
+        shadowCache = cache
+
+    first = iotCached('thing-001')
+    first.get()
+    # A second Iot object for the same thing reuses the shadow that was just read
+    second = iotCached('thing-001')
+    second.get()
+    assert iotData.calls == [('get', 'thing-001')]
+    assert second.lastGet == first.lastGet
+
+    # Writes are applied to the cached shadow as a delta until the thing confirms them
+    second.put({ 'apower': True })
+    (shadow, retrieved) = cache.get(('us-east-1', 'thing-001'), None)
+    assert shadow['state']['delta'] == { 'apower': True }
+    assert shadow['version'] == 2
+    assert second.updateFinished(timeout=1)
+    (shadow, retrieved) = cache.get(('us-east-1', 'thing-001'), None)
+    assert shadow['state']['reported'] == { 'apower': True }
+    assert 'delta' not in shadow['state']
+    assert iotData.calls == [('get', 'thing-001'), ('update', 'thing-001'), ('get', 'thing-001')]
+
+    # Shadows expire and the least recently used is evicted
+    time.sleep(.25)
+    iotCached('thing-001').get()
+    iotCached('thing-002').get()
+    iotCached('thing-003').get()
+    assert iotData.calls[-3:] == [('get', 'thing-001'), ('get', 'thing-002'), ('get', 'thing-003')]
+    assert cache.stats['evictions'] == 1
+
+def test_ShadowCache_SingleFlight():
+    fake = slowIotData(.2)
+    clients.setStub('iot-data', lambda region, profile: fake)
+    try:
+        # Concurrent reads of the same thing share a single request
+        group = IotGroup([ Iot('thing-001') for i in range(5) ])
+        group.get()
+        assert fake.calls == [('get', 'thing-001')]
+        assert defaultShadowCache.stats['coalesced'] == 4
+        assert all([ iot.reportedState is not None for iot in group ])
+    finally:
+        clients.clearStubs()
+
+def test_BufferedWrites(iotData):
+    iot = Iot('thing-001')
+    with iot.buffered():
+        iot.batchSet({ 'apower': True, 'volume': 10 })
+        iot.put({ 'unrelated': 1 })
+        IotGroup([iot]).put({ 'volume': 20 })
+        # Held writes are visible to reads and a later write replaces an earlier one
+        assert iot.batchGet()['volume'] == 20
+        # Only the write made directly with put has been sent
+        assert iotData.calls == [('get', 'thing-001'), ('update', 'thing-001')]
+    assert not iot.buffering
+    assert iotData.calls[-1] == ('update', 'thing-001')
+    assert iotData.shadows['thing-001']['state']['reported'] == { 'apower': True, 'volume': 20, 'unrelated': 1 }
+
+    # Waiting for the thing to update sends the held writes first
+    iot.bufferWrites()
+    iot.batchSet({ 'volume': 30 })
+    assert iot.updateFinished(timeout=1)
+    assert iot.buffering
+    assert iotData.shadows['thing-001']['state']['reported']['volume'] == 30
+    iot.flush()
+
+def test_WriteWithoutRead(iotData):
+    from pyASH.interface import PowerController
+    from pyASH.iot import Thing
+
+    class iotLight(Iot):
+        shadowCache = None
+
+    controller = PowerController(Thing('thing-001', iotLight))
+    # Nothing is known about the thing so the value is written without reading the shadow first
+    controller['powerState'] = 'ON'
+    assert iotData.calls == [('update', 'thing-001')]
+
+    # Once the shadow is fresh an unchanged value is not written again
+    controller.iot.get()
+    controller['powerState'] = 'ON'
+    assert iotData.calls == [('update', 'thing-001'), ('get', 'thing-001')]
+    controller['powerState'] = 'OFF'
+    assert iotData.calls[-1] == ('update', 'thing-001')
+
+def test_KnownValueFromShadowCache(iotData):
+    from pyASH.interface import PowerController
+    from pyASH.iot import Thing
+
+    iotData._document('thing-001')['state']['reported']['powerState'] = 'ON'
+    Iot('thing-001').get()
+
+    # A new object knows the value from the shadow another object just read so an unchanged value is not written
+    assert Iot('thing-001').knownValue('powerState') == 'ON'
+    controller = PowerController(Thing('thing-001', Iot))
+    controller['powerState'] = 'ON'
+    assert iotData.calls == [('get', 'thing-001')]
+
+    # A change that has been requested but not yet reported is known as well
+    Iot('thing-001').put({ 'powerState': 'OFF' })
+    iotData._document('thing-001')['state']['reported']['powerState'] = 'ON'
+    assert Iot('thing-001').knownValue('powerState') == 'OFF'
+
+    # Versioned writes take the shadow's version from the cache rather than reading it
+    class iotVersioned(Iot):
+        versionedWrites = True
+
+    iot = iotVersioned('thing-001')
+    iot.put({ 'powerState': 'ON' })
+    assert iotData.calls == [('get', 'thing-001'), ('update', 'thing-001'), ('update', 'thing-001')]
+    assert iot.shadowVersion == 3
+
+def test_IotTest_KeepsStoredState(tmp_path, monkeypatch):
+    from pyASH.iot import IotTest
+    monkeypatch.chdir(tmp_path)
+
+    @IotTest.initial('volume', 5)
+    @IotTest.initial('mute', False)
+    class iotStored(IotTest):
+        pass
+
+    iotStored()['volume'] = 30
+    # A new object writing a different variable must not replace the stored volume with its initial value
+    iotStored()['muted'] = True
+    iot = iotStored()
+    assert iot['volume'] == 30
+    assert iot['muted'] is True
+
+def test_VersionedWrites(iotData):
+    class iotVersioned(Iot):
+        versionedWrites = True
+        shadowCache = None
+
+    iot = iotVersioned('thing-001')
+    iot.get()
+    assert iot.shadowVersion == 1
+    iot.put({ 'apower': True })
+    assert iot.shadowVersion == 2
+
+    # Another writer changes the shadow.  The update is rejected, the shadow is read again and the update is resent.
+    iotData.shadows['thing-001']['version'] = 5
+    iot.put({ 'apower': False })
+    assert iotData.calls[-3:] == [('update', 'thing-001'), ('get', 'thing-001'), ('update', 'thing-001')]
+    assert iot.shadowVersion == 6
+    assert iotData.shadows['thing-001']['state']['reported']['apower'] is False
+
+def test_TransformTables():
+    class iotTransformed(Iot):
+        @Iot.transformFromProperty('powerState', 'apower')
+        def fromPowerState(self, value):
+            return { 'ON': True, 'OFF': False }.get(value, value)
+
+        @Iot.transformToProperty('powerState', 'apower')
+        def toPowerState(self, value):
+            return { True: 'ON', False: 'OFF' }.get(value, value)
+
+    first = iotTransformed('thing-001')
+    second = iotTransformed('thing-002')
+    # The tables are built once per class and cannot be modified
+    assert first.toPropertybyVariable is second.toPropertybyVariable
+    with pytest.raises(TypeError):
+        first.toPropertybyVariable['volume'] = None
+    assert 'apower' not in Iot('thing-003').toPropertybyVariable
+
+    first.reportedState = { 'apower': True, 'volume': 10, 'unknown': 1 }
+    first.reportedStateTimeStamp = { 'apower': { 'timestamp': 1 }, 'volume': { 'timestamp': 2 }, 'unknown': { 'timestamp': 3 } }
+    first.lastGet = time.time()
+    assert first.batchGet() == { 'powerState': 'ON', 'volume': 10 }
+    assert first.timeStamps == { 'powerState': 1, 'volume': 2 }
+    assert first._getMethodVariable('powerState', 'from') == (iotTransformed.__dict__['fromPowerState'], 'apower')
+
+    assert Iot.validateProperty('volume') == 'volume'
+    with pytest.raises(ValueError):
+        Iot.validateProperty('apower')
+
+def test_BulkGet():
+    fake = slowIotData(.2, unreachable=['thing-013'])
+    clients.setStub('iot-data', lambda region, profile: fake)
+    try:
+        names = [ 'thing-{0:03d}'.format(i) for i in range(20) ]
+        result = Iot.bulkGet(names + ['thing-001'])
+        # The things were retrieved concurrently
+        assert result.elapsed < .6
+        assert len(result) == 19
+        assert 'thing-001' in result and result['thing-001']['version'] == 1
+        assert list(result.errors) == ['thing-013']
+        assert sorted(result.latency) == names
+        assert all([ latency >= .2 for latency in result.latency.values() ])
+
+        # The shadows that were retrieved are in the shared cache
+        calls = len(fake.calls)
+        Iot('thing-001').get()
+        assert len(fake.calls) == calls
+    finally:
+        clients.clearStubs()
+
+def test_User_GetThingStates(iotData):
+    from pyASH.endpoint import Endpoint
+    from pyASH.iot import Thing
+    from pyASH.user import DemoUser
+
+    class tBulk(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tBulk(things=[Thing('thing-001', Iot), Thing('thing-002', Iot)], friendlyName='Scene'))
+    user.addEndpoint(tBulk(things=Thing('thing-002', Iot), friendlyName='Light'))
+    result = user.getThingStates(None, maxWorkers=2)
+    assert sorted(result.shadows) == ['thing-001', 'thing-002']
+    assert sorted(iotData.calls) == [('get', 'thing-001'), ('get', 'thing-002')]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+import logging
+
+from pyASH import log
+
+def test_Redact():
+    request = { 'directive': { 'endpoint': { 'scope': { 'type': 'BearerToken', 'token': 'access-token-from-skill' }, 'endpointId': 'endpoint-001' }, 'payload': { 'grant': { 'type': 'OAuth2.AuthorizationCode', 'code': 'VGhpcyBpcyBhbiBhdXRob3JpemF0aW9uIGNvZGUuIDotKQ==' } } } }
+    redacted = log.redact(request)
+    assert redacted['directive']['endpoint']['scope']['token'] == log.REDACTED
+    assert redacted['directive']['payload']['grant']['code'] == log.REDACTED
+    assert redacted['directive']['endpoint']['endpointId'] == 'endpoint-001'
+    # The original is not modified
+    assert request['directive']['endpoint']['scope']['token'] == 'access-token-from-skill'
+    assert 'access-token-from-skill' not in log.dumps(request)
+
+def test_LazyPayload(caplog):
+    calls = []
+    def expensive():
+        calls.append(1)
+        return 'expensive'
+
+    logger = logging.getLogger('test_log')
+    logger.setLevel(logging.WARN)
+    logger.debug('%s', log.Lazy(expensive))
+    assert not log.payload(logger, 'response is', { 'token': 'secret' })
+    assert calls == []
+
+    logger.setLevel(logging.DEBUG)
+    with caplog.at_level(logging.DEBUG, logger='test_log'):
+        assert log.payload(logger, 'response is', { 'token': 'secret' })
+        assert not log.payload(logger, 'response is', { 'token': 'secret' }, sampleRate=0)
+        logger.debug('%s', log.Lazy(expensive))
+    assert calls == [1]
+    assert 'secret' not in caplog.text
+    assert log.REDACTED in caplog.text
@@ -450,3 +450,40 @@ def test_Request_1():
     assert a.endpointId == 'endpoint-001'
     assert a.endpoint.token == 'access-token-from-skill'
     assert a.payload.brightnessDelta == -25
+
+def test_Request_Index():
+    raw = {
+        'directive': {
+            'header': { 'namespace': 'Alexa.Speaker', 'name': 'SetMute', 'messageId': 'abc' },
+            'endpoint': { 'scope': { 'type': 'BearerToken', 'token': 'access-token' }, 'endpointId': 'endpoint-001', 'cookie': {} },
+            'payload': { 'mute': False, 'volume': 0, 'name': 'ignored' }
+        }
+    }
+    r = Request(raw)
+    assert r.namespace == 'Alexa.Speaker'
+    # First match wins
+    assert r.name == 'SetMute'
+    assert r.payload.name == 'ignored'
+    assert r.token == 'access-token'
+    assert r.endpoint.endpointId == 'endpoint-001'
+    # Child wrappers are cached
+    assert r.payload is r.payload
+    # Falsy values are not returned
+    with pytest.raises(AttributeError):
+        r.mute
+    assert not hasattr(r, 'missing')
+
+def test_ASHO_Deferred():
+    import subprocess
+    import sys
+    script = 'import sys, time; t=time.time(); import pyASH.pyASH; from pyASH.objects import ASHO; print(ASHO.built, "python_jsonschema_objects" in sys.modules, time.time()-t)'
+    (built, imported, elapsed) = subprocess.check_output([sys.executable, '-c', script]).decode().split()
+    assert built == 'False'
+    assert imported == 'False'
+    assert float(elapsed) < 1.5
+
+def test_ASHO_CompiledSchema():
+    from pyASH import objects
+    with open(objects.path_to_schema, 'rb') as schema_file:
+        raw = schema_file.read()
+    assert objects._loadCompiledSchema(objects._schemaHash(raw)) == objects._objectSchema(json.loads(raw.decode('utf-8')))
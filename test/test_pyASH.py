@@ -2600,3 +2600,434 @@ def test_ReportState(setupReportState):
     response = pyash.lambda_handler(request)
     print (response)
     compareResults(expected_response, response)
+
+def test_IotSession_SingleShadowGet():
+    try:
+        os.remove('iotSession.json')
+    except FileNotFoundError:
+        # ignore
+        pass
+
+    @IotTest.initial('powerState', 'ON')
+    @IotTest.initial('brightness', 50)
+    class iotSession(IotTest):
+        # Only consider the shadow stale until it has been retrieved once so that round trips can be counted
+        def _stale(self):
+            return self.getCount == 0
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    @Endpoint.addInterface(BrightnessController, proactivelyReported=True, retrievable=True)
+    @Endpoint.addInterface(EndpointHealth, proactivelyReported=True, retrievable=True)
+    class tSessionLight(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tSessionLight(things=Thing('endpoint-001', iotSession), friendlyName='Light'))
+    pyash = pyASH(user)
+    endpoint = user.endpoints['tSessionLight:endpoint-001']
+    session = endpoint.openSession()
+
+    request = {
+        "directive": {
+            "header": {
+                "namespace": "Alexa.PowerController",
+                "name": "TurnOff",
+                "payloadVersion": "3",
+                "messageId": "1bd5d003-31b9-476f-ad03-71d471922820",
+                "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg=="
+            },
+            "endpoint": {
+                "scope": {
+                    "type": "BearerToken",
+                    "token": "access-token-from-skill"
+                },
+                "endpointId": "tSessionLight:endpoint-001",
+                "cookie": {}
+            },
+            "payload": {}
+        }
+    }
+    response = pyash.lambda_handler(request)
+
+    assert response['event']['header']['name'] == 'Response'
+    assert len(session.iots) == 1
+    assert session.shadowGets == 1
+    assert session.shadowPuts == 1
+    assert session.closed
+
+    # A new request starts a new session
+    assert endpoint.openSession() is not session
+
+def test_Endpoint_DispatchTables():
+    class tCompiled(Endpoint):
+        @Endpoint.addDirective
+        def TurnOn(self, request):
+            pass
+
+    tables = tCompiled._dispatchTables()
+    assert tCompiled._dispatchTables() is tables
+    assert ('Alexa.PowerController', 'TurnOn') in tables[1]
+    assert 'Alexa.PowerController' in tables[2]
+    with pytest.raises(TypeError):
+        tables[1][('Alexa.PowerController', 'TurnOff')] = None
+
+    # Decorating the class after it has been defined must be reflected in the tables
+    Endpoint.addInterface(BrightnessController)(tCompiled)
+    tables = tCompiled._dispatchTables()
+    assert 'Alexa.BrightnessController' in tables[2]
+    assert ('Alexa.BrightnessController', 'SetBrightness') in tables[1]
+
+def test_AsyncLambdaHandler():
+    import asyncio
+    try:
+        os.remove('iotAsync.json')
+    except FileNotFoundError:
+        # ignore
+        pass
+
+    @IotTest.initial('powerState', 'ON')
+    class iotAsync(IotTest):
+        def _stale(self):
+            return self.getCount == 0
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    class tAsyncScene(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tAsyncScene(things=[Thing('endpoint-001', iotAsync), Thing('endpoint-002', iotAsync)], friendlyName='Scene'))
+    pyash = pyASH(user)
+    endpoint = user.endpoints['tAsyncScene:endpoint-001:endpoint-002']
+    session = endpoint.openSession()
+
+    request = {
+        "directive": {
+            "header": {
+                "namespace": "Alexa.PowerController",
+                "name": "TurnOff",
+                "payloadVersion": "3",
+                "messageId": "1bd5d003-31b9-476f-ad03-71d471922820",
+                "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg=="
+            },
+            "endpoint": {
+                "scope": {
+                    "type": "BearerToken",
+                    "token": "access-token-from-skill"
+                },
+                "endpointId": "tAsyncScene:endpoint-001:endpoint-002",
+                "cookie": {}
+            },
+            "payload": {}
+        }
+    }
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(pyash.async_lambda_handler(request))
+    finally:
+        loop.close()
+
+    assert response['event']['header']['name'] == 'Response'
+    assert response['context']['properties'][0]['value'] == 'OFF'
+    # Both shadows were prefetched and neither was retrieved again by the handler
+    assert len(session.iots) == 2
+    assert session.shadowGets == 2
+    assert session.closed
+
+    # The sync handler produces the same response
+    sync = pyash.lambda_handler(request)
+    assert sync['context']['properties'][0]['value'] == response['context']['properties'][0]['value']
+    assert sync['event']['endpoint'] == response['event']['endpoint']
+
+def test_Endpoint_CapabilityCache():
+    class iotNoDiscovery(IotTest):
+        def __init__(self, *args, **kwargs):
+            raise AssertionError('Discovery must not create Iot objects')
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    class tCapabilities(Endpoint):
+        pass
+
+    user = DemoUser()
+    for i in range(3):
+        user.addEndpoint(tCapabilities(things=Thing('device_{0}'.format(i), iotNoDiscovery), friendlyName='Device {0}'.format(i)))
+    pyash = pyASH(user)
+    response = pyash.handleDiscovery(None)
+
+    endpoints = response['event']['payload']['endpoints']
+    assert len(endpoints) == 3
+    assert [ c['interface'] for c in endpoints[0]['capabilities'] ] == ['Alexa', 'Alexa.PowerController']
+    # Capabilities are computed once per class
+    assert tCapabilities._capabilities() is tCapabilities._capabilities()
+    assert endpoints[0]['capabilities'] == endpoints[2]['capabilities']
+    assert all([ ep.session is None for ep in user.endpoints.values() ])
+
+    # Modifying one endpoint's capabilities does not affect the others or the class
+    endpoints[0]['capabilities'][1]['properties']['retrievable'] = False
+    assert endpoints[2]['capabilities'][1]['properties']['retrievable'] is True
+    assert tCapabilities._capabilities()[1]['properties']['retrievable'] is True
+    assert pyash.handleDiscovery(None)['event']['payload']['endpoints'][0]['capabilities'][1]['properties']['retrievable'] is True
+
+    # Adding an interface to the class is reflected in the next discovery
+    Endpoint.addInterface(EndpointHealth, proactivelyReported=True, retrievable=True)(tCapabilities)
+    endpoints = pyash.handleDiscovery(None)['event']['payload']['endpoints']
+    assert 'Alexa.EndpointHealth' in [ c['interface'] for c in endpoints[0]['capabilities'] ]
+
+def test_Instrumentation():
+    from pyASH import instrumentation
+
+    @IotTest.initial('powerState', 'ON')
+    class iotTraced(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    class tTraced(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tTraced(things=Thing('endpoint-001', iotTraced), friendlyName='Traced'))
+    pyash = pyASH(user)
+    request = {
+        "directive": {
+            "header": { "namespace": "Alexa.PowerController", "name": "TurnOff", "payloadVersion": "3", "messageId": "1bd5d003-31b9-476f-ad03-71d471922820", "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==" },
+            "endpoint": { "scope": { "type": "BearerToken", "token": "access-token-from-skill" }, "endpointId": "tTraced:endpoint-001", "cookie": {} },
+            "payload": {}
+        }
+    }
+
+    sink = instrumentation.addSink(instrumentation.MemorySink())
+    try:
+        # Disabled by default
+        pyash.lambda_handler(request)
+        assert sink.traces == []
+
+        instrumentation.ENABLED = True
+        pyash.lambda_handler(request)
+    finally:
+        instrumentation.ENABLED = False
+        instrumentation.removeSink(sink)
+
+    assert len(sink.traces) == 1
+    trace = sink.traces[0]
+    assert trace['name'] == 'Alexa.PowerController.TurnOff'
+    for phase in ['user', 'handler', 'wait', 'interface.jsonResponse', 'serialize']:
+        assert trace['phases'][phase]['count'] >= 1
+    assert trace['ms'] >= trace['phases']['handler']['ms']
+    assert instrumentation.currentTrace() is None
+
+def test_HandleBatch():
+    for name in ['iotBatch.json']:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+    @IotTest.initial('powerState', 'ON')
+    @IotTest.initial('brightness', 50)
+    class iotBatch(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    @Endpoint.addInterface(BrightnessController, proactivelyReported=True, retrievable=True)
+    class tBatchLight(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tBatchLight(things=Thing('light-001', iotBatch), friendlyName='Light 1'))
+    user.addEndpoint(tBatchLight(things=Thing('light-002', iotBatch), friendlyName='Light 2'))
+    pyash = pyASH(user)
+
+    def directive(namespace, name, endpointId, payload={}):
+        return {
+            "directive": {
+                "header": { "namespace": namespace, "name": name, "payloadVersion": "3", "messageId": get_uuid(), "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==" },
+                "endpoint": { "scope": { "type": "BearerToken", "token": "access-token-from-skill" }, "endpointId": endpointId, "cookie": {} },
+                "payload": payload
+            }
+        }
+
+    responses = pyash.handleBatch([
+        directive('Alexa.BrightnessController', 'SetBrightness', 'tBatchLight:light-001', { 'brightness': 30 }),
+        directive('Alexa.PowerController', 'TurnOff', 'tBatchLight:light-002'),
+        directive('Alexa.PowerController', 'TurnOn', 'tBatchLight:missing'),
+        directive('Alexa.BrightnessController', 'AdjustBrightness', 'tBatchLight:light-001', { 'brightnessDelta': 10 }),
+    ])
+
+    assert [ r['event']['header']['name'] for r in responses ] == ['Response', 'Response', 'ErrorResponse', 'Response']
+    assert responses[2]['event']['payload']['type'] == 'NO_SUCH_ENDPOINT'
+    assert responses[1]['event']['endpoint']['endpointId'] == 'tBatchLight:light-002'
+    # Each directive reports the state as of that directive.  The adjustment was applied on top of the earlier (not yet sent) write.
+    brightness = [ [ p['value'] for p in responses[i]['context']['properties'] if p['name'] == 'brightness' ] for i in [0, 3] ]
+    assert brightness == [[30], [40]]
+
+    # Both directives for light-001 were sent to the thing as a single update
+    session = user.endpoints['tBatchLight:light-001'].session
+    assert session.shadowPuts == 1
+    assert session.closed
+
+    # Requests that are not directives are handled in order with the directives around them
+    report = directive('Alexa', 'ReportState', 'tBatchLight:light-001')
+    responses = pyash.handleBatch([
+        directive('Alexa.PowerController', 'TurnOff', 'tBatchLight:light-001'),
+        report,
+        directive('Alexa.PowerController', 'TurnOn', 'tBatchLight:light-001'),
+        report,
+    ])
+    assert [ r['event']['header']['name'] for r in responses ] == ['Response', 'StateReport', 'Response', 'StateReport']
+    powerState = [ [ p['value'] for p in r['context']['properties'] if p['name'] == 'powerState' ] for r in responses ]
+    assert powerState == [['OFF'], ['OFF'], ['ON'], ['ON']]
+
+def test_HandleBatch_UnexpectedError():
+    for name in ['iotBatchError.json', 'iotBatchBroken.json']:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+    @IotTest.initial('powerState', 'ON')
+    @IotTest.initial('brightness', 50)
+    class iotBatchError(IotTest):
+        pass
+
+    @IotTest.initial('powerState', 'ON')
+    class iotBatchBroken(IotTest):
+        # Reading the state for the response fails
+        def get(self):
+            raise RuntimeError('get_thing_shadow failed')
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    @Endpoint.addInterface(BrightnessController, proactivelyReported=True, retrievable=True)
+    class tBatchError(Endpoint):
+        @Endpoint.addDirective
+        def TurnOn(self, request):
+            raise ValueError('handler failed')
+
+    user = DemoUser()
+    user.addEndpoint(tBatchError(things=Thing('light-001', iotBatchError), friendlyName='Light 1'))
+    user.addEndpoint(tBatchError(things=Thing('light-002', iotBatchBroken), friendlyName='Light 2'))
+    pyash = pyASH(user)
+
+    def directive(namespace, name, endpointId, payload={}):
+        return {
+            "directive": {
+                "header": { "namespace": namespace, "name": name, "payloadVersion": "3", "messageId": get_uuid(), "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==" },
+                "endpoint": { "scope": { "type": "BearerToken", "token": "access-token-from-skill" }, "endpointId": endpointId, "cookie": {} },
+                "payload": payload
+            }
+        }
+
+    responses = pyash.handleBatch([
+        directive('Alexa.PowerController', 'TurnOn', 'tBatchError:light-001'),
+        directive('Alexa.BrightnessController', 'SetBrightness', 'tBatchError:light-001', { 'brightness': 30 }),
+        directive('Alexa.PowerController', 'TurnOff', 'tBatchError:light-002'),
+    ])
+
+    # The failing handler only affects its own directive
+    assert [ r['event']['header']['name'] for r in responses ] == ['ErrorResponse', 'Response', 'ErrorResponse']
+    assert responses[0]['event']['payload']['type'] == 'INTERNAL_ERROR'
+    # So does an exception raised while computing the response
+    assert responses[2]['event']['payload']['type'] == 'INTERNAL_ERROR'
+    assert responses[2]['event']['endpoint']['endpointId'] == 'tBatchError:light-002'
+    for name in ['iotBatchError.json', 'iotBatchBroken.json']:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+def test_ResponseCache():
+    from pyASH.cache import ResponseCache
+    try:
+        os.remove('iotRetried.json')
+    except FileNotFoundError:
+        pass
+
+    @IotTest.initial('brightness', 50)
+    class iotRetried(IotTest):
+        pass
+
+    @Endpoint.addInterface(BrightnessController, proactivelyReported=True, retrievable=True)
+    class tRetried(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tRetried(things=Thing('endpoint-001', iotRetried), friendlyName='Retried'))
+    cache = ResponseCache()
+    pyash = pyASH(user, responseCache=cache)
+    request = {
+        "directive": {
+            "header": { "namespace": "Alexa.BrightnessController", "name": "AdjustBrightness", "payloadVersion": "3", "messageId": get_uuid(), "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==" },
+            "endpoint": { "scope": { "type": "BearerToken", "token": "access-token-from-skill" }, "endpointId": "tRetried:endpoint-001", "cookie": {} },
+            "payload": { "brightnessDelta": 10 }
+        }
+    }
+    def brightness(response):
+        return [ p['value'] for p in response['context']['properties'] if p['name'] == 'brightness' ][0]
+
+    first = pyash.lambda_handler(deepcopy(request))
+    assert brightness(first) == 60
+    assert cache.stats == { 'hits': 0, 'misses': 1 }
+
+    # A redelivery returns the original response without adjusting the brightness again
+    retry = pyash.lambda_handler(deepcopy(request))
+    assert retry == first
+    assert cache.stats == { 'hits': 1, 'misses': 1 }
+
+    # A different directive that reuses the messageId is handled
+    request['directive']['payload']['brightnessDelta'] = 5
+    assert brightness(pyash.lambda_handler(deepcopy(request))) == 65
+    assert cache.stats == { 'hits': 1, 'misses': 2 }
+
+    # The same directive sent with a different user's token is handled for that user
+    other = deepcopy(request)
+    other['directive']['endpoint']['scope']['token'] = 'access-token-from-another-skill'
+    assert brightness(pyash.lambda_handler(other)) == 70
+    assert cache.stats == { 'hits': 1, 'misses': 3 }
+
+    # Every delivery is handled when no cache is provided
+    uncached = pyASH(user)
+    assert brightness(uncached.lambda_handler(deepcopy(request))) == 75
+    assert brightness(uncached.lambda_handler(deepcopy(request))) == 80
+    os.remove('iotRetried.json')
+
+def test_WriteCoalescing():
+    try:
+        os.remove('iotCoalesced.json')
+    except FileNotFoundError:
+        pass
+
+    @IotTest.initial('powerState', 'OFF')
+    @IotTest.initial('brightness', 0)
+    class iotCoalesced(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+    @Endpoint.addInterface(BrightnessController, proactivelyReported=True, retrievable=True)
+    class tCoalesced(Endpoint):
+        @Endpoint.addDirective
+        def TurnOn(self, request):
+            self.iot['powerState'] = 'ON'
+            self.iot['brightness'] = 50
+            # The handler reads its own (not yet sent) write
+            assert self.iot['brightness'] == 50
+            self.iot['brightness'] = 75
+
+    user = DemoUser()
+    user.addEndpoint(tCoalesced(things=Thing('endpoint-001', iotCoalesced), friendlyName='Light'))
+    pyash = pyASH(user)
+    endpoint = user.endpoints['tCoalesced:endpoint-001']
+    session = endpoint.openSession()
+    request = {
+        "directive": {
+            "header": { "namespace": "Alexa.PowerController", "name": "TurnOn", "payloadVersion": "3", "messageId": get_uuid(), "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==" },
+            "endpoint": { "scope": { "type": "BearerToken", "token": "access-token-from-skill" }, "endpointId": "tCoalesced:endpoint-001", "cookie": {} },
+            "payload": {}
+        }
+    }
+    response = pyash.lambda_handler(request)
+
+    assert response['context']['properties'][0]['value'] == 'ON'
+    # Every write the handler made was sent to the thing in a single update
+    iot = session.iots[(iotCoalesced, 'endpoint-001')]
+    assert session.shadowPuts == 1
+    assert not iot.buffering
+    assert iot.reportedState['brightness'] == 75
+    os.remove('iotCoalesced.json')
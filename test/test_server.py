@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+import json
+import os
+import urllib.request
+import urllib.error
+
+from pyASH.server import Server, Metrics
+
+def handler(request, context):
+    header = request['directive']['header']
+    if header['name'] == 'Fail':
+        raise ValueError('failed')
+    return { 'event': { 'header': dict(header, name='Response'), 'payload': {} }, 'pid': os.getpid() }
+
+def makeHandler():
+    def closureHandler(request, context):
+        return handler(request, context)
+    return closureHandler
+
+# Like the handler returned by pyASH.warm.lambdaHandler this cannot be pickled
+closureHandler = makeHandler()
+
+def directive(name):
+    return { 'directive': { 'header': { 'namespace': 'Alexa.PowerController', 'name': name, 'payloadVersion': '3', 'messageId': 'm' }, 'payload': {} } }
+
+def post(server, body):
+    url = 'http://{0}:{1}/'.format(*server.address[:2])
+    data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, headers={ 'Content-Type': 'application/json' })) as response:
+            return (response.status, json.loads(response.read().decode('utf-8')))
+    except urllib.error.HTTPError as e:
+        return (e.code, json.loads(e.read().decode('utf-8')))
+
+def get(server, path):
+    with urllib.request.urlopen('http://{0}:{1}{2}'.format(server.address[0], server.address[1], path)) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def test_Metrics():
+    metrics = Metrics()
+    metrics.record('Alexa.PowerController.TurnOn', 0.003)
+    metrics.record('Alexa.PowerController.TurnOn', 0.030)
+    metrics.record('Alexa.PowerController.TurnOff', 10, error=True)
+    data = metrics.asDict()
+    assert data['requests'] == 3
+    assert data['errors'] == 1
+    assert data['latency']['histogram']['5'] == 1
+    assert data['latency']['histogram']['50'] == 1
+    assert data['latency']['histogram']['+Inf'] == 1
+    assert sum(data['latency']['histogram'].values()) == 3
+    assert data['directives']['Alexa.PowerController.TurnOn'] == { 'count': 2, 'errors': 0, 'ms': 16.5 }
+    assert data['throughput']['overall'] > 0
+
+def test_Server():
+    with Server(handler, port=0, workers=2) as server:
+        (status, response) = post(server, directive('TurnOn'))
+        assert status == 200
+        assert response['event']['header']['name'] == 'Response'
+        assert response['pid'] == os.getpid()
+
+        (status, response) = post(server, directive('Fail'))
+        assert status == 500
+        # The exception's text is not returned to the caller
+        assert response == { 'error': 'internal error' }
+
+        (status, response) = post(server, b'not json')
+        assert status == 400
+
+        assert get(server, '/health') == { 'status': 'ok' }
+        metrics = get(server, '/metrics')
+        assert metrics['requests'] == 2
+        assert metrics['errors'] == 1
+        assert metrics['directives']['Alexa.PowerController.Fail']['errors'] == 1
+
+def test_Server_Processes():
+    with Server(handler, port=0, workers=1, processes=True) as server:
+        (status, response) = post(server, directive('TurnOn'))
+        assert status == 200
+        assert response['pid'] != os.getpid()
+        # The worker process is reused
+        assert post(server, directive('TurnOff'))[1]['pid'] == response['pid']
+
+def test_Server_Processes_Closure():
+    # Workers import the handler by name so a closure can be served as long as it is named by its module level variable
+    with pytest.raises(ValueError):
+        Server(closureHandler, port=0, processes=True)
+    with Server('{0}:closureHandler'.format(__name__), port=0, workers=1, processes=True, startMethod='spawn') as server:
+        (status, response) = post(server, directive('TurnOn'))
+        assert status == 200
+        assert response['event']['header']['name'] == 'Response'
+        assert response['pid'] != os.getpid()
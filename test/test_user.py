@@ -5,3 +5,263 @@
 
 import pytest
 import json
+
+import pyASH.user
+from pyASH.cache import LRUCache
+from pyASH.exceptions import OAUTH2_EXCEPTION
+from pyASH.objects import Request
+from pyASH.user import DbUser, DemoUser, DiscoveryCache, TokenCache
+
+def test_LRUCache():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # b was the least recently used entry
+    assert 'b' not in cache
+    assert cache.get('c') == 3
+    cache.set('d', 4, ttl=-1)
+    assert cache.get('d') is None
+    assert cache.stats['evictions'] == 2
+
+def _request(token, endpointId='tSwitch:endpoint-001'):
+    return Request({ 'directive': { 'header': { 'namespace': 'Alexa', 'name': 'ReportState' }, 'endpoint': { 'scope': { 'type': 'BearerToken', 'token': token }, 'endpointId': endpointId }, 'payload': {} } })
+
+def test_DbUser_TokenCache(monkeypatch):
+    calls = []
+    def getUserProfile(token):
+        calls.append(token)
+        if token in ['bad-token', 'outage-token']:
+            e = OAUTH2_EXCEPTION('invalid token' if token == 'bad-token' else 'service unavailable')
+            e.statusCode = 401 if token == 'bad-token' else 503
+            raise e
+        return { 'user_id': 'amzn1.account.1', 'name': 'Test User', 'email': 'test@example.com' }
+
+    def _getUserUUID(self):
+        self.uuid = 'uuid-001'
+        return self.uuid
+
+    monkeypatch.setattr(pyASH.user, 'getUserProfile', getUserProfile)
+    monkeypatch.setattr(DbUser, '_getUserUUID', _getUserUUID)
+    monkeypatch.setattr(DbUser, '_retrieveEndpoints', lambda self: None)
+
+    cache = TokenCache()
+    user = DbUser(token='good-token', tokenCache=cache)
+    user.getEndpoints(_request('good-token'))
+    DbUser(token='good-token', tokenCache=cache).getEndpoints(_request('good-token'))
+    assert calls == ['good-token']
+    assert user.uuid == 'uuid-001'
+
+    for i in range(2):
+        with pytest.raises(OAUTH2_EXCEPTION):
+            DbUser(token='bad-token', tokenCache=cache)
+    assert calls == ['good-token', 'bad-token']
+
+    # A failure of the profile service is not remembered so the token is tried again
+    for i in range(2):
+        with pytest.raises(OAUTH2_EXCEPTION):
+            DbUser(token='outage-token', tokenCache=cache)
+    assert calls == ['good-token', 'bad-token', 'outage-token', 'outage-token']
+
+def test_TokenCache_Expiry(monkeypatch):
+    import time
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    cache = TokenCache(ttl=300, unknownExpiryTtl=60)
+    # Tokens resolved through the profile service have no known expiration
+    cache.set('profile-token', 'amzn1.account.1', 'uuid-001', {})
+    cache.set('issued-token', 'amzn1.account.1', 'uuid-001', {}, expires=now[0] + 3600)
+    cache.set('expiring-token', 'amzn1.account.1', 'uuid-001', {}, expires=now[0] + 10)
+
+    now[0] += 30
+    assert cache.get('expiring-token') is None
+    assert cache.get('profile-token') is not None
+
+    now[0] += 60
+    assert cache.get('profile-token') is None
+    assert cache.get('issued-token') is not None
+
+    now[0] += 300
+    assert cache.get('issued-token') is None
+
+def test_DbUser_LazyEndpoints(monkeypatch):
+    from pyASH.endpoint import Endpoint
+    from pyASH.interface import PowerController
+    from pyASH.iot import IotTest, Thing
+
+    class iotLazy(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController)
+    class tLazySwitch(Endpoint):
+        pass
+
+    records = [ tLazySwitch(things=Thing('endpoint-{0:03d}'.format(i), iotLazy)).json for i in range(80) ]
+
+    class fakeDBEndpoints(dict):
+        def __init__(self, uuid):
+            super(fakeDBEndpoints, self).__init__(endpoints=records)
+
+    monkeypatch.setattr(pyASH.user, 'getUserProfile', lambda token: { 'user_id': 'amzn1.account.1', 'name': 'Test User', 'email': 'test@example.com' })
+    monkeypatch.setattr(DbUser, '_getUserUUID', lambda self: setattr(self, 'uuid', 'uuid-001'))
+    monkeypatch.setattr(pyASH.user, 'DBEndpoints', fakeDBEndpoints)
+
+    user = DbUser(token='lazy-token', classes=[tLazySwitch, iotLazy], tokenCache=TokenCache())
+    assert len(user.endpointRecords) == 80
+    assert user.endpoints == {}
+
+    endpoint = user.getEndpoint(_request('lazy-token', 'tLazySwitch:endpoint-042'))
+    assert list(user.endpoints.keys()) == ['tLazySwitch:endpoint-042']
+    # The shadow has not been read yet
+    assert endpoint.iot.getCount == 0
+
+def test_DbUser_LegacyRecords(monkeypatch):
+    from pyASH.endpoint import Endpoint
+    from pyASH.interface import PowerController
+    from pyASH.iot import IotTest, Thing
+
+    class iotLegacy(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController)
+    class tLegacySwitch(Endpoint):
+        @property
+        def endpointId(self):
+            return 'legacy-' + self.things[0].name
+
+    # A record written before the endpointId was persisted
+    record = json.loads(tLegacySwitch(things=Thing('endpoint-001', iotLegacy)).json)
+    del record['endpointId']
+    store = { 'endpoints': [ json.dumps(record) ] }
+
+    class fakeDBEndpoints(object):
+        def __getitem__(self, key):
+            return store.get(key)
+        def __setitem__(self, key, value):
+            store[key] = value
+
+    monkeypatch.setattr(pyASH.user, 'getUserProfile', lambda token: { 'user_id': 'amzn1.account.1', 'name': 'Test User', 'email': 'test@example.com' })
+    monkeypatch.setattr(DbUser, '_getUserUUID', lambda self: setattr(self, 'uuid', 'uuid-001'))
+    monkeypatch.setattr(pyASH.user, 'DBEndpoints', lambda uuid: fakeDBEndpoints())
+
+    user = DbUser(token='legacy-token', classes=[tLegacySwitch, iotLegacy], tokenCache=TokenCache())
+    endpoint = user.getEndpoint(_request('legacy-token', 'legacy-endpoint-001'))
+    assert endpoint.things[0].name == 'endpoint-001'
+
+    # The endpointId is written back to the record when the endpoints are next persisted
+    user.addEndpoint(tLegacySwitch(things=Thing('endpoint-002', iotLegacy)))
+    assert sorted([ json.loads(ep)['endpointId'] for ep in store['endpoints'] ]) == ['legacy-endpoint-001', 'legacy-endpoint-002']
+
+def test_DbUser_DiscoveryCache(monkeypatch):
+    from pyASH.endpoint import Endpoint
+    from pyASH.interface import PowerController
+    from pyASH.iot import IotTest, Thing
+
+    class iotDiscovery(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController)
+    class tDiscoverySwitch(Endpoint):
+        pass
+
+    store = { 'endpoints': [ tDiscoverySwitch(things=Thing('endpoint-{0:03d}'.format(i), iotDiscovery)).json for i in range(3) ] }
+
+    class fakeDBEndpoints(object):
+        def __getitem__(self, key):
+            return store.get(key)
+        def __setitem__(self, key, value):
+            store[key] = value
+
+    monkeypatch.setattr(pyASH.user, 'getUserProfile', lambda token: { 'user_id': 'amzn1.account.1', 'name': 'Test User', 'email': 'test@example.com' })
+    monkeypatch.setattr(DbUser, '_getUserUUID', lambda self: setattr(self, 'uuid', 'uuid-001'))
+    monkeypatch.setattr(pyASH.user, 'DBEndpoints', lambda uuid: fakeDBEndpoints())
+
+    cache = DiscoveryCache()
+    user = DbUser(token='discovery-token', classes=[tDiscoverySwitch, iotDiscovery], tokenCache=TokenCache(), discoveryCache=cache)
+    discovery = user.getDiscovery(_request('discovery-token'))
+    assert len(discovery) == 3
+
+    # A second user object for the same records is answered from the cache without materializing any endpoints
+    other = DbUser(token='discovery-token', classes=[tDiscoverySwitch, iotDiscovery], tokenCache=TokenCache(), discoveryCache=cache)
+    assert other.getDiscovery(_request('discovery-token')) == discovery
+    assert other.endpoints == {}
+
+    # Changing a returned discovery object does not change the cached one
+    discovery[0]['friendlyName'] = 'Changed'
+    discovery.pop()
+    cached = other.getDiscovery(_request('discovery-token'))
+    assert len(cached) == 3
+    assert cached[0]['friendlyName'] != 'Changed'
+
+    # Adding an endpoint changes the persisted records and so the cache key
+    user.addEndpoint(tDiscoverySwitch(things=Thing('endpoint-003', iotDiscovery)))
+    assert len(user.getDiscovery(_request('discovery-token'))) == 4
+    assert len(DbUser(token='discovery-token', classes=[tDiscoverySwitch, iotDiscovery], tokenCache=TokenCache(), discoveryCache=cache).getDiscovery(_request('discovery-token'))) == 4
+
+def test_DbUser_Recheck(monkeypatch):
+    from pyASH.endpoint import Endpoint
+    from pyASH.interface import PowerController
+    from pyASH.iot import IotTest, Thing
+
+    class iotRecheck(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController)
+    class tRecheckSwitch(Endpoint):
+        pass
+
+    store = { 'endpoints': [ tRecheckSwitch(things=Thing('endpoint-000', iotRecheck)).json ] }
+    revoked = []
+    def getUserProfile(token):
+        if token in revoked:
+            e = OAUTH2_EXCEPTION('invalid token')
+            e.statusCode = 401
+            raise e
+        return { 'user_id': 'amzn1.account.1', 'name': 'Test User', 'email': 'test@example.com' }
+
+    monkeypatch.setattr(pyASH.user, 'getUserProfile', getUserProfile)
+    monkeypatch.setattr(DbUser, '_getUserUUID', lambda self: setattr(self, 'uuid', 'uuid-001'))
+    monkeypatch.setattr(pyASH.user, 'DBEndpoints', lambda uuid: store)
+
+    cache = TokenCache()
+    user = DbUser(token='recheck-token', classes=[tRecheckSwitch, iotRecheck], tokenCache=cache, discoveryCache=DiscoveryCache())
+    assert len(user.getDiscovery(_request('recheck-token'))) == 1
+
+    # Endpoints stored by someone else are picked up by a user that is being reused
+    store['endpoints'] = store['endpoints'] + [ tRecheckSwitch(things=Thing('endpoint-{0:03d}'.format(i), iotRecheck)).json for i in range(1, 3) ]
+    assert len(user.getDiscovery(_request('recheck-token'))) == 3
+    store['endpoints'] = store['endpoints'] + [ tRecheckSwitch(things=Thing('endpoint-003', iotRecheck)).json ]
+    assert user.getEndpoint(_request('recheck-token', 'tRecheckSwitch:endpoint-003')).endpointId == 'tRecheckSwitch:endpoint-003'
+
+    # Once the token is no longer cached it is checked again and a revoked token stops working
+    revoked.append('recheck-token')
+    user.getEndpoint(_request('recheck-token', 'tRecheckSwitch:endpoint-000'))
+    cache.delete('recheck-token')
+    with pytest.raises(OAUTH2_EXCEPTION):
+        user.getEndpoint(_request('recheck-token', 'tRecheckSwitch:endpoint-000'))
+    with pytest.raises(OAUTH2_EXCEPTION):
+        user.getDiscovery(_request('recheck-token'))
+
+def test_StaticUser_DiscoveryCache():
+    from pyASH.endpoint import Endpoint
+    from pyASH.interface import PowerController
+    from pyASH.iot import IotTest, Thing
+
+    class iotStatic(IotTest):
+        pass
+
+    @Endpoint.addInterface(PowerController)
+    class tStaticSwitch(Endpoint):
+        pass
+
+    user = DemoUser()
+    user.addEndpoint(tStaticSwitch(things=Thing('endpoint-001', iotStatic)))
+    discovery = user.getDiscovery(None)
+    assert user.getDiscovery(None) == discovery
+    discovery.pop()
+    assert len(user.getDiscovery(None)) == 1
+
+    user.addEndpoint(tStaticSwitch(things=Thing('endpoint-002', iotStatic)))
+    assert len(user.getDiscovery(None)) == 2
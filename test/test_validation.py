@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+from copy import deepcopy
+
+from jsonschema import ValidationError
+
+from pyASH.validation import get_validator, validate_message
+
+response = {
+    'context': {
+        'properties': [{
+            'namespace': 'Alexa.PowerController',
+            'name': 'powerState',
+            'value': 'OFF',
+            'timeOfSample': '2017-09-27T18:30:30.45Z',
+            'uncertaintyInMilliseconds': 0
+        }]
+    },
+    'event': {
+        'header': {
+            'namespace': 'Alexa',
+            'name': 'Response',
+            'payloadVersion': '3',
+            'messageId': '5f8a426e-01e4-4cc9-8b79-65f8bd0fd8a4',
+            'correlationToken': 'dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg=='
+        },
+        'endpoint': {
+            'scope': {
+                'type': 'BearerToken',
+                'token': 'access-token-from-Amazon'
+            },
+            'endpointId': 'endpoint-001'
+        },
+        'payload': {}
+    }
+}
+
+errorResponse = {
+    'event': {
+        'header': {
+            'namespace': 'Alexa',
+            'name': 'ErrorResponse',
+            'payloadVersion': '3',
+            'messageId': '5f8a426e-01e4-4cc9-8b79-65f8bd0fd8a4',
+            'correlationToken': 'dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg=='
+        },
+        'endpoint': {
+            'endpointId': 'endpoint-001'
+        },
+        'payload': {
+            'type': 'ENDPOINT_UNREACHABLE',
+            'message': 'Unable to reach endpoint-001'
+        }
+    }
+}
+
+def test_ValidatorCompiledOnce():
+    assert get_validator(response) is get_validator(deepcopy(response))
+    assert get_validator(response) is not get_validator(errorResponse)
+
+def test_ValidateByMessageType():
+    assert validate_message(None, response)
+    assert validate_message(None, errorResponse)
+
+    r = deepcopy(response)
+    r['context']['properties'][0]['value'] = 'SIDEWAYS'
+    with pytest.raises(ValidationError):
+        validate_message(None, r)
+
+    # A message without a recognizable header is checked against the whole schema
+    with pytest.raises(ValidationError):
+        validate_message(None, { 'event': {} })
+
+def test_ValidateSampling():
+    r = deepcopy(response)
+    r['context']['properties'][0]['value'] = 'SIDEWAYS'
+    validated = 0
+    for i in range(10):
+        try:
+            if validate_message(None, r, sample_rate=5):
+                validated += 1
+        except ValidationError:
+            validated += 1
+    assert validated == 2
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+import time
+
+from pyASH.wait import BackoffWait, VersionWait, SubscriptionWait, ShadowMessageBus
+
+class fakeIot(object):
+    ''' Returns a scripted sequence of shadow documents '''
+    def __init__(self, shadows, pendingState=None, lastPutVersion=None):
+        self.shadows = shadows
+        self.pendingState = pendingState if pendingState is not None else {}
+        self.lastPutVersion = lastPutVersion
+        self.waitPolls = 0
+
+    def getThingName(self):
+        return 'thing-001'
+
+    def get(self):
+        return self.shadows.pop(0) if len(self.shadows) > 1 else self.shadows[0]
+
+def test_BackoffWait_Completes():
+    iot = fakeIot([
+        { 'version': 5, 'state': { 'reported': {}, 'delta': { 'apower': True } } },
+        { 'version': 6, 'state': { 'reported': { 'apower': True } } }
+    ], pendingState={ 'apower': True }, lastPutVersion=5)
+    assert BackoffWait(initialDelay=.001).wait(iot, 1)
+    assert iot.waitPolls == 2
+
+def test_BackoffWait_TimesOut():
+    iot = fakeIot([{ 'version': 5, 'state': { 'delta': { 'apower': True } } }], pendingState={ 'apower': True }, lastPutVersion=5)
+    start = time.time()
+    assert not BackoffWait(initialDelay=.01, maxDelay=.02).wait(iot, .1)
+    assert time.time() - start < .5
+    assert iot.waitPolls > 1
+
+def test_VersionWait():
+    # Nothing written so nothing to wait for
+    iot = fakeIot([{ 'version': 5, 'state': { 'delta': { 'volume': 5 } } }])
+    assert VersionWait().wait(iot, 1)
+    assert iot.waitPolls == 0
+
+    # A shadow older than our own update is not trusted, and unrelated deltas do not block
+    iot = fakeIot([
+        { 'version': 4, 'state': { 'reported': {} } },
+        { 'version': 6, 'state': { 'reported': { 'apower': True }, 'delta': { 'volume': 5 } } }
+    ], pendingState={ 'apower': True }, lastPutVersion=5)
+    assert VersionWait(initialDelay=.001).wait(iot, 1)
+    assert iot.waitPolls == 2
+
+def test_SubscriptionWait():
+    bus = ShadowMessageBus()
+    iot = fakeIot([], pendingState={ 'apower': True }, lastPutVersion=7)
+    topic = bus.topic('thing-001', 'update/documents')
+
+    # A stale retained document must not complete the wait
+    bus.publish(topic, { 'current': { 'version': 6, 'state': { 'desired': { 'apower': True }, 'reported': { 'apower': True } } } })
+    assert not SubscriptionWait(bus).wait(iot, .05)
+
+    bus.publish(topic, { 'current': { 'version': 8, 'state': { 'desired': { 'apower': True }, 'reported': { 'apower': True } } } })
+    assert SubscriptionWait(bus).wait(iot, .05)
+    assert bus.subscribers[topic] == []
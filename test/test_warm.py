@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 dhrone. All Rights Reserved.
+#
+import pytest
+import os
+import time
+
+from pyASH.endpoint import Endpoint
+from pyASH.interface import PowerController
+from pyASH.iot import IotTest, Thing
+from pyASH.user import DemoUser
+from pyASH.utility import get_uuid
+from pyASH.warm import WarmState, lambdaHandler
+
+@IotTest.initial('powerState', 'ON')
+class iotWarm(IotTest):
+    pass
+
+@Endpoint.addInterface(PowerController, proactivelyReported=True, retrievable=True)
+class tWarm(Endpoint):
+    pass
+
+def directive(token, name='TurnOff'):
+    return {
+        "directive": {
+            "header": { "namespace": "Alexa.PowerController", "name": name, "payloadVersion": "3", "messageId": get_uuid(), "correlationToken": "dFMb0z+PgpgdDmluhJ1LddFvSqZ/jCc8ptlAKulUj90jSqg==" },
+            "endpoint": { "scope": { "type": "BearerToken", "token": token }, "endpointId": "tWarm:endpoint-001", "cookie": {} },
+            "payload": {}
+        }
+    }
+
+@pytest.fixture
+def factory():
+    try:
+        os.remove('iotWarm.json')
+    except FileNotFoundError:
+        pass
+    created = []
+    def makeUser(token):
+        user = DemoUser()
+        user.uuid = 'uuid-' + token
+        user.addEndpoint(tWarm(things=Thing('endpoint-001', iotWarm), friendlyName='Warm'))
+        created.append(token)
+        return user
+    makeUser.created = created
+    yield makeUser
+    try:
+        os.remove('iotWarm.json')
+    except FileNotFoundError:
+        pass
+
+def test_WarmState_ReusesUsers(factory):
+    state = WarmState()
+    handler = lambdaHandler(factory, state)
+
+    response = handler(directive('token-a'))
+    assert response['event']['header']['name'] == 'Response'
+    user = state.getUser('token-a', factory)
+    handler(directive('token-a', 'TurnOn'))
+    handler(directive('token-b'))
+    assert factory.created == ['token-a', 'token-b']
+    assert state.getUser('token-a', factory) is user
+
+    state.invalidate(token='token-a')
+    handler(directive('token-a'))
+    assert factory.created == ['token-a', 'token-b', 'token-a']
+
+    state.invalidate(uuid='uuid-token-b')
+    state.getUser('token-b', factory)
+    assert factory.created[-1] == 'token-b'
+
+    state.invalidate()
+    assert len(state.entries) == 0
+
+def test_WarmState_Limits(factory):
+    state = WarmState(maxUsers=2, ttl=0.1)
+    for token in ['token-a', 'token-b', 'token-c']:
+        state.getUser(token, factory)
+    # token-a was the least recently used
+    state.getUser('token-a', factory)
+    assert factory.created == ['token-a', 'token-b', 'token-c', 'token-a']
+
+    time.sleep(0.15)
+    state.getUser('token-c', factory)
+    assert factory.created[-1] == 'token-c'
+
+def test_WarmState_TokenExpiry(factory):
+    state = WarmState(ttl=600)
+    def makeUser(token):
+        user = factory(token)
+        user.tokenExpires = time.time() + 0.1
+        return user
+    state.getUser('token-a', makeUser)
+    assert state.getUser('token-a', makeUser) is state.getUser('token-a', makeUser)
+
+    # The entry does not outlive the user's access token
+    time.sleep(0.15)
+    state.getUser('token-a', makeUser)
+    assert factory.created == ['token-a', 'token-a']
@@ -85,8 +85,7 @@ class PhysicalThing(object):
     def _updateCallback(self, payload, responseStatus, token):
         ''' Log result when a request has been made to update the IOT shadow '''
         if responseStatus == 'accepted':
-            payloadDict = json.loads(payload)
-            self._logger.info("Received delta request: " + json.dumps(payloadDict))
+            self._logger.info('Received delta request: %s', payload)
             return
 
         self._logger.warn({
@@ -96,11 +95,11 @@ class PhysicalThing(object):
 
     def _deltaCallback(self, payload, responseStatus, token):
         ''' Receive an delta message from IOT service and forward update requests for every included property to the event queue '''
-        print ('Delta message received with content: {0}'.format(payload))
+        self._logger.debug('Delta message received with content: %s', payload)
         payloadDict = json.loads(payload)
 
         for property in payloadDict['state']:
-            self._logger.info('Delta Message: processing item [{0}][{1}]'.format(property, payloadDict['state'][property]))
+            self._logger.info('Delta Message: processing item [%s][%s]', property, payloadDict['state'][property])
             self._eventQueue.put({'source': '__thing__', 'action': 'UPDATE', 'property': property, 'value': payloadDict['state'][property] })
 
     def _main(self):
@@ -120,9 +119,9 @@ class PhysicalThing(object):
 
             ''' Process all received messages '''
             updatedProperties = dict()
-            print ('Processing received messages')
+            self._logger.debug('Processing %d received messages', len(messages))
             for message in messages:
-                print (message)
+                self._logger.debug('%s', message)
                 if message['action'] == 'EXIT':
                     ''' If an EXIT message is received then stop processing messages and exit the main thing loop '''
                     return
@@ -224,31 +223,31 @@ class PhysicalDevice(ABC):
 
     def _readLoop(self):
         ''' Main event loop for reading from device '''
-        print ('Starting {0} readLoop'.format(self.__name__))
+        self._logger.info('Starting %s readLoop', self.__name__)
         while not self._exit:
             val = self._read(5) # Read input.  Timeout after 5 seconds to make sure we are checking that an exit hasn't been commanded.
             if val:
-                print ('Received {0} from device'.format(val))
+                self._logger.debug('Received %s from device', val)
                 ret = self._deviceToProperty(val) # Retrieve appropriate handler to translate device value into property value
                 if ret:
-                    print ('Sending {0} to event queue'.format(ret))
+                    self._logger.debug('Sending %s to event queue', ret)
                     (property, method) = ret
 
                     # Send updated property to Thing
                     self._eventQueue.put({'source': self.__name__, 'action': 'UPDATE', 'property': property, 'value': method(self,val) })
                 else:
-                    self._logger.warn('No method matches {0}'.format(val))
+                    self._logger.warn('No method matches %s', val)
 
     def _writeLoop(self):
         ''' Main event loop for writing to device '''
-        print ('Starting {0} writeLoop'.format(self.__name__))
+        self._logger.info('Starting %s writeLoop', self.__name__)
 
         while not self._exit:
             try:
                 message = self._deviceQueue.get(5)
                 self._deviceQueue.task_done()
 
-                print ('Received request to update device: {0}'.format(message))
+                self._logger.debug('Received request to update device: %s', message)
                 if message['action'].upper() == 'EXIT':
                     return
                 elif message['action'].upper() == 'UPDATE':
@@ -259,7 +258,7 @@ class PhysicalDevice(ABC):
                         # Send updated property to device
                         self._write(cmd.format(method(self,message['value'])))
                     else:
-                        self._logger.warn('No property matches {0}'.format(message['property']))
+                        self._logger.warn('No property matches %s', message['property'])
 
 
 